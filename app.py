@@ -1,38 +1,57 @@
 import streamlit as st
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
 import pandas as pd
 import os
-import time
-import base64
-import requests
 import json
-import re
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import time
 from datetime import datetime
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from urllib.parse import urlencode
 import zipfile
-import io
-
-# === CONFIGURAÇÃO DE RETRY === 
-MAX_RETRIES = 3
-RETRY_DELAY = 5  # segundos
-RETRY_BACKOFF = 1.5
-MAX_DELAY = 30
-
-# Erros que NÃO devem ter retry
-ERRORS_SEM_RETRY = [
-    "fatura indisponível no canal digital",
-    "fatura não disponível",
-    "documento não relacionado",
-    "acesso negado",
-    "não encontrado"
-]
+import shutil
+import tempfile
+import hashlib
+import queue
+import threading
+import itertools
+from collections import deque
+from scraper import (
+    MAX_WORKERS_PADRAO,
+    MAX_WORKERS_LIMITE,
+    MAX_REQUISICOES_PADRAO,
+    MAX_REQUISICOES_LIMITE,
+    INTERVALO_PROGRESSO,
+    DIRETORIO_EXPORTACOES,
+    CATEGORIAS_RESULTADO,
+    COLUNAS_PLANILHA,
+    ArmazemPDFs,
+    SnapshotPlanilhas,
+    ObservadorExecucao,
+    ColetorResultados,
+    JornalExecucoes,
+    iniciar_servidor_metricas,
+    normalizar_planilha,
+    montar_plano,
+    executar_scraper
+)
+
+# === CONFIGURAÇÃO DOS JOBS EM SEGUNDO PLANO ===
+MENSAGENS_EXIBIDAS = 30  # mensagens mostradas na tela de acompanhamento
+MAX_JOBS_HISTORICO = 20  # jobs finalizados mantidos na memória do servidor
+LIMITE_MENSAGENS_JOB = 500  # mensagens mais recentes guardadas por job
+LINHAS_TABELA_UCS = 200  # UCs mais recentes na tabela de acompanhamento
+INTERVALO_ATUALIZACAO_TELA = 2.0  # segundos entre redesenhos do painel do job
+UCS_POR_ATUALIZACAO = 25  # ...ou redesenha antes disso a cada N UCs concluídas
+
+# === PLANILHA DE UCS ===
+INTERVALO_VERIFICACAO_PLANILHA = 60  # segundos entre consultas ao modifiedTime da planilha no Drive
+CELULAS_POR_LOTE_PLANILHA = 3000  # células por chamada values:batchUpdate ao devolver os resultados
+INTERVALO_ESCRITA_PLANILHA = 1.5  # segundos entre chamadas (cota do Sheets: 60 escritas/min por usuário)
+TENTATIVAS_ESCRITA_PLANILHA = 5  # tentativas de cada lote em 429/5xx, com espera exponencial
+
+# === EXPORTAÇÃO ===
+TAMANHO_MAXIMO_ZIP = 100 * 1024 * 1024  # bytes de PDFs por parte do ZIP (o download_button lê a parte inteira na memória)
+IDADE_MAXIMA_EXPORTACAO = 6 * 60 * 60  # segundos sem uso antes de os ZIPs de um conjunto serem apagados
 
 # ----------------------------
 # Configurações iniciais
@@ -165,24 +184,75 @@ if 'executando' not in st.session_state:
 if 'parar_execucao' not in st.session_state:
     st.session_state.parar_execucao = False
 if 'arquivos_baixados' not in st.session_state:
-    st.session_state.arquivos_baixados = {} # Salvará os PDFs aqui
+    st.session_state.arquivos_baixados = {} # Metadados dos PDFs salvos em disco (caminho, tamanho, hash)
 
 # ----------------------------
 # Função para criar arquivo ZIP
 # ----------------------------
 def criar_zip_pdfs(arquivos_session):
-    """Cria um arquivo ZIP com todos os PDFs do session_state"""
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for mes, pdfs in arquivos_session.items():
-            for nome_arquivo, pdf_bytes in pdfs.items():
-                # Criar caminho virtual no ZIP (ex: 2025-10/COELBA_123_2025-10.pdf)
-                arcname = os.path.join(mes, nome_arquivo)
-                zip_file.writestr(arcname, pdf_bytes)
-    
-    zip_buffer.seek(0)
-    return zip_buffer
+    """Gera em disco (ou reaproveita) os ZIPs com todos os PDFs listados no session_state.
+
+    Os PDFs já são comprimidos, então entram com ZIP_STORED; cada arquivo é escrito
+    em streaming e fica em cache enquanto o conjunto de PDFs não mudar. O conjunto é
+    dividido em partes de até TAMANHO_MAXIMO_ZIP, na ordem dos meses, porque o
+    st.download_button carrega na memória tudo o que serve.
+    """
+    entradas = sorted(
+        (mes, nome_arquivo, metadados['sha256'], metadados['caminho'], metadados['tamanho'])
+        for mes, pdfs in arquivos_session.items()
+        for nome_arquivo, metadados in pdfs.items()
+    )
+    chave = hashlib.sha256(
+        "\n".join(f"{mes}/{nome_arquivo}:{sha256}" for mes, nome_arquivo, sha256, _, _ in entradas).encode()
+    ).hexdigest()[:16]
+
+    partes = []
+    for entrada in entradas:
+        if not partes or (partes[-1][1] and partes[-1][1] + entrada[4] > TAMANHO_MAXIMO_ZIP):
+            partes.append([[], 0])
+        partes[-1][0].append(entrada)
+        partes[-1][1] += entrada[4]
+
+    # Cada conjunto de PDFs tem o seu diretório: várias sessões exportam ao mesmo tempo
+    diretorio = os.path.join(DIRETORIO_EXPORTACOES, chave)
+    os.makedirs(diretorio, exist_ok=True)
+    os.utime(diretorio)  # marca o uso, para a limpeza por idade
+    caminhos = []
+    for numero, (entradas_parte, _) in enumerate(partes, start=1):
+        caminho_zip = os.path.join(diretorio, f"faturas_{numero:03d}.zip")
+        caminhos.append(caminho_zip)
+        if os.path.exists(caminho_zip):
+            continue
+
+        temporario = tempfile.NamedTemporaryFile(dir=diretorio, suffix='.tmp', delete=False)
+        try:
+            with temporario, zipfile.ZipFile(temporario, 'w', zipfile.ZIP_STORED) as zip_file:
+                for mes, nome_arquivo, _, caminho, _ in entradas_parte:
+                    # Criar caminho virtual no ZIP (ex: 2025-10/COELBA_123_2025-10.pdf)
+                    arcname = os.path.join(mes, nome_arquivo)
+                    zip_file.write(caminho, arcname)
+            os.replace(temporario.name, caminho_zip)
+        finally:
+            if os.path.exists(temporario.name):
+                os.remove(temporario.name)
+
+    limpar_exportacoes_antigas()
+    return caminhos
+
+def limpar_exportacoes_antigas():
+    """Apaga os conjuntos de ZIPs que nenhuma sessão usa há IDADE_MAXIMA_EXPORTACAO"""
+    limite = time.time() - IDADE_MAXIMA_EXPORTACAO
+    for nome in os.listdir(DIRETORIO_EXPORTACOES):
+        caminho = os.path.join(DIRETORIO_EXPORTACOES, nome)
+        try:
+            if os.path.getmtime(caminho) >= limite:
+                continue
+            if os.path.isdir(caminho):
+                shutil.rmtree(caminho, ignore_errors=True)
+            else:
+                os.remove(caminho)
+        except FileNotFoundError:
+            pass  # outra sessão limpou primeiro
 
 # ----------------------------
 # Função para exibir seção de downloads
@@ -201,9 +271,9 @@ def exibir_secao_downloads():
     
     total_arquivos = sum(len(pdfs) for pdfs in pdfs_por_mes.values())
     total_tamanho = sum(
-        len(pdf_bytes)
+        metadados['tamanho']
         for mes_pdfs in pdfs_por_mes.values() 
-        for pdf_bytes in mes_pdfs.values()
+        for metadados in mes_pdfs.values()
     ) / (1024 * 1024)
     
     col1, col2, col3 = st.columns(3)
@@ -215,48 +285,84 @@ def exibir_secao_downloads():
         st.metric("Tamanho Total", f"{total_tamanho:.2f} MB")
     
     if total_arquivos > 0:
-        zip_buffer = criar_zip_pdfs(pdfs_por_mes)
-        
-        st.download_button(
-            label="📦 Baixar Todos os Arquivos (ZIP)",
-            data=zip_buffer,
-            file_name=f"faturas_neoenergia_{datetime.now().strftime('%Y%m%d_%H%M')}.zip",
-            mime="application/zip",
-            use_container_width=True
-        )
+        # O ZIP só é montado/lido quando pedido, e não a cada rerun da página; só a parte
+        # escolhida passa pelo download_button, então a memória fica limitada a TAMANHO_MAXIMO_ZIP
+        if st.session_state.get('zip_solicitado'):
+            caminhos_zip = criar_zip_pdfs(pdfs_por_mes)
+            nome_zip = f"faturas_neoenergia_{datetime.now().strftime('%Y%m%d_%H%M')}"
+            parte = 0
+            if len(caminhos_zip) > 1:
+                parte = st.selectbox(
+                    "Parte do ZIP:",
+                    options=range(len(caminhos_zip)),
+                    format_func=lambda i: f"Parte {i + 1} de {len(caminhos_zip)} ({os.path.getsize(caminhos_zip[i]) / (1024 * 1024):.1f} MB)",
+                    key='parte_zip'
+                )
+                nome_zip += f"_parte{parte + 1:03d}"
+            with open(caminhos_zip[parte], 'rb') as arquivo_zip:
+                baixou = st.download_button(
+                    label="📦 Baixar Todos os Arquivos (ZIP)" if len(caminhos_zip) == 1 else f"📦 Baixar Parte {parte + 1} (ZIP)",
+                    data=arquivo_zip,
+                    file_name=f"{nome_zip}.zip",
+                    mime="application/zip",
+                    use_container_width=True
+                )
+            if baixou and len(caminhos_zip) == 1:
+                st.session_state.zip_solicitado = False
+        elif st.button("📦 Preparar ZIP com Todos os Arquivos", use_container_width=True):
+            st.session_state.zip_solicitado = True
+            st.rerun()
     
     for mes, pdfs in pdfs_por_mes.items():
         with st.expander(f"📅 Mês: {mes} ({len(pdfs)} arquivos)"):
-            for nome_arquivo, pdf_bytes in pdfs.items():
-                col1, col2, col3 = st.columns([3, 1, 1])
-                with col1:
-                    st.write(f"`{nome_arquivo}`")
-                with col2:
-                    st.write(f"{len(pdf_bytes) / 1024:.1f} KB")
-                with col3:
-                    st.download_button(
-                        label="📄 Baixar",
-                        data=pdf_bytes,
-                        file_name=nome_arquivo,
-                        mime="application/pdf",
-                        key=f"btn_{nome_arquivo}"
-                    )
+            # Só o arquivo escolhido é lido do disco a cada rerun; a lista do mês cresce durante
+            # a execução, então a escolha fica na sessão e é reposta se sair das opções
+            chave_arquivo = f"arquivo_{mes}"
+            escolhido = st.session_state.get(chave_arquivo)
+            st.session_state[chave_arquivo] = escolhido if escolhido in pdfs else next(iter(pdfs))
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                nome_arquivo = st.selectbox(
+                    "Arquivo:",
+                    options=list(pdfs),
+                    format_func=lambda nome: f"{nome} ({pdfs[nome]['tamanho'] / 1024:.1f} KB)",
+                    key=chave_arquivo,
+                    label_visibility="collapsed"
+                )
+            with col2:
+                st.download_button(
+                    label="📄 Baixar",
+                    data=ArmazemPDFs.ler(pdfs[nome_arquivo]),
+                    file_name=nome_arquivo,
+                    mime="application/pdf",
+                    key=f"btn_{mes}",
+                    use_container_width=True
+                )
 
 # ----------------------------
 # Função de autenticação Google Sheets
 # ----------------------------
+@st.cache_resource(show_spinner=False)
+def cliente_google(service_account_json):
+    """Cliente gspread autorizado, único no processo e reaproveitado entre reruns e sessões.
+
+    As credenciais renovam o token sozinhas quando ele expira, então só a primeira
+    operação paga a troca OAuth. Recebe a service account serializada para que uma
+    troca de credenciais nos Secrets gere um cliente novo.
+    """
+    creds = Credentials.from_service_account_info(
+        json.loads(service_account_json),
+        scopes=["https.www.googleapis.com/auth/spreadsheets", 
+                "https.www.googleapis.com/auth/drive"]
+    )
+    return gspread.authorize(creds)
+
 def autorizar_google():
     """Autenticação simples com Service Account"""
     try:
         if hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
             service_account_info = dict(st.secrets['gcp_service_account'])
-            creds = Credentials.from_service_account_info(
-                service_account_info,
-                scopes=["https.www.googleapis.com/auth/spreadsheets", 
-                        "https.www.googleapis.com/auth/drive"]
-            )
-            gc = gspread.authorize(creds)
-            return gc
+            return cliente_google(json.dumps(service_account_info, sort_keys=True))
         else:
             st.error("🔐 Credenciais não encontradas nos Secrets")
             return None
@@ -268,19 +374,29 @@ def autorizar_google():
 # ----------------------------
 # Função COM CACHE para carregar dados
 # ----------------------------
-@st.cache_data(ttl=600)  # Cache de 10 minutos
+@st.cache_data(ttl=INTERVALO_VERIFICACAO_PLANILHA)
 def carregar_dados_planilha(sheet_key, sheet_name):
-    """Carrega e armazena em cache os dados do Google Sheets."""
+    """Carrega a aba da cópia local, baixando de novo só se a planilha mudou no Drive."""
     try:
-        gc = autorizar_google()
-        if not gc:
-            st.error("Falha na autenticação com Google.")
-            return pd.DataFrame()  # Retorna DF vazio em caso de falha
-
-        spreadsheet = gc.open_by_key(sheet_key)
-        sheet = spreadsheet.worksheet(sheet_name)
-        dados = sheet.get_all_values()
-        
+        snapshot = SnapshotPlanilhas()
+        modificado_em, dados = snapshot.obter(sheet_key, sheet_name)
+
+        try:
+            gc = autorizar_google()
+            if not gc:
+                raise RuntimeError("Falha na autenticação com Google.")
+
+            # Uma chamada leve ao Drive; get_all_values só quando a planilha foi editada
+            modificado_agora = gc.get_file_drive_metadata(sheet_key)['modifiedTime']
+            if modificado_agora != modificado_em:
+                # Usa o que foi guardado (só as colunas da extração), igual ao que a cópia local devolve depois
+                dados = gc.open_by_key(sheet_key).worksheet(sheet_name).get_all_values()
+                dados = snapshot.salvar(sheet_key, sheet_name, modificado_agora, dados)
+        except Exception as e:
+            if dados is None:
+                raise
+            st.warning(f"⚠️ Usando a cópia local da planilha (sincronizada em {modificado_em}): {e}")
+
         if not dados or len(dados) < 1:
             st.warning("A planilha parece estar vazia ou conter apenas cabeçalho.")
             return pd.DataFrame()
@@ -291,104 +407,13 @@ def carregar_dados_planilha(sheet_key, sheet_name):
         st.error(f"❌ Erro ao carregar dados do Google Sheets: {e}")
         return pd.DataFrame()
 
-# ----------------------------
-# Configuração do Selenium
-# ----------------------------
-def iniciar_navegador(headless=True):
-    chrome_options = Options()
-    if headless:
-        chrome_options.add_argument("--headless=new")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--window-size=1920,1080")
-    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-    chrome_options.add_experimental_option('useAutomationExtension', False)
-    
-    try:
-        # No Streamlit Cloud, o chromedriver estará no PATH se vc usar o packages.txt
-        driver = webdriver.Chrome(options=chrome_options) 
-        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        return driver
-    except Exception as e:
-        st.error(f"Erro ao iniciar navegador: {e}")
-        st.error("Verifique se o 'google-chrome-stable' e 'chromedriver' estão no seu 'packages.txt'.")
-        return None
+@st.cache_resource(max_entries=20, show_spinner=False)
+def plano_extracao(df, estimativa_inicio, estimativa_fim, clientes_selecionados):
+    """Plano filtrado e agrupado por login, montado uma vez por versão da planilha e combinação de filtros.
 
-# ----------------------------
-# Função para fazer requisições com retry
-# ----------------------------
-def fazer_requisicao_com_retry(url, headers=None, params=None, method='GET', 
-                               max_retries=MAX_RETRIES, 
-                               initial_delay=RETRY_DELAY,
-                               backoff_factor=RETRY_BACKOFF,
-                               skip_retry_errors=None):
-    if skip_retry_errors is None:
-        skip_retry_errors = ERRORS_SEM_RETRY
-    
-    for attempt in range(max_retries):
-        try:
-            if method.upper() == 'GET':
-                response = requests.get(url, headers=headers, params=params, timeout=90)
-            else:
-                response = requests.post(url, headers=headers, json=params, timeout=90)
-            
-            if response.status_code == 200:
-                return response
-            
-            response_text = response.text.lower()
-            should_skip_retry = any(error in response_text for error in skip_retry_errors)
-            
-            if should_skip_retry:
-                return response
-            
-            if response.status_code == 500:
-                current_delay = min(initial_delay * (backoff_factor ** attempt), MAX_DELAY)
-                if attempt < max_retries - 1:
-                    time.sleep(current_delay)
-                    continue
-                else:
-                    return response
-            
-            return response
-            
-        except requests.exceptions.Timeout:
-            current_delay = min(initial_delay * (backoff_factor ** attempt), MAX_DELAY)
-            if attempt < max_retries - 1:
-                time.sleep(current_delay)
-                continue
-            else:
-                raise
-        except requests.exceptions.ConnectionError:
-            current_delay = min(initial_delay * (backoff_factor ** attempt), MAX_DELAY)
-            if attempt < max_retries - 1:
-                time.sleep(current_delay)
-                continue
-            else:
-                raise
-    
-    return None
-
-# ----------------------------
-# Função para verificar token no storage
-# ----------------------------
-def verificar_token_storage(navegador, id_distribuidora):
-    try:
-        if id_distribuidora == 52:
-            token_raw = navegador.execute_script("return window.localStorage.getItem('tokenNeSe');")
-            return token_raw is not None
-        else:
-            token = navegador.execute_script("return window.localStorage.getItem('access_token') || window.localStorage.getItem('token');")
-            return token is not None
-    except:
-        return False
-
-# ----------------------------
-# Função para limpar documento
-# ----------------------------
-def limpar_documento(documento):
-    return re.sub(r'[^0-9]', '', documento)
+    Compartilhado entre reruns e sessões sem cópia: quem usa só lê (ou deriva outro plano).
+    """
+    return montar_plano(df, estimativa_inicio, estimativa_fim, clientes_selecionados)
 
 # ----------------------------
 # Função para parar execução
@@ -396,584 +421,322 @@ def limpar_documento(documento):
 def parar_execucao():
     st.session_state.parar_execucao = True
     st.session_state.executando = False
+    job_id = st.session_state.get('job_id')
+    if job_id is not None:
+        obter_gerenciador_jobs().parar(job_id)
 
 # ----------------------------
-# Função principal do scraper
+# Jobs em segundo plano (sobrevivem a reloads e quedas do navegador)
 # ----------------------------
-def executar_scraper(df_filtrado, progress_bar, status_text, meses_desejados, mes_atraso, headless=False):
-    # O diretório de download não é mais usado para salvar arquivos
-    
-    navegador = iniciar_navegador(headless)
-    if not navegador:
-        st.error("❌ Não foi possível iniciar o navegador")
-        return None
-    
-    ucs_retidas = []
-    tempos_ucs = []
-    ucs_inativas = []
-    ucs_sem_fatura = []
-    ucs_cadastro_invalido = []
-    ucs_ativar_cadastro = []
-    ucs_fatura_indisponivel = []
-    ucs_erro_sistema = []
-    ucs_erro_busca = []
-    ucs_sucesso = []
-    
-    tempo_total_inicio = time.perf_counter()
-    
-    for i in range(len(df_filtrado)):
-        if st.session_state.parar_execucao:
-            st.warning("⏹️ Execução interrompida pelo usuário")
-            break
+STATUS_JOB = {
+    'na_fila': '⏳ Na fila',
+    'executando': '🔄 Executando',
+    'concluido': '✅ Concluído',
+    'parado': '⏹️ Parado',
+    'erro': '❌ Erro'
+}
 
-        inicio_uc = time.perf_counter()
-        progress = (i + 1) / len(df_filtrado)
-        progress_bar.progress(progress)
-        status_text.text(f"Processando UC {i+1} de {len(df_filtrado)}")
+ROTULOS_DESFECHO = {
+    'ucs_sucesso': '✅ Sucesso',
+    'ucs_retidas': '📦 Retida',
+    'ucs_fatura_indisponivel': '🚫 Indisponível',
+    'ucs_erro_sistema': '🔴 Erro Sistema',
+    'ucs_erro_busca': '❌ Erro Busca',
+    'ucs_sem_fatura': '📭 Sem Fatura',
+    'ucs_inativas': '⛔ Inativa',
+    'ucs_ativar_cadastro': '🔐 Ativar Cadastro',
+    'ucs_cadastro_invalido': '🔑 Cred. Inválida'
+}
 
-        try:
-            login = df_filtrado['login'].iloc[i].strip()
-            senha = df_filtrado['senha_dist'].iloc[i]
-            uc_desejada = df_filtrado['codigo'].iloc[i].zfill(12)
-            id_distribuidora = int(df_filtrado['dist'].iloc[i])
-
-            distribuidoras_map = {
-                11: {'nome': 'COELBA', 'canal': 'AGC', 'regiao': 'NE', 'usuario_api': 'WSO2_CONEXAO', 'base_url': 'apineprd'},
-                42: {'nome': 'COSERN', 'canal': 'AGR', 'regiao': 'NE', 'usuario_api': 'WSO2_CONEXAO', 'base_url': 'apineprd'},
-                43: {'nome': 'CELP',   'canal': 'AGP', 'regiao': 'NE', 'usuario_api': 'WSO2_CONEXAO', 'base_url': 'apineprd'},
-                52: {'nome': 'ELEKTRO', 'canal': 'AGE', 'regiao': 'SE', 'usuario_api': 'AGENEOELK', 'base_url': 'apiseprd'}
-            }
+class PainelExecucao(ObservadorExecucao):
+    """Observador que só acumula os eventos do motor; a tela é redesenhada em lote pelo acompanhar_job"""
+
+    def __init__(self):
+        self.contagens = {categoria: 0 for categoria in CATEGORIAS_RESULTADO}
+        self.linhas = deque(maxlen=LINHAS_TABELA_UCS)
+        self.mensagens = deque(maxlen=LIMITE_MENSAGENS_JOB)
+        self.ucs_concluidas = 0
+        self._lock = threading.Lock()
+
+    def uc_concluida(self, registro):
+        desfecho = registro.desfecho
+        linha = {
+            'Nº': registro.numero,
+            'UC': registro.uc,
+            'Login': registro.login,
+            'Desfecho': ROTULOS_DESFECHO.get(desfecho, '—'),
+            'Protocolo': registro.protocolo,
+            'Faturas': registro.faturas_encontradas,
+            'Mais recente': registro.mais_recente,
+            'Baixados': ", ".join(registro.meses_baixados),
+            'Reaproveitados': ", ".join(registro.meses_reaproveitados),
+            'Não encontrados': ", ".join(registro.meses_nao_encontrados),
+            'Tempo (s)': registro.tempo
+        }
+        with self._lock:
+            self.ucs_concluidas += 1
+            if desfecho:
+                self.contagens[desfecho] += 1
+            self.linhas.append(linha)
+
+    def mensagem(self, nivel, texto):
+        with self._lock:
+            self.mensagens.append((nivel, texto))
+
+    def instantaneo(self):
+        """Cópia consistente do estado para desenhar a tela fora do lock"""
+        with self._lock:
+            return dict(self.contagens), list(self.linhas), list(self.mensagens)[-MENSAGENS_EXIBIDAS:]
+
+# Colunas do bd_ucs atualizadas com o desfecho de cada UC; erros do sistema e de busca
+# só entram no Historico_Faturas, para a UC continuar na próxima extração. Os desfechos do
+# login (cadastro inválido/ativar cadastro) também: um portal lento cai no mesmo caminho que
+# uma senha errada, e um Status permanente tiraria a UC do filtrar_ucs para sempre
+STATUS_PLANILHA = {
+    'ucs_sucesso': {'Status': 'Acesso Ok', 'Status_TEST': 'Baixada'},
+    'ucs_retidas': {'Status': 'Retida'},
+    'ucs_fatura_indisponivel': {'Status': 'Sem fatura do mês de referencia'},
+    'ucs_sem_fatura': {'Status': 'Sem fatura do mês de referencia'},
+    'ucs_inativas': {'Status': 'Inativa'}
+}
 
-            if id_distribuidora not in distribuidoras_map:
-                continue
+def coluna_planilha(nome):
+    """Letra da coluna do bd_ucs (ex.: 'codigo' -> 'D')"""
+    return rowcol_to_a1(1, COLUNAS_PLANILHA.index(nome) + 1)[:-1]
+
+class ObservadorPlanilha(ObservadorExecucao):
+    """Acumula o desfecho de cada UC e, no fim do job, grava tudo no bd_ucs em poucas chamadas em lote.
+
+    As linhas são localizadas só na hora de gravar, relendo as colunas codigo/login: a aba pode ter
+    ganhado, perdido ou reordenado linhas desde que o job foi submetido.
+    """
+
+    def __init__(self, gc, sheet_key, sheet_name):
+        self.gc = gc
+        self.sheet_key = sheet_key
+        self.sheet_name = sheet_name
+        self.valores = {}  # (codigo, login) -> {coluna: valor}
+        self._lock = threading.Lock()
+
+    def uc_concluida(self, registro):
+        desfecho = registro.desfecho
+        if desfecho is None:
+            return
+
+        meses = sorted(registro.meses_baixados + registro.meses_reaproveitados, reverse=True)
+        historico = f"{datetime.now():%d/%m/%Y} - {ROTULOS_DESFECHO[desfecho].split(' ', 1)[1]}"
+        if meses:
+            historico += f": {', '.join(meses)}"
+
+        with self._lock:
+            self.valores[(registro.codigo, registro.login)] = {
+                **STATUS_PLANILHA.get(desfecho, {}), 'Historico_Faturas': historico
+            }
 
-            distribuidora = distribuidoras_map[id_distribuidora]['nome']
-            canal = distribuidoras_map[id_distribuidora]['canal']
-            regiao = distribuidoras_map[id_distribuidora]['regiao']
-            usuario_api = distribuidoras_map[id_distribuidora]['usuario_api']
-            base_url = distribuidoras_map[id_distribuidora]['base_url']
-
-            # Lógica de login
-            precisa_logar = False
-            if i == 0:
-                precisa_logar = True
-            elif df_filtrado['login'].iloc[i] != df_filtrado['login'].iloc[i-1]:
-                precisa_logar = True
-            elif not verificar_token_storage(navegador, id_distribuidora):
-                precisa_logar = True
-
-            if precisa_logar:
-                navegador.get("https://agenciavirtual.neoenergia.com/#/login")
-                time.sleep(3)
-                
-                # Clicar no botão LOGIN
-                login_btn_found = False
-                for elem in navegador.find_elements(By.TAG_NAME, 'button'):
-                    if 'LOGIN' in elem.text.upper(): 
-                        navegador.execute_script("arguments[0].click();", elem)
-                        login_btn_found = True
-                        break
-                
-                if not login_btn_found:
-                    for elem in navegador.find_elements(By.XPATH, "//button | //a | //input[@type='button']"):
-                         if 'LOGIN' in elem.get_attribute('innerHTML').upper() or 'LOGIN' in elem.get_attribute('value', '').upper(): 
-                            navegador.execute_script("arguments[0].click();", elem)
-                            login_btn_found = True
-                            break
-                
-                time.sleep(2)
-                
-                # Preencher campos de login
-                try:
-                    campo_user = WebDriverWait(navegador, 10).until(EC.presence_of_element_located((By.ID, 'userId')))
-                    campo_user.clear()
-                    campo_user.send_keys(login)
-                    
-                    campo_senha = navegador.find_element(By.ID, 'password')
-                    campo_senha.clear()
-                    campo_senha.send_keys(senha)
-                except Exception as e:
-                    for j in range(i, len(df_filtrado)):
-                        if df_filtrado['login'].iloc[j] == login: 
-                            ucs_cadastro_invalido.append(df_filtrado['codigo'].iloc[j].zfill(12))
-                        else: 
-                            break
-                    continue
-                
-                time.sleep(1)
-                
-                # Clicar no botão ENTRAR
-                entrar_btn_found = False
-                for elem in navegador.find_elements(By.TAG_NAME, 'button'):
-                    if 'ENTRAR' in elem.text.upper(): 
-                        navegador.execute_script("arguments[0].click();", elem)
-                        entrar_btn_found = True
-                        break
-                
-                if not entrar_btn_found:
-                    for elem in navegador.find_elements(By.XPATH, "//button | //input[@type='submit']"):
-                        if 'ENTRAR' in elem.get_attribute('innerHTML').upper() or 'ENTRAR' in elem.get_attribute('value', '').upper(): 
-                            navegador.execute_script("arguments[0].click();", elem)
-                            entrar_btn_found = True
-                            break
-                
-                time.sleep(10)
-                
-                # Verificar se precisa trocar senha
-                try:
-                    aviso = WebDriverWait(navegador, 3).until(EC.presence_of_element_located((By.ID, 'swal2-html-container'))).text
-                    if 'troca da sua senha' in aviso.lower():
-                        for j in range(i, len(df_filtrado)):
-                            if df_filtrado['login'].iloc[j] == login: 
-                                ucs_ativar_cadastro.append(df_filtrado['codigo'].iloc[j].zfill(12))
-                            else: 
-                                break
-                        continue
-                except: 
-                    pass
-                
-                # Verificar credenciais inválidas
-                credenciais_invalidas = False
-                try:
-                    error_msgs = navegador.find_elements(By.CLASS_NAME, 'm-0')
-                    for msg in error_msgs:
-                        if 'CPF/CNPJ ou senha inválidos' in msg.text:
-                            credenciais_invalidas = True
-                            for j in range(i, len(df_filtrado)):
-                                if df_filtrado['login'].iloc[j] == login: 
-                                    ucs_cadastro_invalido.append(df_filtrado['codigo'].iloc[j].zfill(12))
-                                else: 
-                                    break
-                            break
-                except: 
-                    pass
-                
-                if credenciais_invalidas: 
-                    continue
-                
-                time.sleep(3)
-
-            # Obter token
-            token = None
-            try:
-                if id_distribuidora == 52:
-                    token_raw = navegador.execute_script("return window.localStorage.getItem('tokenNeSe');")
-                    if token_raw:
-                        try: 
-                            tokens = json.loads(token_raw)
-                            token = tokens['se']
-                        except: 
-                            token = token_raw
-                else:
-                    token = navegador.execute_script("return window.localStorage.getItem('access_token') || window.localStorage.getItem('token');")
-                
-                if not token:
-                    ucs_erro_sistema.append(uc_desejada)
-                    continue
-                    
-            except Exception as e:
-                ucs_erro_sistema.append(uc_desejada)
+    def _celulas(self, aba, valores):
+        """Células A1 a gravar, com as linhas atuais da aba; chaves ausentes ou repetidas ficam de fora"""
+        codigos, logins, historicos = [
+            (coluna[0] if coluna else [])
+            for coluna in aba.batch_get(
+                [f"{letra}:{letra}" for letra in map(coluna_planilha, ('codigo', 'login', 'Historico_Faturas'))],
+                major_dimension='COLUMNS'
+            )
+        ]
+        linhas = {}
+        for posicao, (codigo, login) in enumerate(zip(codigos, logins)):
+            if posicao == 0:
+                continue  # cabeçalho
+            linhas[(codigo, login)] = None if (codigo, login) in linhas else posicao + 1
+
+        celulas = []
+        ignoradas = 0
+        for chave, colunas in valores.items():
+            linha = linhas.get(chave)
+            if linha is None:
+                ignoradas += 1
                 continue
+            for coluna, valor in colunas.items():
+                if coluna == 'Historico_Faturas':
+                    # O histórico acumula as execuções: a linha nova vai ao fim do que já existe
+                    anterior = historicos[linha - 1] if linha - 1 < len(historicos) else ''
+                    valor = f"{anterior}\n{valor}" if anterior else valor
+                celulas.append((rowcol_to_a1(linha, COLUNAS_PLANILHA.index(coluna) + 1), valor))
+        return celulas, ignoradas
+
+    def enviar(self, coletor):
+        """Grava as células acumuladas; falhas viram mensagens do job e não derrubam a execução"""
+        with self._lock:
+            valores = dict(self.valores)
+        if not valores:
+            return
 
-            headers = {
-                'Authorization': f'Bearer {token}', 
-                'Content-Type': 'application/json',
-                'Accept': 'application/json', 
-                'User-Agent': 'Mozilla/5.0'
-            }
-            time.sleep(1)
-            
-            # Lógica específica para cada distribuidora
-            if id_distribuidora == 52:
-                # ELEKTRO
-                uc_info = {'uc': uc_desejada}
-                
-                url_protocolo = "https://apiseprd.neoenergia.com/protocolo/1.1.0/obterProtocolo"
-                params_protocolo = {
-                    "distribuidora": "ELEKTRO",
-                    "canalSolicitante": "AGE",
-                    "usuario": "AGENEOELK",
-                    "documento": limpar_documento(login),
-                    "recaptchaAnl": "false",
-                    "regiao": "SE"
-                }
-
-                try:
-                    time.sleep(1)
-                    res_protocolo = fazer_requisicao_com_retry(url_protocolo, headers=headers, params=params_protocolo, method='GET')
-                    
-                    if not res_protocolo or res_protocolo.status_code != 200:
-                        ucs_erro_sistema.append(uc_desejada)
-                        ucs_erro_busca.append(uc_desejada)
-                        continue
-                    
-                    protocolo_data = res_protocolo.json()
-                    protocolo = protocolo_data.get('protocoloSalesforceStr')
-                    
-                    if not protocolo:
-                        ucs_retidas.append(uc_desejada)
-                        continue
-                    
-                except Exception as e:
-                    ucs_retidas.append(uc_desejada)
-                    continue
-
-                url_faturas = "https://apiseprd.neoenergia.com/multilogin/2.0.0/servicos/faturas/ucs/faturas"
-                params_faturas = {
-                    "codigo": uc_desejada,
-                    "documento": limpar_documento(login),
-                    "canalSolicitante": "AGE",
-                    "usuario": "AGENEOELK",
-                    "protocolo": protocolo,
-                    "distribuidora": "ELEKTRO",
-                    "regiao": "SE",
-                    "tipoPerfil": "1"
-                }
-
-                try:
-                    time.sleep(1)
-                    res_faturas = fazer_requisicao_com_retry(url_faturas, headers=headers, params=params_faturas, method='GET')
-                    
-                    if not res_faturas or res_faturas.status_code != 200:
-                        ucs_erro_sistema.append(uc_desejada)
-                        ucs_erro_busca.append(uc_desejada)
-                        continue
-                    
-                    faturas_data = res_faturas.json()
-                    if 'entregaFaturas' in faturas_data:
-                        faturas = faturas_data['entregaFaturas'][0].get('faturas', [])
-                    elif 'faturas' in faturas_data:
-                        faturas = faturas_data['faturas']
-                    else:
-                        ucs_retidas.append(uc_desejada)
-                        continue
-                    
-                except Exception as e:
-                    ucs_retidas.append(uc_desejada)
-                    continue
+        try:
+            aba = self.gc.open_by_key(self.sheet_key).worksheet(self.sheet_name)
+            celulas, ignoradas = self._celulas(aba, valores)
+            if ignoradas:
+                coletor.registrar_mensagem(
+                    f"⚠️ {ignoradas} UCs não foram gravadas na planilha: código/login ausente ou repetido em {self.sheet_name}",
+                    'warning'
+                )
+            for inicio in range(0, len(celulas), CELULAS_POR_LOTE_PLANILHA):
+                if inicio:
+                    time.sleep(INTERVALO_ESCRITA_PLANILHA)
+                lote = celulas[inicio:inicio + CELULAS_POR_LOTE_PLANILHA]
+                self._enviar_lote(aba, [{'range': celula, 'values': [[valor]]} for celula, valor in lote])
+        except Exception as e:
+            coletor.registrar_mensagem(f"⚠️ Não foi possível atualizar a planilha: {e}", 'warning')
+            return
 
-            else:
-                # Demais distribuidoras
-                login_limpo = limpar_documento(login)
-                url_ucs = f'https://{base_url}.neoenergia.com/imoveis/1.1.0/clientes/{login_limpo}/ucs'
-                
-                params_ucs = {
-                    'documento': login_limpo,
-                    'canalSolicitante': canal,
-                    'distribuidora': distribuidora,
-                    'usuario': usuario_api,
-                    'indMaisUcs': 'X',
-                    'protocolo': '123',
-                    'opcaoSSOS': 'S',
-                    'tipoPerfil': '1'
-                }
-
-                try:
-                    time.sleep(1)
-                    res_ucs = fazer_requisicao_com_retry(url_ucs, headers=headers, params=params_ucs, method='GET')
-                    
-                    if not res_ucs or res_ucs.status_code != 200:
-                        ucs_erro_sistema.append(uc_desejada)
-                        ucs_erro_busca.append(uc_desejada)
-                        continue
-                    
-                    ucs_data = res_ucs.json()
-                    ucs = ucs_data.get('listaUnidadesConsumidoras') or ucs_data.get('ucs') or []
-                    
-                    uc_info = next((uc for uc in ucs if uc['uc'].endswith(uc_desejada[-10:])), None)
-                    if not uc_info:
-                        ucs_retidas.append(uc_desejada)
-                        continue
-                    
-                except Exception as e:
-                    ucs_retidas.append(uc_desejada)
-                    continue
-
-                url_protocolo = f'https://{base_url}.neoenergia.com/protocolo/1.1.0/obterProtocolo'
-                params_protocolo = {
-                    'distribuidora': distribuidora[:4],
-                    'canalSolicitante': canal,
-                    'documento': login_limpo,
-                    'codCliente': uc_info['uc'],
-                    'recaptchaAnl': 'false',
-                    'regiao': regiao
-                }
-
-                try:
-                    time.sleep(1)
-                    res_protocolo = fazer_requisicao_com_retry(url_protocolo, headers=headers, params=params_protocolo, method='GET')
-                    
-                    if not res_protocolo or res_protocolo.status_code != 200:
-                        ucs_erro_sistema.append(uc_info['uc'])
-                        ucs_erro_busca.append(uc_info['uc'])
-                        continue
-                    
-                    protocolo_data = res_protocolo.json()
-                    protocolo = (protocolo_data.get('protocolo') or 
-                                 protocolo_data.get('protocoloSalesforceStr') or 
-                                 protocolo_data.get('protocoloSalesforce') or 
-                                 protocolo_data.get('protocoloLegadoStr') or 
-                                 protocolo_data.get('protocoloLegado'))
-                    
-                    if not protocolo:
-                        ucs_retidas.append(uc_info['uc'])
-                        continue
-                    
-                except Exception as e:
-                    ucs_retidas.append(uc_info['uc'])
-                    continue
-
-                url_faturas = f'https://{base_url}.neoenergia.com/multilogin/2.0.0/servicos/faturas/ucs/faturas'
-                params_faturas = {
-                    'codigo': uc_info['uc'],
-                    'documento': login_limpo,
-                    'canalSolicitante': canal,
-                    'usuario': usuario_api,
-                    'protocolo': protocolo,
-                    'byPassActiv': 'X',
-                    'documentoSolicitante': login_limpo,
-                    'documentoCliente': login_limpo,
-                    'distribuidora': distribuidora,
-                    'tipoPerfil': '1'
-                }
-
-                try:
-                    time.sleep(1)
-                    res_faturas = fazer_requisicao_com_retry(url_faturas, headers=headers, params=params_faturas, method='GET')
-                    
-                    if not res_faturas or res_faturas.status_code != 200:
-                        ucs_erro_sistema.append(uc_info['uc'])
-                        ucs_erro_busca.append(uc_info['uc'])
-                        continue
-                    
-                    faturas_data = res_faturas.json()
-                    faturas = faturas_data.get("faturas", [])
-                    
-                except Exception as e:
-                    ucs_retidas.append(uc_info['uc'])
-                    continue
-
-            # Processar faturas
-            if not faturas:
-                ucs_sem_fatura.append(uc_info.get('uc', uc_desejada))
-                continue
+        coletor.registrar_mensagem(f"📝 Planilha atualizada: {len(celulas)} células de {self.sheet_name}", 'success')
 
+    def _enviar_lote(self, aba, dados):
+        for tentativa in range(TENTATIVAS_ESCRITA_PLANILHA):
             try:
-                if id_distribuidora == 52:
-                    f_mais_recente = sorted(faturas, key=lambda f: f.get("dataCompetencia", ""), reverse=True)[0]
-                    if f_mais_recente.get("dataCompetencia", "")[:7].replace('-', '/') <= mes_atraso.replace('/', '-'):
-                        ucs_inativas.append(uc_info['uc'])
-                else:
-                    f_mais_recente = sorted(faturas, key=lambda f: f.get("mesReferencia", ""), reverse=True)[0]
-                    if f_mais_recente.get("mesReferencia") <= mes_atraso:
-                        ucs_inativas.append(uc_info['uc'])
-            except IndexError:
-                ucs_sem_fatura.append(uc_info.get('uc', uc_desejada))
+                aba.batch_update(dados, value_input_option='RAW')
+                return
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code
+                if (status != 429 and status < 500) or tentativa == TENTATIVAS_ESCRITA_PLANILHA - 1:
+                    raise
+                time.sleep(INTERVALO_ESCRITA_PLANILHA * 2 ** (tentativa + 1))
+
+class JobExtracao:
+    """Uma execução do scraper na fila do servidor; progresso e resultados ficam aqui, fora da sessão"""
+
+    def __init__(self, job_id, df_filtrado, parametros, escrita_planilha=None):
+        self.id = job_id
+        self.df_filtrado = df_filtrado
+        self.parametros = parametros
+        self.painel = PainelExecucao()
+        self.escrita_planilha = escrita_planilha
+        observadores = [self.painel] + ([escrita_planilha] if escrita_planilha else [])
+        self.coletor = ColetorResultados(len(df_filtrado), observadores=observadores)
+        self.status = 'na_fila'
+        self.resultados = None
+        self.criado_em = datetime.now()
+        self.finalizado_em = None
+
+    @property
+    def ativo(self):
+        return self.status in ('na_fila', 'executando')
+
+    def progresso(self):
+        return min(self.coletor.ucs_concluidas, self.coletor.total), self.coletor.total
+
+class GerenciadorJobs:
+    """Fila de jobs executados um de cada vez por uma thread do servidor"""
+
+    def __init__(self):
+        self.jobs = {}
+        self._fila = queue.Queue()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._executar, name="jobs-extracao", daemon=True)
+        self._thread.start()
+
+    def submeter(self, df_filtrado, escrita_planilha=None, **parametros):
+        """Coloca uma execução na fila; `parametros` são repassados ao executar_scraper"""
+        with self._lock:
+            job = JobExtracao(next(self._ids), df_filtrado, parametros, escrita_planilha)
+            self.jobs[job.id] = job
+            self._descartar_antigos()
+        self._fila.put(job)
+        return job
+
+    def obter(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def listar(self):
+        with self._lock:
+            return sorted(self.jobs.values(), key=lambda job: job.id, reverse=True)
+
+    def parar(self, job_id):
+        """Pede a parada; o job termina a UC em andamento e não começa outra"""
+        job = self.obter(job_id)
+        if job:
+            job.coletor.parar.set()
+
+    def _descartar_antigos(self):
+        finalizados = [job for job in sorted(self.jobs.values(), key=lambda job: job.id) if not job.ativo]
+        for job in finalizados[:max(0, len(finalizados) - MAX_JOBS_HISTORICO)]:
+            del self.jobs[job.id]
+
+    def _executar(self):
+        while True:
+            job = self._fila.get()
+            if job.coletor.parar.is_set():
+                job.status = 'parado'
+                job.finalizado_em = datetime.now()
                 continue
 
-            st.write(f"🔍 Busca {i+1} de {len(df_filtrado)}")
-            st.write(f"✅ Protocolo: {protocolo}")
-            st.write(f"✅ {len(faturas)} faturas encontradas")
-            
-            if id_distribuidora == 52:
-                st.write(f"🧾 Mais recente: {f_mais_recente.get('dataCompetencia')}")
-            else:
-                st.write(f"🧾 Mais recente: {f_mais_recente.get('mesReferencia')}")
-
-            # Baixar faturas dos meses desejados
-            faturas_baixadas_neste_mes = 0
-            meses_lista = [mes.strip() for mes in meses_desejados.split(",")]
-            
-            for mes_desejada in meses_lista:
-                if st.session_state.parar_execucao:
-                    break # Interrompe o loop de meses se o usuário parar
-
-                fatura_desejada = None
-                
-                if id_distribuidora == 52:
-                    mes_desejada_formatada = mes_desejada.replace('/', '-')
-                    fatura_desejada = next((f for f in faturas if f.get('dataCompetencia', '').startswith(mes_desejada_formatada)), None)
-                else:
-                    fatura_desejada = next((f for f in faturas if f.get('mesReferencia') == mes_desejada), None)
-                
-                if not fatura_desejada:
-                    st.write(f"⚠️ Fatura do mês {mes_desejada} não encontrada.")
-                    if uc_info.get('uc', uc_desejada) not in ucs_retidas:
-                        ucs_retidas.append(uc_info.get('uc', uc_desejada))
-                    continue
-
-                numero_fatura = fatura_desejada.get('numeroFatura')
-                if not numero_fatura:
-                    if uc_info.get('uc', uc_desejada) not in ucs_retidas:
-                        ucs_retidas.append(uc_info.get('uc', uc_desejada))
-                    continue
-
-                # Download do PDF
-                url_pdf = f"https://{base_url}.neoenergia.com/multilogin/2.0.0/servicos/faturas/{numero_fatura}/pdf"
-                
-                if id_distribuidora == 52:
-                    params_pdf = {
-                        "codigo": uc_info.get('uc', uc_desejada),
-                        "protocolo": protocolo,
-                        "tipificacao": fatura_desejada.get('tipificacao', "1031607"),
-                        "usuario": usuario_api,
-                        "canalSolicitante": canal,
-                        "distribuidora": distribuidora,
-                        "regiao": regiao,
-                        "tipoPerfil": "1",
-                        "documento": limpar_documento(login),
-                    }
+            job.status = 'executando'
+            try:
+                job.resultados = executar_scraper(job.df_filtrado, coletor=job.coletor, **job.parametros)
+                # Também devolve as UCs concluídas de um job parado
+                if job.escrita_planilha:
+                    job.escrita_planilha.enviar(job.coletor)
+                if job.coletor.parar.is_set():
+                    job.status = 'parado'
                 else:
-                    params_pdf = {
-                        "codigo": uc_info.get('uc', uc_desejada),
-                        "protocolo": protocolo,
-                        "tipificacao": fatura_desejada.get('tipificacao', "1031607"),
-                        "usuario": usuario_api,
-                        "canalSolicitante": canal,
-                        "distribuidora": distribuidora,
-                        "regiao": regiao,
-                        "tipoPerfil": "1",
-                        "documento": limpar_documento(login),
-                        "documentoSolicitante": limpar_documento(login),
-                        "documentoCliente": limpar_documento(login),
-                        "byPassActiv": "X",
-                        "motivo": "2"
-                    }
-
-                try:
-                    time.sleep(1)
-                    
-                    res_pdf = fazer_requisicao_com_retry(
-                        url_pdf, 
-                        headers=headers, 
-                        params=params_pdf, 
-                        method='GET',
-                        skip_retry_errors=ERRORS_SEM_RETRY
-                    )
-                    
-                    if not res_pdf:
-                        if uc_info.get('uc', uc_desejada) not in ucs_erro_sistema:
-                            ucs_erro_sistema.append(uc_info.get('uc', uc_desejada))
-                        if uc_info.get('uc', uc_desejada) not in ucs_erro_busca:
-                            ucs_erro_busca.append(uc_info.get('uc', uc_desejada))
-                        continue
-                    
-                    if res_pdf.status_code != 200:
-                        if "Fatura indisponível no canal digital" in res_pdf.text:
-                            if uc_info.get('uc', uc_desejada) not in ucs_fatura_indisponivel:
-                                ucs_fatura_indisponivel.append(uc_info.get('uc', uc_desejada))
-                        elif "falha ao checar relação 'documento' - 'uc'" in res_pdf.text:
-                            if uc_info.get('uc', uc_desejada) not in ucs_cadastro_invalido:
-                                ucs_cadastro_invalido.append(uc_info.get('uc', uc_desejada))
-                        else:
-                            if uc_info.get('uc', uc_desejada) not in ucs_retidas:
-                                ucs_retidas.append(uc_info.get('uc', uc_desejada))
-                        continue
-
-                    # === MODIFICAÇÃO: Salvar no st.session_state ===
-                    content_type = res_pdf.headers.get('Content-Type', '')
-                    mes_ref = mes_desejada.replace('/', '-')
-                    
-                    nome_distribuidora = distribuidora.upper()
-                    codigo_uc = uc_info.get('uc', uc_desejada)
-                    nome_arquivo = f"{nome_distribuidora}_{codigo_uc}_{mes_ref}.pdf"
-                    
-                    pdf_bytes = None
-
-                    if 'application/json' in content_type:
-                        data_json = res_pdf.json()
-                        base64_pdf = data_json.get("fileData") or data_json.get("faturaBase64")
-                        if base64_pdf:
-                            pdf_bytes = base64.b64decode(base64_pdf)
-                        else:
-                            if uc_info.get('uc', uc_desejada) not in ucs_retidas:
-                                ucs_retidas.append(uc_info.get('uc', uc_desejada))
-                    
-                    elif 'application/pdf' in content_type:
-                        pdf_bytes = res_pdf.content
-                    
-                    else:
-                        if uc_info.get('uc', uc_desejada) not in ucs_retidas:
-                            ucs_retidas.append(uc_info.get('uc', uc_desejada))
-
-                    # Se temos os bytes, salvamos na sessão
-                    if pdf_bytes:
-                        if mes_ref not in st.session_state.arquivos_baixados:
-                            st.session_state.arquivos_baixados[mes_ref] = {}
-                        st.session_state.arquivos_baixados[mes_ref][nome_arquivo] = pdf_bytes
-                        
-                        faturas_baixadas_neste_mes += 1
-                        st.success(f"✅ PDF salvo na sessão: {nome_arquivo}")
-                    # ===============================================
-                        
-                except Exception as e:
-                    st.warning(f"Erro ao baixar PDF para UC {uc_info.get('uc', uc_desejada)}: {e}")
-                    if uc_info.get('uc', uc_desejada) not in ucs_retidas:
-                        ucs_retidas.append(uc_info.get('uc', uc_desejada))
-
-            # Contabilizar sucesso
-            if faturas_baixadas_neste_mes > 0:
-                if uc_info.get('uc', uc_desejada) not in ucs_sucesso:
-                    ucs_sucesso.append(uc_info.get('uc', uc_desejada))
-
-            # Tempo da UC
-            fim_uc = time.perf_counter()
-            tempo_uc = fim_uc - inicio_uc
-            tempos_ucs.append((df_filtrado['codigo'].iloc[i], round(tempo_uc, 2)))
-            st.write(f"⏱️ Tempo desta UC: {tempo_uc:.2f} segundos")
+                    job.status = 'concluido' if job.resultados else 'erro'
+            except Exception as e:
+                job.coletor.registrar_mensagem(f"❌ Erro fatal na execução: {e}", 'error')
+                job.status = 'erro'
+            finally:
+                job.finalizado_em = datetime.now()
+
+@st.cache_resource
+def obter_gerenciador_jobs():
+    """Um único gerenciador por processo, compartilhado por todas as sessões"""
+    # O /metrics (se METRICAS_PORTA estiver definida) também é um só por processo
+    iniciar_servidor_metricas()
+    return GerenciadorJobs()
+
+def desenhar_painel(job, progress_bar, status_text, painel):
+    concluidas, total = job.progresso()
+    progress_bar.progress(concluidas / max(total, 1))
+    status_text.text(f"{STATUS_JOB[job.status]} - UC {concluidas} de {total}")
+
+    contagens, linhas, mensagens = job.painel.instantaneo()
+    with painel.container():
+        colunas = st.columns(len(CATEGORIAS_RESULTADO))
+        for coluna, categoria in zip(colunas, CATEGORIAS_RESULTADO):
+            coluna.metric(ROTULOS_DESFECHO[categoria], contagens[categoria])
+        if linhas:
+            st.dataframe(pd.DataFrame(linhas[::-1]), use_container_width=True, hide_index=True, height=300)
+        for nivel, texto in mensagens:
+            getattr(st, nivel)(texto)
+
+def acompanhar_job(job, progress_bar, status_text, painel):
+    """Redesenha o painel do job a cada INTERVALO_ATUALIZACAO_TELA ou UCS_POR_ATUALIZACAO UCs, até ele terminar.
+
+    Um rerun só interrompe a exibição; o job continua rodando no servidor.
+    """
+    estava_ativo = job.ativo
+    ucs_na_tela = -1
+    ultima_atualizacao = 0.0
+    while True:
+        ativo = job.ativo
+        ucs = job.painel.ucs_concluidas
+        if (not ativo
+                or ucs - ucs_na_tela >= UCS_POR_ATUALIZACAO
+                or time.monotonic() - ultima_atualizacao >= INTERVALO_ATUALIZACAO_TELA):
+            desenhar_painel(job, progress_bar, status_text, painel)
+            ucs_na_tela = ucs
+            ultima_atualizacao = time.monotonic()
+        if not ativo:
+            break
+        time.sleep(INTERVALO_PROGRESSO)
 
-        except Exception as e:
-            st.error(f"Erro inesperado no processamento da UC {df_filtrado['codigo'].iloc[i]}: {e}")
-            if df_filtrado['codigo'].iloc[i] not in ucs_retidas:
-                ucs_retidas.append(df_filtrado['codigo'].iloc[i])
+    # Os PDFs do job passam a aparecer na seção de downloads desta sessão
+    for mes_ref, arquivos in job.coletor.arquivos.items():
+        st.session_state.arquivos_baixados.setdefault(mes_ref, {}).update(arquivos)
 
-    # Finalizar navegador
-    if navegador:
-        navegador.quit()
-    
-    tempo_total_fim = time.perf_counter()
-    tempo_total = tempo_total_fim - tempo_total_inicio
-
-    # Relatório final
-    ucs_sucesso_set = set(ucs_sucesso)
-    ucs_retidas_set = set(ucs_retidas) - ucs_sucesso_set
-    ucs_fatura_indisponivel_set = set(ucs_fatura_indisponivel) - ucs_sucesso_set
-    ucs_erro_sistema_set = set(ucs_erro_sistema) - ucs_sucesso_set
-    ucs_erro_busca_set = set(ucs_erro_busca) - ucs_sucesso_set
-    ucs_sem_fatura_set = set(ucs_sem_fatura) - ucs_sucesso_set
-    ucs_inativas_set = set(ucs_inativas) - ucs_sucesso_set
-    ucs_ativar_cadastro_set = set(ucs_ativar_cadastro) - ucs_sucesso_set
-    ucs_cadastro_invalido_set = set(ucs_cadastro_invalido) - ucs_sucesso_set
-    
-    st.write("\n🧾 === RELATÓRIO FINAL ===")
-    st.write(f"📊 Total UCs: {len(df_filtrado)}")
-    st.write(f"✅ Sucesso: {len(ucs_sucesso_set)}")
-    st.write(f"📦 Retidas: {len(ucs_retidas_set)}")
-    st.write(f"🚫 Indisponíveis: {len(ucs_fatura_indisponivel_set)}")
-    st.write(f"🔴 Erros Sistema: {len(ucs_erro_sistema_set)}")
-    st.write(f"❌ Erros Busca: {len(ucs_erro_busca_set)}")
-    st.write(f"📭 Sem Fatura: {len(ucs_sem_fatura_set)}")
-    st.write(f"⛔ Inativas: {len(ucs_inativas_set)}")
-    st.write(f"🔐 Ativar Cadastro: {len(ucs_ativar_cadastro_set)}")
-    st.write(f"🔑 Cred. Inválidas: {len(ucs_cadastro_invalido_set)}")
-    st.write(f"\n⏲️ Tempo Total: {tempo_total:.2f} seg")
-    
-    resultados = {
-        'ucs_processadas': len(df_filtrado),
-        'ucs_sucesso': list(ucs_sucesso_set),
-        'ucs_retidas': list(ucs_retidas_set),
-        'ucs_fatura_indisponivel': list(ucs_fatura_indisponivel_set),
-        'ucs_erro_sistema': list(ucs_erro_sistema_set),
-        'ucs_erro_busca': list(ucs_erro_busca_set),
-        'ucs_sem_fatura': list(ucs_sem_fatura_set),
-        'ucs_inativas': list(ucs_inativas_set),
-        'ucs_ativar_cadastro': list(ucs_ativar_cadastro_set),
-        'ucs_cadastro_invalido': list(ucs_cadastro_invalido_set),
-        'tempo_total': tempo_total,
-        'tempos_ucs': tempos_ucs
-    }
-    
-    return resultados
+    if estava_ativo:
+        st.session_state.executando = False
+        # Força o rerender para exibir a seção de downloads atualizada
+        st.rerun()
 
 # ----------------------------
 # Função principal
@@ -985,6 +748,25 @@ def main():
     headless = st.sidebar.checkbox("Modo Headless (sem interface gráfica)", value=True)
     meses_desejados = st.sidebar.text_input("Meses desejados (separados por vírgula)", "2025/10")
     mes_atraso = st.sidebar.text_input("Mês limite para UC inativa", "2025/06")
+    max_workers = st.sidebar.number_input(
+        "Workers paralelos (logins simultâneos)",
+        min_value=1,
+        max_value=MAX_WORKERS_LIMITE,
+        value=MAX_WORKERS_PADRAO,
+        help="Cada worker abre seu próprio navegador e só faz o login para obter o token"
+    )
+    max_requisicoes = st.sidebar.number_input(
+        "Requisições simultâneas (fase HTTP)",
+        min_value=1,
+        max_value=MAX_REQUISICOES_LIMITE,
+        value=MAX_REQUISICOES_PADRAO,
+        help="Limite global de chamadas à API em andamento ao mesmo tempo, somando todas as UCs"
+    )
+    atualizar_planilha = st.sidebar.checkbox(
+        "Atualizar planilha ao final",
+        value=True,
+        help="Grava Status, Status_TEST e Historico_Faturas de cada UC no bd_ucs, em lote, quando o job terminar"
+    )
     
     # Adicionar seção de downloads na sidebar
     st.sidebar.header("📥 Downloads")
@@ -1004,13 +786,7 @@ def main():
             st.stop() # Para a execução se os dados não forem carregados
         # ====================================================
 
-        df.columns = ['uc_id', 'cliente_id_gestor', 'distribuidora_id', 'codigo', 'login',
-                      'senha_dist', 'Status', 'documento', 'Distribuidora',
-                      'Status_Mes_Anterior', 'data_geracao', 'nome', 'Geradora?',
-                      'Clientes', 'Estimativa', 'Status2', 'Historico_Faturas',
-                      'StatusContrato', 'Senha_modificada', 'Status_TEST']
-
-        df['Estimativa'] = pd.to_numeric(df['Estimativa'], errors='coerce').fillna(0).astype(int)
+        df = normalizar_planilha(df)
 
         st.subheader("🔍 Filtros de Seleção")
         
@@ -1046,47 +822,55 @@ def main():
             placeholder="Digite o código UC para começar a partir dele"
         )
 
-        # Aplicar filtros iniciais
-        df_filtrado = df.loc[
-            ((df['Distribuidora'].isin(['COELBA','COSERN','NEOENERGIA PE','ELEKTRO'])) &
-             (df['Status'].isin(['Acesso Ok','Sem fatura do mês de referencia','Retida'])) &
-             (df['Status_TEST'] == 'A baixar') &
-             (df['Estimativa'] >= estimativa_inicio) &
-             (df['Estimativa'] <= estimativa_fim) &
-             (df['Clientes'].isin(clientes_selecionados))),
-            ['distribuidora_id','codigo', 'login', 'senha_dist']
-        ].copy()
+        # Aplicar filtros iniciais, já agrupados por login (em cache entre os reruns)
+        plano = plano_extracao(df, estimativa_inicio, estimativa_fim, clientes_selecionados)
 
-        st.sidebar.info(f"📊 UCs após filtros básicos: {len(df_filtrado)}")
+        st.sidebar.info(f"📊 UCs após filtros básicos: {len(plano)}")
 
-        # Aplicar filtro por código UC se especificado
+        # Aplicar filtro por código UC se especificado (a partir dele, na ordem de processamento)
         if codigo_uc_inicio and codigo_uc_inicio.strip():
             codigo_uc_inicio = codigo_uc_inicio.strip()
-            try:
-                df_filtrado_reset = df_filtrado.reset_index(drop=True)
-                indices = df_filtrado_reset.index[df_filtrado_reset['codigo'] == codigo_uc_inicio].tolist()
-                
-                if indices:
-                    start_index = indices[0]
-                    df_filtrado = df_filtrado_reset.iloc[start_index:].copy()
-                    st.sidebar.success(f"✅ Busca iniciará a partir da UC: {codigo_uc_inicio}")
-                else:
-                    st.sidebar.warning(f"⚠️ UC {codigo_uc_inicio} não encontrada nos filtros atuais.")
-            except Exception as e:
-                st.sidebar.error(f"❌ Erro ao processar código UC: {e}")
-
-        # Preencher senhas vazias e ordenar
-        df_filtrado["senha_dist"] = df_filtrado["senha_dist"].fillna("")
-
-        if len(df_filtrado) > 0:
-            frequencia_login = df_filtrado['login'].value_counts()
-            df_filtrado = df_filtrado.copy()
-            df_filtrado['frequencia_login'] = df_filtrado['login'].map(frequencia_login)
-            df_filtrado = df_filtrado.sort_values(['frequencia_login', 'login'], ascending=[False, True])
-            df_filtrado = df_filtrado.drop('frequencia_login', axis=1)
-            df_filtrado = df_filtrado.reset_index(drop=True)
+            plano_inicio = plano.a_partir_de(codigo_uc_inicio)
+            if plano_inicio is not None:
+                plano = plano_inicio
+                st.sidebar.success(f"✅ Busca iniciará a partir da UC: {codigo_uc_inicio}")
+            else:
+                st.sidebar.warning(f"⚠️ UC {codigo_uc_inicio} não encontrada nos filtros atuais.")
+
+        # Retomar uma execução anterior a partir do jornal
+        st.sidebar.subheader("♻️ Retomar Execução")
+        execucao_retomada = None
+        execucoes_anteriores = JornalExecucoes().listar()
+        if execucoes_anteriores:
+            retomar = st.sidebar.checkbox(
+                "Retomar execução anterior",
+                help="Pula as UCs já concluídas na execução escolhida e refaz só as que falharam ou ficaram pendentes"
+            )
+            if retomar:
+                execucoes_por_id = {e['id']: e for e in execucoes_anteriores}
+                # Mesmo cuidado do seletor de jobs: rótulos sem contagens que mudam com o jornal,
+                # e a chave reatribuída para a escolha sobreviver a execuções novas no topo da lista
+                escolhida = st.session_state.get('execucao_retomada')
+                st.session_state.execucao_retomada = escolhida if escolhida in execucoes_por_id else execucoes_anteriores[0]['id']
+                execucao_retomada = st.sidebar.selectbox(
+                    "Execução:",
+                    options=list(execucoes_por_id),
+                    format_func=lambda execucao_id: f"#{execucao_id} - {execucoes_por_id[execucao_id]['iniciada_em']} - meses {execucoes_por_id[execucao_id]['meses']}",
+                    key='execucao_retomada'
+                )
+                execucao = execucoes_por_id[execucao_retomada]
+                st.sidebar.caption(f"{execucao['concluidas']}/{execucao['total_ucs']} UCs concluídas")
+                # As UCs "concluídas" valem para os meses daquela execução, não para os da barra lateral
+                execucao = JornalExecucoes().obter(execucao_retomada)
+                meses_desejados, mes_atraso = execucao['meses'], execucao['mes_atraso']
+                st.sidebar.info(f"📅 Retomando com os meses da execução: {meses_desejados} (limite {mes_atraso})")
+                concluidas = JornalExecucoes().ucs_concluidas(execucao_retomada)
+                plano = plano.sem_ucs(concluidas)
+                st.sidebar.success(f"✅ {len(concluidas)} UCs já concluídas serão puladas")
+        else:
+            st.sidebar.caption("Nenhuma execução registrada ainda.")
 
-        df_filtrado.columns = ['dist','codigo','login','senha_dist']
+        df_filtrado = plano.df
 
         st.subheader("📊 Dados Filtrados para Processamento")
         
@@ -1098,6 +882,7 @@ def main():
             # Não usamos 'return' aqui para permitir que a seção de downloads apareça
  
         # Botões de controle
+        gerenciador = obter_gerenciador_jobs()
         col1, col2 = st.columns(2)
         
         with col1:
@@ -1107,29 +892,67 @@ def main():
                 else:
                     st.session_state.executando = True
                     st.session_state.parar_execucao = False
-                    
-                    st.subheader("📈 Progresso da Extração")
-                    progress_bar = st.progress(0)
-                    status_text = st.empty()
-                    
-                    with st.spinner("🔄 Executando extração de faturas..."):
-                        resultados = executar_scraper(df_filtrado, progress_bar, status_text, meses_desejados, mes_atraso, headless)
-                    
-                    if resultados:
-                        progress_bar.progress(1.0)
-                        status_text.text("✅ Extração concluída!")
-                        st.session_state.executando = False
-                        # Força o rerender para exibir a seção de downloads atualizada
-                        st.rerun() 
+
+                    escrita_planilha = None
+                    gc = autorizar_google() if atualizar_planilha else None
+                    if gc:
+                        escrita_planilha = ObservadorPlanilha(gc, sheet_key, sheet_name)
+
+                    # A extração roda em segundo plano no servidor; esta sessão só acompanha
+                    job = gerenciador.submeter(
+                        df_filtrado,
+                        escrita_planilha=escrita_planilha,
+                        meses_desejados=meses_desejados,
+                        mes_atraso=mes_atraso,
+                        headless=headless,
+                        max_workers=max_workers,
+                        max_requisicoes=max_requisicoes,
+                        execucao_id=execucao_retomada
+                    )
+                    st.session_state.job_id = job.id
+                    st.session_state.job_acompanhado = job.id
+                    st.success(f"🚀 Job #{job.id} enviado para a fila")
 
         with col2:
             if st.button("⏹️ Parar Execução", type="secondary", use_container_width=True):
                 parar_execucao()
                 st.warning("⏹️ Comando para parar execução enviado.")
 
+        # Acompanhamento dos jobs do servidor (qualquer sessão pode acompanhar qualquer job)
+        job = None
+        jobs = gerenciador.listar()
+        if jobs:
+            st.subheader("📈 Progresso da Extração")
+            jobs_por_id = {j.id: j for j in jobs}
+            # O valor do widget é a escolha do operador. Os rótulos não mostram status nem progresso,
+            # que mudam a cada rerun e trocariam o id do widget; reatribuir a chave mantém a escolha
+            # quando a lista de jobs muda (um job novo ou descartado também troca o id)
+            job_acompanhado = st.session_state.get('job_acompanhado')
+            st.session_state.job_acompanhado = job_acompanhado if job_acompanhado in jobs_por_id else jobs[0].id
+            job = jobs_por_id[st.selectbox(
+                "Job acompanhado:",
+                options=list(jobs_por_id),
+                format_func=lambda job_id: f"#{job_id} - criado em {jobs_por_id[job_id].criado_em:%d/%m %H:%M}",
+                key='job_acompanhado'
+            )]
+            st.session_state.job_id = job.id
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+            painel = st.empty()
+            if not job.ativo and len(job.coletor.tabela):
+                st.download_button(
+                    "📄 Baixar resultados por UC (CSV)",
+                    job.coletor.tabela.para_dataframe().to_csv(index=False).encode('utf-8'),
+                    file_name=f"resultados_job_{job.id}.csv",
+                    mime='text/csv'
+                )
+
         # Exibir seção de downloads
         exibir_secao_downloads()
 
+        if job:
+            acompanhar_job(job, progress_bar, status_text, painel)
+
     except Exception as e:
         st.error(f"❌ Erro fatal no aplicativo: {e}")
         st.exception(e) # Mostra o traceback completo para debug
@@ -0,0 +1,450 @@
+"""Benchmark do motor de extração contra uma API Neoenergia simulada, local.
+
+Sobe um servidor aiohttp que imita a página de login e os endpoints ucs, obterProtocolo,
+faturas e /pdf (com latência, taxa de erro e formato do PDF configuráveis), roda o
+executar_scraper sobre conjuntos sintéticos de UCs e escreve uma linha JSON por tamanho
+com UCs/min, p50/p95 de cada etapa e o pico de RSS. Exemplo:
+
+    python benchmark.py --tamanhos 10,1000,10000 --latencia 0.05 --erros 0.02 --formato json
+
+Sem --chrome o login usa o NavegadorSimulado (mesma interface do WebDriver usada pelo
+realizar_login), então o benchmark roda sem Chrome; com --chrome o login passa pelo
+Chrome de verdade, na página de login do servidor simulado.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import psutil
+import requests
+from aiohttp import web
+from selenium.common.exceptions import ElementNotInteractableException, NoSuchElementException
+from selenium.webdriver.common.by import By
+
+import scraper
+from cli import emitir
+
+FORMATOS_PDF = ['json', 'base64', 'pdf']
+ETAPAS = ['login', 'ucs', 'protocolo', 'faturas', 'pdf']
+INTERVALO_AMOSTRA_RSS = 0.2  # segundos entre leituras do RSS do processo e dos filhos
+
+PAGINA_LOGIN = """<!DOCTYPE html>
+<html><body>
+<button id="abrir" onclick="document.getElementById('form').style.display='block'">LOGIN</button>
+<div id="form" style="display:none">
+  <input id="userId"><input id="password" type="password">
+  <button onclick="entrar()">ENTRAR</button>
+</div>
+<p class="m-0" id="erro"></p>
+<script>
+async function entrar() {
+  const res = await fetch('/login', {method: 'POST', headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({usuario: userId.value, senha: password.value})});
+  if (res.status !== 200) { erro.innerText = 'CPF/CNPJ ou senha inválidos'; return; }
+  const dados = await res.json();
+  localStorage.setItem('access_token', dados.access_token);
+  localStorage.setItem('tokenNeSe', JSON.stringify({se: dados.access_token}));
+}
+</script>
+</body></html>
+"""
+
+def token_simulado(validade=3600):
+    """JWT sem assinatura válida, só com o 'exp' que o CacheTokens lê"""
+    parte = lambda dados: base64.urlsafe_b64encode(json.dumps(dados).encode()).decode().rstrip('=')
+    return f"{parte({'alg': 'none'})}.{parte({'exp': time.time() + validade})}.x"
+
+def pdf_simulado(numero_fatura, tamanho):
+    return b'%PDF-1.4\n' + numero_fatura.encode() + b'\n' + os.urandom(max(tamanho - 32, 0)) + b'\n%%EOF'
+
+# ----------------------------
+# Servidor simulado da API
+# ----------------------------
+class ServidorSimulado:
+    """API Neoenergia de mentira num event loop próprio; a URL base faz o papel dos hosts apineprd/apiseprd"""
+
+    def __init__(self, latencia=0.05, latencia_login=0.2, taxa_erro=0.0, formato='json', tamanho_pdf=20000, meses=('2025/10',)):
+        self.latencia = latencia
+        self.latencia_login = latencia_login
+        self.taxa_erro = taxa_erro
+        self.formato = formato
+        self.tamanho_pdf = tamanho_pdf
+        self.meses = list(meses)
+        self.ucs_por_documento = {}
+        self.requisicoes = 0
+        self.erros = 0
+        self.url = None
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="servidor-simulado", daemon=True)
+
+    def registrar_ucs(self, df):
+        """UCs que o endpoint ucs devolve para cada documento (login sem pontuação)"""
+        self.ucs_por_documento = {}
+        for login, codigo in zip(df['login'], df['codigo']):
+            self.ucs_por_documento.setdefault(scraper.limpar_documento(login), []).append(codigo.zfill(12))
+
+    def iniciar(self):
+        self._thread.start()
+        self.url = asyncio.run_coroutine_threadsafe(self._iniciar(), self.loop).result()
+        return self.url
+
+    async def _iniciar(self):
+        app = web.Application()
+        app.router.add_get('/', self.pagina_login)
+        app.router.add_post('/login', self.login)
+        app.router.add_get('/{base}/imoveis/1.1.0/clientes/{documento}/ucs', self.ucs)
+        app.router.add_get('/{base}/protocolo/1.1.0/obterProtocolo', self.protocolo)
+        app.router.add_get('/{base}/multilogin/2.0.0/servicos/faturas/ucs/faturas', self.faturas)
+        app.router.add_get('/{base}/multilogin/2.0.0/servicos/faturas/{numero}/pdf', self.pdf)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        porta = self._runner.addresses[0][1]
+        return f"http://127.0.0.1:{porta}"
+
+    def encerrar(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    async def _atender(self, request, latencia=None, falhar=True):
+        """Espera a latência sorteada e decide se a chamada falha (429/500); retorna a resposta de erro ou None"""
+        self.requisicoes += 1
+        latencia = self.latencia if latencia is None else latencia
+        await asyncio.sleep(latencia * random.uniform(0.5, 1.5))
+        if request.path != '/login' and not request.headers.get('Authorization', '').startswith('Bearer '):
+            return web.json_response({'mensagem': 'acesso negado'}, status=401)
+        if falhar and random.random() < self.taxa_erro:
+            self.erros += 1
+            return web.json_response({'mensagem': 'erro simulado'}, status=random.choice([429, 500]))
+        return None
+
+    async def pagina_login(self, request):
+        return web.Response(text=PAGINA_LOGIN, content_type='text/html')
+
+    async def login(self, request):
+        # O login não falha: um erro aqui viraria "credenciais inválidas" para o login inteiro
+        erro = await self._atender(request, self.latencia_login, falhar=False)
+        if erro:
+            return erro
+        return web.json_response({'access_token': token_simulado()})
+
+    async def ucs(self, request):
+        erro = await self._atender(request)
+        if erro:
+            return erro
+        codigos = self.ucs_por_documento.get(request.match_info['documento'], [])
+        return web.json_response({'listaUnidadesConsumidoras': [{'uc': codigo} for codigo in codigos]})
+
+    async def protocolo(self, request):
+        erro = await self._atender(request)
+        if erro:
+            return erro
+        protocolo = f"P{random.randrange(10 ** 9)}"
+        return web.json_response({'protocolo': protocolo, 'protocoloSalesforceStr': protocolo})
+
+    async def faturas(self, request):
+        erro = await self._atender(request)
+        if erro:
+            return erro
+        codigo = request.query.get('codigo', '')
+        return web.json_response({'faturas': [
+            {
+                'mesReferencia': mes,
+                'dataCompetencia': f"{mes.replace('/', '-')}-01",
+                'numeroFatura': f"{codigo}{mes.replace('/', '')}"
+            }
+            for mes in self.meses
+        ]})
+
+    async def pdf(self, request):
+        erro = await self._atender(request)
+        if erro:
+            return erro
+        conteudo = pdf_simulado(request.match_info['numero'], self.tamanho_pdf)
+        formato = random.choice(FORMATOS_PDF) if self.formato == 'misto' else self.formato
+        if formato == 'pdf':
+            return web.Response(body=conteudo, content_type='application/pdf')
+        chave = 'fileData' if formato == 'json' else 'faturaBase64'
+        return web.json_response({chave: base64.b64encode(conteudo).decode()})
+
+# ----------------------------
+# Navegador sem Chrome para o login no servidor simulado
+# ----------------------------
+class ElementoSimulado:
+    def __init__(self, navegador, id_elemento, text=''):
+        self.navegador = navegador
+        self.id = id_elemento
+        self.text = text
+        self.valor = ''
+
+    def is_displayed(self):
+        # Como na PAGINA_LOGIN: os campos estão no DOM, mas escondidos até o clique em LOGIN
+        return self.id not in self.navegador.campos or self.navegador.formulario_aberto
+
+    def _editar(self):
+        if not self.is_displayed():
+            raise ElementNotInteractableException(self.id)
+
+    def clear(self):
+        self._editar()
+        self.valor = ''
+
+    def send_keys(self, valor):
+        self._editar()
+        self.valor += valor
+
+    def get_attribute(self, nome):
+        return self.text if nome == 'innerHTML' else None
+
+    def click(self):
+        self.navegador.clicar(self)
+
+class NavegadorSimulado:
+    """Implementa só o pedaço do WebDriver que o realizar_login e o PoolNavegadores usam"""
+
+    def __init__(self, url_servidor):
+        self.url_servidor = url_servidor
+        self.sessao = requests.Session()
+        self.local_storage = {}
+        self.formulario_aberto = False
+        self.na_pagina = False
+        self.campos = {id_campo: ElementoSimulado(self, id_campo) for id_campo in ('userId', 'password')}
+        self.erro = None
+
+    def get(self, url):
+        self.na_pagina = url.startswith(self.url_servidor)
+        self.formulario_aberto = False
+        self.erro = None
+
+    def find_elements(self, by, valor):
+        if not self.na_pagina:
+            return []
+        if by == By.TAG_NAME and valor == 'button':
+            botao = 'ENTRAR' if self.formulario_aberto else 'LOGIN'
+            return [ElementoSimulado(self, botao.lower(), botao)]
+        if by == By.ID and valor in self.campos:
+            return [self.campos[valor]]
+        if by == By.CLASS_NAME and valor == 'm-0' and self.erro:
+            return [ElementoSimulado(self, 'erro', self.erro)]
+        return []
+
+    def find_element(self, by, valor):
+        elementos = self.find_elements(by, valor)
+        if not elementos:
+            raise NoSuchElementException(valor)
+        return elementos[0]
+
+    def execute_script(self, script, *args):
+        if script == "return 1":
+            return 1
+        if script.startswith("arguments[0].click()"):
+            args[0].click()
+        elif 'localStorage.clear()' in script:
+            self.local_storage.clear()
+        elif 'localStorage.getItem' in script:
+            chaves = [trecho.split("')")[0] for trecho in script.split("getItem('")[1:]]
+            return next((self.local_storage[chave] for chave in chaves if self.local_storage.get(chave)), None)
+        return None
+
+    def clicar(self, elemento):
+        if elemento.id == 'login':
+            self.formulario_aberto = True
+        elif elemento.id == 'entrar':
+            res = self.sessao.post(
+                f"{self.url_servidor}/login",
+                json={'usuario': self.campos['userId'].valor, 'senha': self.campos['password'].valor}
+            )
+            if res.status_code != 200:
+                self.erro = 'CPF/CNPJ ou senha inválidos'
+                return
+            token = res.json()['access_token']
+            self.local_storage['access_token'] = token
+            self.local_storage['tokenNeSe'] = json.dumps({'se': token})
+
+    def delete_all_cookies(self):
+        self.sessao.cookies.clear()
+
+    def quit(self):
+        self.sessao.close()
+
+# ----------------------------
+# Medição
+# ----------------------------
+class Medicoes:
+    """Duração de cada chamada por etapa (login e endpoints da API) e pico de RSS do processo + filhos"""
+
+    def __init__(self):
+        self.duracoes = {etapa: [] for etapa in ETAPAS}
+        self.pico_rss = 0
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._amostrador = None
+
+    def registrar(self, etapa, duracao):
+        with self._lock:
+            self.duracoes[etapa].append(duracao)
+
+    def iniciar(self):
+        self._amostrador = threading.Thread(target=self._amostrar_rss, name="amostrador-rss", daemon=True)
+        self._amostrador.start()
+
+    def finalizar(self):
+        self._parar.set()
+        self._amostrador.join()
+
+    def _amostrar_rss(self):
+        processo = psutil.Process()
+        while True:
+            try:
+                rss = sum(p.memory_info().rss for p in [processo, *processo.children(recursive=True)])
+            except psutil.Error:
+                rss = 0
+            self.pico_rss = max(self.pico_rss, rss)
+            if self._parar.wait(INTERVALO_AMOSTRA_RSS):
+                return
+
+    def resumo(self):
+        with self._lock:
+            return {
+                etapa: {'chamadas': len(valores), 'p50_ms': percentil(valores, 50), 'p95_ms': percentil(valores, 95)}
+                for etapa, valores in self.duracoes.items()
+            }
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))] * 1000, 1)
+
+def instrumentar(medicoes):
+    """Cronometra o realizar_login e cada chamada à API (com retries) sem mudar o motor"""
+    requisicao_original = scraper.fazer_requisicao_com_retry_async
+    login_original = scraper.realizar_login
+
+    async def requisicao_cronometrada(motor_http, url, *args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await requisicao_original(motor_http, url, *args, **kwargs)
+        finally:
+            medicoes.registrar(scraper.etapa_da_url(url), time.perf_counter() - inicio)
+
+    def login_cronometrado(navegador, login, senha):
+        inicio = time.perf_counter()
+        try:
+            return login_original(navegador, login, senha)
+        finally:
+            medicoes.registrar('login', time.perf_counter() - inicio)
+
+    scraper.fazer_requisicao_com_retry_async = requisicao_cronometrada
+    scraper.realizar_login = login_cronometrado
+
+    def restaurar():
+        scraper.fazer_requisicao_com_retry_async = requisicao_original
+        scraper.realizar_login = login_original
+    return restaurar
+
+# ----------------------------
+# Execução
+# ----------------------------
+def ucs_sinteticas(quantidade, ucs_por_login):
+    """UCs espalhadas pelas distribuidoras, `ucs_por_login` por login, já na ordem do motor"""
+    distribuidoras = list(scraper.DISTRIBUIDORAS)
+    df = pd.DataFrame({
+        'distribuidora_id': [str(distribuidoras[(i // ucs_por_login) % len(distribuidoras)]) for i in range(quantidade)],
+        'codigo': [str(7000000000 + i) for i in range(quantidade)],
+        'login': [f"{10000000000 + i // ucs_por_login:011d}" for i in range(quantidade)],
+        'senha_dist': ['senha'] * quantidade
+    })
+    return scraper.ordenar_por_login(df)
+
+def medir(servidor, args, quantidade):
+    df = ucs_sinteticas(quantidade, args.ucs_por_login)
+    servidor.registrar_ucs(df)
+    requisicoes_antes, erros_antes = servidor.requisicoes, servidor.erros
+
+    medicoes = Medicoes()
+    restaurar = instrumentar(medicoes)
+    coletor = scraper.ColetorResultados(len(df))
+    # Diretório novo por tamanho: o armazém não pode reaproveitar PDFs da rodada anterior
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as diretorio_dados:
+        medicoes.iniciar()
+        inicio = time.perf_counter()
+        try:
+            resultados = scraper.executar_scraper(
+                df, ','.join(args.meses), args.mes_atraso, True, args.workers, args.requisicoes,
+                coletor=coletor, diretorio_dados=diretorio_dados
+            )
+        finally:
+            duracao = time.perf_counter() - inicio
+            medicoes.finalizar()
+            restaurar()
+
+    return {
+        'ucs': quantidade,
+        'logins': df['login'].nunique(),
+        'duracao_s': round(duracao, 2),
+        'ucs_por_min': round(coletor.ucs_concluidas / duracao * 60, 1),
+        'sucesso': len(resultados['ucs_sucesso']) if resultados else 0,
+        # Uma UC pode cair em mais de uma categoria (ex.: erro_sistema e erro_busca): conta cada UC uma vez
+        'falhas': len(set().union(*(resultados[categoria] for categoria in scraper.CATEGORIAS_FALHA))) if resultados else None,
+        'requisicoes_servidor': servidor.requisicoes - requisicoes_antes,
+        'respostas_erro_simuladas': servidor.erros - erros_antes,
+        'pico_rss_mb': round(medicoes.pico_rss / 2 ** 20, 1),
+        'etapas': medicoes.resumo(),
+        'conexoes': resultados['conexoes'] if resultados else None
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark do motor contra uma API Neoenergia simulada")
+    parser.add_argument('--tamanhos', default='10,1000,10000', help="quantidades de UCs, separadas por vírgula")
+    parser.add_argument('--ucs-por-login', type=int, default=5)
+    parser.add_argument('--meses', default='2025/10', help="meses pedidos (e devolvidos pelo servidor), separados por vírgula")
+    parser.add_argument('--mes-atraso', default='2025/06')
+    parser.add_argument('--workers', type=int, default=scraper.MAX_WORKERS_PADRAO)
+    parser.add_argument('--requisicoes', type=int, default=scraper.MAX_REQUISICOES_PADRAO)
+    parser.add_argument('--taxa-maxima', type=float, help="sobrescreve LIMITE_TAXA_MAXIMA (req/s por host/distribuidora)")
+    parser.add_argument('--latencia', type=float, default=0.05, help="latência média dos endpoints da API, em segundos")
+    parser.add_argument('--latencia-login', type=float, default=0.2, help="latência média do POST de login, em segundos")
+    parser.add_argument('--erros', type=float, default=0.0, help="fração das chamadas que responde 429/500")
+    parser.add_argument('--formato', choices=FORMATOS_PDF + ['misto'], default='json', help="formato da resposta do /pdf")
+    parser.add_argument('--tamanho-pdf', type=int, default=20000, help="bytes de cada PDF")
+    parser.add_argument('--chrome', action='store_true', help="faz o login no Chrome, na página do servidor simulado")
+    parser.add_argument('--saida', help="também grava os resultados neste arquivo JSON")
+    args = parser.parse_args(argv)
+    args.meses = [mes.strip() for mes in args.meses.split(',')]
+
+    servidor = ServidorSimulado(args.latencia, args.latencia_login, args.erros, args.formato, args.tamanho_pdf, args.meses)
+    url_servidor = servidor.iniciar()
+    scraper.URL_API = url_servidor + "/{base_url}"
+    scraper.URL_LOGIN = url_servidor + "/"
+    if not args.chrome:
+        scraper.iniciar_navegador = lambda headless=True: NavegadorSimulado(url_servidor)
+    if args.taxa_maxima:
+        scraper.LIMITE_TAXA_MAXIMA = args.taxa_maxima
+
+    emitir('benchmark', servidor=url_servidor, **{k: v for k, v in vars(args).items() if k != 'saida'})
+    medidas = []
+    try:
+        for quantidade in [int(tamanho) for tamanho in args.tamanhos.split(',')]:
+            medidas.append(medir(servidor, args, quantidade))
+            emitir('medida', **medidas[-1])
+    finally:
+        servidor.encerrar()
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'parametros': vars(args), 'medidas': medidas}, arquivo, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
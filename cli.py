@@ -0,0 +1,303 @@
+"""Extração de faturas em lote, sem Streamlit.
+
+Lê um snapshot CSV da planilha (todas as colunas da aba bd_ucs, ou só dist,codigo,login,senha_dist),
+roda o mesmo motor do app e escreve o progresso como linhas JSON no stdout. Exemplo:
+
+    python cli.py bd_ucs.csv --meses 2025/10 --mes-atraso 2025/06 --workers 4 --saida /dados/faturas
+
+Para dividir uma execução entre vários containers, enfileire uma vez e suba um nó por container,
+todos com o mesmo --saida (volume compartilhado, com locks de arquivo; os SQLite de lá não usam WAL):
+
+    python cli.py bd_ucs.csv --meses 2025/10 --mes-atraso 2025/06 --saida /compartilhado --enfileirar
+    python cli.py --lote 7 --workers 4 --saida /compartilhado
+
+Com --metricas-porta 9100 o processo serve /metrics (Prometheus) e /metrics.json com os
+histogramas de cada etapa; --metricas-json grava o mesmo dump num arquivo periodicamente.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from scraper import (
+    MAX_WORKERS_PADRAO,
+    MAX_REQUISICOES_PADRAO,
+    INTERVALO_PROGRESSO,
+    DIRETORIO_DADOS,
+    PORTA_METRICAS,
+    METRICAS,
+    iniciar_servidor_metricas,
+    ObservadorExecucao,
+    ColetorResultados,
+    JornalExecucoes,
+    FilaShards,
+    identificador_no,
+    executar_shards,
+    normalizar_planilha,
+    filtrar_ucs,
+    ordenar_por_login,
+    executar_scraper
+)
+
+COLUNAS_MOTOR = ['dist', 'codigo', 'login', 'senha_dist']
+
+# Nível de log correspondente a cada tipo de mensagem do motor
+NIVEIS_LOG = {'write': 'info', 'info': 'info', 'success': 'info', 'warning': 'warning', 'error': 'error'}
+
+_lock_saida = threading.Lock()
+
+def emitir(evento, **campos):
+    linha = {'ts': datetime.now().isoformat(timespec='seconds'), 'evento': evento, **campos}
+    with _lock_saida:
+        print(json.dumps(linha, ensure_ascii=False, default=str), flush=True)
+
+class ObservadorLinhasJSON(ObservadorExecucao):
+    """Escreve cada evento do motor como uma linha JSON, com o progresso a cada `intervalo` segundos"""
+
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self.concluidas = 0
+        self.total = 0
+        self._ultimo_progresso = time.monotonic()
+        self._lock = threading.Lock()
+
+    def execucao_iniciada(self, execucao_id, total):
+        self.total = total
+        emitir('execucao', execucao_id=execucao_id, total=total)
+
+    def uc_concluida(self, registro):
+        emitir(
+            'uc',
+            numero=registro.numero,
+            uc=registro.uc,
+            login=registro.login,
+            desfecho=registro.desfecho,
+            categorias=sorted(registro.categorias),
+            meses_baixados=registro.meses_baixados,
+            meses_reaproveitados=registro.meses_reaproveitados,
+            meses_nao_encontrados=registro.meses_nao_encontrados,
+            tempo=registro.tempo
+        )
+        with self._lock:
+            self.concluidas += 1
+            if time.monotonic() - self._ultimo_progresso < self.intervalo:
+                return
+            self._ultimo_progresso = time.monotonic()
+            concluidas = self.concluidas
+        emitir('progresso', concluidas=concluidas, total=self.total)
+
+    def mensagem(self, nivel, texto):
+        emitir('mensagem', nivel=NIVEIS_LOG.get(nivel, 'info'), texto=texto.strip())
+
+def carregar_ucs(args):
+    """Lê o snapshot e aplica os mesmos filtros e a mesma ordenação da interface"""
+    df = pd.read_csv(args.entrada, dtype=str, keep_default_na=False)
+
+    if set(COLUNAS_MOTOR) <= set(df.columns):
+        df_filtrado = df[COLUNAS_MOTOR].copy()
+    else:
+        df = normalizar_planilha(df)
+        estimativa_inicio = args.estimativa_min if args.estimativa_min is not None else int(df['Estimativa'].min())
+        estimativa_fim = args.estimativa_max if args.estimativa_max is not None else int(df['Estimativa'].max())
+        clientes = args.cliente or df['Clientes'].unique().tolist()
+        df_filtrado = filtrar_ucs(df, estimativa_inicio, estimativa_fim, clientes)
+
+    if args.retomar is not None:
+        concluidas = JornalExecucoes(os.path.join(args.saida, 'execucoes.db')).ucs_concluidas(args.retomar)
+        df_filtrado = df_filtrado[~df_filtrado['codigo'].isin(concluidas)]
+
+    return ordenar_por_login(df_filtrado)
+
+def lista_meses(meses):
+    return [mes.strip() for mes in meses.split(",")]
+
+def copiar_faturas(arquivos, diretorio):
+    """Copia os PDFs do armazém para <diretorio>/<mês>/<nome do arquivo>"""
+    copiados = 0
+    for mes_ref, arquivos_mes in arquivos.items():
+        os.makedirs(os.path.join(diretorio, mes_ref), exist_ok=True)
+        for nome_arquivo, metadados in arquivos_mes.items():
+            destino = os.path.join(diretorio, mes_ref, nome_arquivo)
+            if not os.path.exists(destino) or os.path.getsize(destino) != metadados['tamanho']:
+                shutil.copyfile(metadados['caminho'], destino)
+            copiados += 1
+    return copiados
+
+def gravar_metricas(caminho):
+    """Dump JSON das métricas do processo, trocado atomicamente para quem estiver lendo o arquivo"""
+    temporario = f"{caminho}.tmp"
+    with open(temporario, 'w', encoding='utf-8') as arquivo:
+        json.dump({'ts': datetime.now().isoformat(timespec='seconds'), **METRICAS.instantaneo()}, arquivo, ensure_ascii=False)
+    os.replace(temporario, caminho)
+
+def despejar_metricas(caminho, intervalo, parar):
+    while not parar.wait(intervalo):
+        gravar_metricas(caminho)
+
+def aguardar(execucao, parar):
+    while execucao.is_alive():
+        try:
+            execucao.join(INTERVALO_PROGRESSO)
+        except KeyboardInterrupt:
+            # Ctrl+C: termina as UCs em andamento e não começa outras
+            parar.set()
+            emitir('parada_solicitada')
+
+def executar_local(args):
+    df_filtrado = carregar_ucs(args)
+    emitir('inicio', ucs=len(df_filtrado), meses=args.meses, workers=args.workers, requisicoes=args.requisicoes)
+    if df_filtrado.empty:
+        emitir('fim', resultado='sem_ucs')
+        return 0
+
+    coletor = ColetorResultados(len(df_filtrado), observadores=[ObservadorLinhasJSON(args.intervalo)])
+    saida = []
+    execucao = threading.Thread(
+        target=lambda: saida.append(executar_scraper(
+            df_filtrado, args.meses, args.mes_atraso, not args.com_janela, args.workers, args.requisicoes,
+            args.retomar, coletor, args.saida
+        )),
+        name="execucao",
+        daemon=True
+    )
+    execucao.start()
+    aguardar(execucao, coletor.parar)
+
+    resultados = saida[0] if saida else None
+    if not resultados:
+        emitir('fim', resultado='erro')
+        return 1
+
+    caminho_resultados = os.path.join(args.saida, f"resultados_execucao_{resultados['execucao_id']}.json")
+    with open(caminho_resultados, 'w', encoding='utf-8') as arquivo:
+        json.dump(resultados, arquivo, ensure_ascii=False, indent=2)
+    copiados = copiar_faturas(coletor.arquivos, os.path.join(args.saida, 'faturas'))
+    # A tabela é um extra: uma falha ao gravá-la não pode esconder o resultado da execução
+    try:
+        caminho_tabela = coletor.tabela.exportar(os.path.join(args.saida, f"ucs_execucao_{resultados['execucao_id']}.{args.formato_tabela}"))
+    except Exception as e:
+        emitir('mensagem', nivel='warning', texto=f"tabela não gravada: {e}")
+        caminho_tabela = None
+
+    emitir(
+        'fim',
+        resultado='parado' if coletor.parar.is_set() else 'concluido',
+        execucao_id=resultados['execucao_id'],
+        pdfs=copiados,
+        resultados=caminho_resultados,
+        tabela=caminho_tabela,
+        **{categoria: len(resultados[categoria]) for categoria in resultados if categoria.startswith('ucs_') and categoria != 'ucs_processadas'},
+        tempo_total=round(resultados['tempo_total'], 2)
+    )
+    return 0
+
+def enfileirar(args):
+    """Registra a execução no jornal e cria um shard por login para os nós processarem"""
+    df_filtrado = carregar_ucs(args)
+    caminho_jornal = os.path.join(args.saida, 'execucoes.db')
+    execucao_id = JornalExecucoes(caminho_jornal).iniciar(args.meses, args.mes_atraso, len(df_filtrado))
+    shards = FilaShards(caminho_jornal).criar(execucao_id, df_filtrado)
+    emitir('lote', execucao_id=execucao_id, ucs=len(df_filtrado), shards=shards)
+    return 0
+
+def executar_no(args):
+    """Processa shards da execução `--lote` até a fila esvaziar; vários nós podem rodar ao mesmo tempo"""
+    caminho_jornal = os.path.join(args.saida, 'execucoes.db')
+    parar = threading.Event()
+    pdfs = []
+
+    def ao_finalizar_rodada(coletor, resultados):
+        pdfs.append(copiar_faturas(coletor.arquivos, os.path.join(args.saida, 'faturas')))
+        emitir('rodada', ucs=resultados['ucs_processadas'], pdfs=pdfs[-1], tempo_total=round(resultados['tempo_total'], 2))
+
+    emitir('no', no=identificador_no(), execucao_id=args.lote, workers=args.workers, requisicoes=args.requisicoes)
+    saida = []
+    execucao = threading.Thread(
+        target=lambda: saida.append(executar_shards(
+            args.lote, not args.com_janela, args.workers, args.requisicoes, args.saida,
+            args.shards_por_rodada, [ObservadorLinhasJSON(args.intervalo)], parar, ao_finalizar_rodada
+        )),
+        name="execucao",
+        daemon=True
+    )
+    execucao.start()
+    aguardar(execucao, parar)
+
+    if not (saida and saida[0]):
+        emitir('fim', resultado='erro')
+        return 1
+
+    emitir(
+        'fim',
+        resultado='parado' if parar.is_set() else 'concluido',
+        execucao_id=args.lote,
+        pdfs=sum(pdfs),
+        shards=FilaShards(caminho_jornal).situacao(args.lote),
+        **JornalExecucoes(caminho_jornal).resumo(args.lote)
+    )
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extração de faturas Neoenergia em lote (sem Streamlit)")
+    parser.add_argument('entrada', nargs='?', help="CSV exportado da planilha de UCs")
+    parser.add_argument('--meses', help="meses desejados separados por vírgula, ex.: 2025/10,2025/09")
+    parser.add_argument('--mes-atraso', help="mês limite para UC inativa, ex.: 2025/06")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS_PADRAO, help="logins simultâneos (um navegador por worker)")
+    parser.add_argument('--requisicoes', type=int, default=MAX_REQUISICOES_PADRAO, help="requisições simultâneas na fase HTTP")
+    parser.add_argument('--saida', default=DIRETORIO_DADOS, help="diretório dos PDFs, do jornal e dos resultados")
+    parser.add_argument('--com-janela', action='store_true', help="abre o navegador com interface gráfica")
+    parser.add_argument('--retomar', type=int, metavar='EXECUCAO', help="retoma a execução do jornal, pulando as UCs concluídas (com os meses dela)")
+    parser.add_argument('--estimativa-min', type=int)
+    parser.add_argument('--estimativa-max', type=int)
+    parser.add_argument('--cliente', action='append', help="filtra por cliente (pode repetir)")
+    parser.add_argument('--formato-tabela', choices=['csv', 'parquet'], default='csv', help="formato da tabela com o desfecho de cada UC (parquet precisa do pyarrow)")
+    parser.add_argument('--intervalo', type=float, default=5.0, help="segundos entre linhas de progresso")
+
+    parser.add_argument('--metricas-porta', type=int, default=PORTA_METRICAS, help="serve /metrics (Prometheus) e /metrics.json nesta porta")
+    parser.add_argument('--metricas-json', metavar='ARQUIVO', help="grava as métricas por etapa neste arquivo a cada --intervalo segundos")
+
+    distribuida = parser.add_argument_group("execução em vários nós (--saida num volume compartilhado)")
+    distribuida.add_argument('--enfileirar', action='store_true', help="só cria a execução e os shards (um por login) e sai")
+    distribuida.add_argument('--lote', type=int, metavar='EXECUCAO', help="roda como nó, processando os shards desta execução")
+    distribuida.add_argument('--shards-por-rodada', type=int, help="logins reservados por vez (padrão: 2 por worker)")
+    args = parser.parse_args(argv)
+
+    if args.formato_tabela == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        parser.error("--formato-tabela parquet precisa do pyarrow (pip install pyarrow)")
+
+    if args.retomar is not None:
+        # Os meses vêm do jornal: as UCs concluídas só valem para os meses daquela execução
+        execucao = JornalExecucoes(os.path.join(args.saida, 'execucoes.db')).obter(args.retomar)
+        if execucao is None:
+            parser.error(f"execução {args.retomar} não encontrada no jornal de {args.saida}")
+        if args.meses and lista_meses(args.meses) != lista_meses(execucao['meses']):
+            parser.error(f"--meses difere dos meses da execução {args.retomar} ({execucao['meses']})")
+        if args.mes_atraso and args.mes_atraso.strip() != execucao['mes_atraso'].strip():
+            parser.error(f"--mes-atraso difere do da execução {args.retomar} ({execucao['mes_atraso']})")
+        args.meses, args.mes_atraso = execucao['meses'], execucao['mes_atraso']
+
+    if args.lote is None and not (args.entrada and args.meses and args.mes_atraso):
+        parser.error("informe a entrada, --meses e --mes-atraso (ou --lote para rodar como nó)")
+    if args.enfileirar and args.lote is None:
+        return enfileirar(args)
+
+    iniciar_servidor_metricas(args.metricas_porta)
+    fim = threading.Event()
+    if args.metricas_json:
+        threading.Thread(target=despejar_metricas, args=(args.metricas_json, args.intervalo, fim), name="metricas-json", daemon=True).start()
+    try:
+        return executar_no(args) if args.lote is not None else executar_local(args)
+    finally:
+        fim.set()
+        if args.metricas_json:
+            gravar_metricas(args.metricas_json)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2459 @@
+"""Motor de extração das faturas: login no portal, fase HTTP e armazenamento dos PDFs.
+
+Não depende do Streamlit; é usado pela interface (app.py) e pelo modo em lote (cli.py).
+"""
+import pandas as pd
+import os
+import time
+import base64
+import json
+import re
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from datetime import datetime
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from urllib.parse import urlencode, urlparse
+import hashlib
+import binascii
+import tempfile
+import sqlite3
+from contextlib import contextmanager
+import queue
+import threading
+import atexit
+import psutil
+import socket
+import bisect
+import math
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import aiohttp
+
+# === CONFIGURAÇÃO DE RETRY === 
+MAX_RETRIES = 3
+MAX_DELAY = 30  # maior intervalo entre chamadas quando a API está sobrecarregada
+STATUS_SOBRECARGA = (429, 500, 502, 503, 504)
+
+# === LIMITADOR DE TAXA (por host/distribuidora) ===
+LIMITE_TAXA_INICIAL = 2.0  # requisições por segundo
+LIMITE_TAXA_MAXIMA = 20.0
+LIMITE_TAXA_MINIMA = 1 / MAX_DELAY
+LIMITE_INCREMENTO = 0.5  # aumento aditivo a cada resposta 200
+LIMITE_FATOR_REDUCAO = 0.5  # redução multiplicativa em 429/5xx/timeout
+LIMITE_REAVALIACAO = 1.0  # segundos máximos de sono antes de recalcular a espera com a taxa atual
+
+# === CONFIGURAÇÃO DE PARALELISMO ===
+MAX_WORKERS_PADRAO = 3  # logins processados simultaneamente (1 navegador por worker)
+MAX_WORKERS_LIMITE = 10
+MAX_REQUISICOES_PADRAO = 64  # requisições simultâneas na fase HTTP (semáforo global)
+MAX_REQUISICOES_LIMITE = 500
+MAX_MESES_SIMULTANEOS = 3  # PDFs de uma mesma UC baixados ao mesmo tempo (também contam no semáforo global)
+TIMEOUT_REQUISICAO = 90  # segundos
+TAMANHO_PEDACO_DOWNLOAD = 64 * 1024  # bytes lidos por vez do corpo do /pdf (buffer fixo por download em voo)
+POOL_CONEXOES_POR_HOST = 100  # conexões keep-alive mantidas por host regional da API
+KEEPALIVE_TIMEOUT = 60  # segundos que uma conexão ociosa fica aberta para reuso
+INTERVALO_PROGRESSO = 0.5  # segundos entre atualizações da barra de progresso
+
+# === ARMAZENAMENTO LOCAL ===
+DIRETORIO_DADOS = os.environ.get('FATURAS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dados'))
+DIRETORIO_PDFS = os.path.join(DIRETORIO_DADOS, 'pdfs')
+DIRETORIO_EXPORTACOES = os.path.join(DIRETORIO_DADOS, 'exportacoes')
+CAMINHO_JORNAL = os.path.join(DIRETORIO_DADOS, 'execucoes.db')
+CAMINHO_PLANILHAS = os.path.join(DIRETORIO_DADOS, 'planilhas.db')
+
+# === DISTRIBUIDORAS ===
+DISTRIBUIDORAS = {
+    11: {'nome': 'COELBA', 'canal': 'AGC', 'regiao': 'NE', 'usuario_api': 'WSO2_CONEXAO', 'base_url': 'apineprd'},
+    42: {'nome': 'COSERN', 'canal': 'AGR', 'regiao': 'NE', 'usuario_api': 'WSO2_CONEXAO', 'base_url': 'apineprd'},
+    43: {'nome': 'CELP',   'canal': 'AGP', 'regiao': 'NE', 'usuario_api': 'WSO2_CONEXAO', 'base_url': 'apineprd'},
+    52: {'nome': 'ELEKTRO', 'canal': 'AGE', 'regiao': 'SE', 'usuario_api': 'AGENEOELK', 'base_url': 'apiseprd'}
+}
+
+# === ENDEREÇOS DO PORTAL E DA API (o benchmark aponta para um servidor simulado) ===
+URL_API = os.environ.get('NEOENERGIA_URL_API', "https://{base_url}.neoenergia.com")
+
+# === LOGIN NO PORTAL ===
+URL_LOGIN = os.environ.get('NEOENERGIA_URL_LOGIN', "https://agenciavirtual.neoenergia.com/#/login")
+TIMEOUT_LOGIN = 45  # prazo máximo (segundos) para todo o login de um usuário
+INTERVALO_VERIFICACAO_LOGIN = 0.25  # segundos entre verificações das condições de espera
+
+# === POOL DE NAVEGADORES ===
+MAX_USOS_NAVEGADOR = 50  # logins por navegador antes de reciclá-lo
+LIMITE_RSS_NAVEGADOR_MB = 800  # recicla o navegador (Chrome + renderers) acima disso
+LIMITE_RSS_POOL_MB = 4000  # só abre navegadores novos enquanto o pool inteiro couber nisso
+TIMEOUT_CHECKOUT_NAVEGADOR = 120  # segundos esperando um navegador livre
+TEMPO_OCIOSO_NAVEGADOR = 300  # segundos parado no pool antes de o navegador ser fechado
+
+# === CONFIGURAÇÃO DE TOKENS ===
+TOKEN_TTL_PADRAO = 30 * 60  # validade assumida quando o token não informa 'exp'
+TOKEN_MARGEM_EXPIRACAO = 60  # segundos de folga antes de considerar o token expirado
+MAX_RODADAS_TOKEN = 2  # rodadas de login para UCs cujo token expirou na fila
+REUTILIZAR_PROTOCOLO = True  # um protocolo por login (cai para um por UC se o /faturas ou o /pdf recusar)
+
+# === MÉTRICAS POR ETAPA ===
+BUCKETS_METRICAS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # limites (segundos) dos histogramas
+PORTA_METRICAS = int(os.environ.get('METRICAS_PORTA', 0))  # 0 = sem endpoint /metrics
+
+# === EXECUÇÃO EM VÁRIOS NÓS (fila de shards) ===
+LEASE_SHARD = 10 * 60  # segundos que um nó segura um shard sem renovar
+INTERVALO_RENOVACAO_LEASE = 60  # segundos entre renovações dos leases do nó
+MAX_TENTATIVAS_SHARD = 3  # reservas de um shard (leases vencidos incluídos) antes de marcá-lo como 'falhou'
+# Modo de journal dos SQLite que ficam no --saida (jornal, fila de shards e índice dos PDFs). O WAL depende
+# de memória compartilhada entre os processos e não funciona num volume montado por hosts diferentes;
+# o rollback journal (DELETE) só precisa dos locks de arquivo do volume.
+MODO_JOURNAL_COMPARTILHADO = 'DELETE'
+
+# Erros que NÃO devem ter retry
+ERRORS_SEM_RETRY = [
+    "fatura indisponível no canal digital",
+    "fatura não disponível",
+    "documento não relacionado",
+    "acesso negado",
+    "não encontrado"
+]
+
+# ----------------------------
+# Preparação das UCs vindas da planilha
+# ----------------------------
+COLUNAS_PLANILHA = ['uc_id', 'cliente_id_gestor', 'distribuidora_id', 'codigo', 'login',
+                    'senha_dist', 'Status', 'documento', 'Distribuidora',
+                    'Status_Mes_Anterior', 'data_geracao', 'nome', 'Geradora?',
+                    'Clientes', 'Estimativa', 'Status2', 'Historico_Faturas',
+                    'StatusContrato', 'Senha_modificada', 'Status_TEST']
+# Colunas que a extração usa (filtrar_ucs); só elas vão para a cópia local da planilha
+COLUNAS_EXTRACAO = ['distribuidora_id', 'codigo', 'login', 'senha_dist', 'Distribuidora',
+                    'Status', 'Status_TEST', 'Estimativa', 'Clientes']
+
+def normalizar_planilha(df):
+    df.columns = COLUNAS_PLANILHA
+    df['Estimativa'] = pd.to_numeric(df['Estimativa'], errors='coerce').fillna(0).astype(int)
+    return df
+
+def filtrar_ucs(df, estimativa_inicio, estimativa_fim, clientes_selecionados):
+    """Filtros básicos da extração: distribuidoras atendidas, status, estimativa e clientes"""
+    return df.loc[
+        ((df['Distribuidora'].isin(['COELBA','COSERN','NEOENERGIA PE','ELEKTRO'])) &
+         (df['Status'].isin(['Acesso Ok','Sem fatura do mês de referencia','Retida'])) &
+         (df['Status_TEST'] == 'A baixar') &
+         (df['Estimativa'] >= estimativa_inicio) &
+         (df['Estimativa'] <= estimativa_fim) &
+         (df['Clientes'].isin(clientes_selecionados))),
+        ['distribuidora_id','codigo', 'login', 'senha_dist']
+    ].copy()
+
+def ordenar_por_login(df_filtrado):
+    """Agrupa as UCs de cada login (logins com mais UCs primeiro) e renomeia as colunas para o motor"""
+    df_filtrado["senha_dist"] = df_filtrado["senha_dist"].fillna("")
+
+    if len(df_filtrado) > 0:
+        frequencia_login = df_filtrado['login'].value_counts()
+        df_filtrado = df_filtrado.copy()
+        df_filtrado['frequencia_login'] = df_filtrado['login'].map(frequencia_login)
+        df_filtrado = df_filtrado.sort_values(['frequencia_login', 'login'], ascending=[False, True])
+        df_filtrado = df_filtrado.drop('frequencia_login', axis=1)
+        df_filtrado = df_filtrado.reset_index(drop=True)
+
+    df_filtrado.columns = ['dist','codigo','login','senha_dist']
+    return df_filtrado
+
+class PlanoExecucao:
+    """UCs já ordenadas por ordenar_por_login, com os blocos contíguos de cada login pré-calculados.
+
+    Os grupos são fatias do mesmo DataFrame (sem groupby nem cópias) e o ponto de partida
+    por código é um lookup num dicionário. O plano não é alterado depois de montado.
+    """
+
+    def __init__(self, df_ordenado):
+        self.df = df_ordenado.reset_index(drop=True)
+        logins = self.df['login']
+        inicios = logins.ne(logins.shift()).to_numpy().nonzero()[0].tolist()
+        fins = inicios[1:] + [len(self.df)]
+        self.blocos = [(logins.iat[inicio], inicio, fim) for inicio, fim in zip(inicios, fins)]
+        codigos = self.df['codigo']
+        primeiras = ~codigos.duplicated()
+        self.posicoes = dict(zip(codigos[primeiras], codigos.index[primeiras]))
+
+    def __len__(self):
+        return len(self.df)
+
+    def grupos(self):
+        """Um DataFrame por login, na ordem do plano"""
+        return [self.df.iloc[inicio:fim] for _, inicio, fim in self.blocos]
+
+    def a_partir_de(self, codigo):
+        """Plano com as UCs a partir de `codigo`, na ordem de processamento; None se ele não está no plano"""
+        posicao = self.posicoes.get(codigo)
+        if posicao is None:
+            return None
+        return PlanoExecucao(self.df.iloc[posicao:])
+
+    def sem_ucs(self, codigos):
+        """Plano sem as UCs indicadas (ex.: as já concluídas de uma execução retomada)"""
+        return PlanoExecucao(self.df[~self.df['codigo'].isin(codigos)])
+
+def montar_plano(df, estimativa_inicio, estimativa_fim, clientes_selecionados):
+    """Filtra, agrupa por login e ordena uma única vez; a interface guarda o plano em cache por versão da planilha"""
+    return PlanoExecucao(ordenar_por_login(filtrar_ucs(df, estimativa_inicio, estimativa_fim, clientes_selecionados)))
+
+# ----------------------------
+# Arquivos locais com credenciais
+# ----------------------------
+def criar_arquivo_privado(caminho):
+    """Cria o arquivo com permissão 0600 (ou restringe o que já existe), antes de o SQLite abri-lo.
+
+    O SQLite cria o -journal/-wal/-shm com a mesma permissão do banco, então eles também
+    ficam legíveis só pelo usuário do processo.
+    """
+    os.close(os.open(caminho, os.O_WRONLY | os.O_CREAT, 0o600))
+    os.chmod(caminho, 0o600)
+
+# ----------------------------
+# Cópia local das abas da planilha
+# ----------------------------
+class SnapshotPlanilhas:
+    """Última versão baixada de cada aba, com o modifiedTime do Drive da planilha naquele momento.
+
+    Quem carrega a planilha compara esse modifiedTime com o atual e só baixa a aba de novo
+    quando a planilha mudou; no resto do tempo (e se o Google estiver fora) usa a cópia local.
+    Só as `colunas` da extração são guardadas (as demais ficam vazias, na mesma posição), mas
+    elas incluem a senha_dist em texto puro: o arquivo é criado com permissão 0600.
+    """
+
+    def __init__(self, caminho=CAMINHO_PLANILHAS, colunas=COLUNAS_EXTRACAO):
+        self.caminho = caminho
+        # Posições em COLUNAS_PLANILHA, a mesma ordem em que normalizar_planilha nomeia as colunas
+        self.posicoes = {COLUNAS_PLANILHA.index(coluna) for coluna in colunas}
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        criar_arquivo_privado(caminho)
+        with self._conectar() as conexao:
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS abas (
+                    planilha TEXT NOT NULL,
+                    aba TEXT NOT NULL,
+                    modificado_em TEXT NOT NULL,
+                    sincronizado_em TEXT NOT NULL,
+                    valores TEXT NOT NULL,
+                    PRIMARY KEY (planilha, aba)
+                )
+            """)
+
+    @contextmanager
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho, timeout=30)
+        try:
+            conexao.execute("PRAGMA journal_mode=WAL")
+            with conexao:
+                yield conexao
+        finally:
+            conexao.close()
+
+    def obter(self, planilha, aba):
+        """(modificado_em, valores) da cópia local, ou (None, None) se a aba nunca foi baixada"""
+        with self._conectar() as conexao:
+            linha = conexao.execute(
+                "SELECT modificado_em, valores FROM abas WHERE planilha = ? AND aba = ?",
+                (planilha, aba)
+            ).fetchone()
+        if not linha:
+            return None, None
+        return linha[0], json.loads(linha[1])
+
+    def salvar(self, planilha, aba, modificado_em, valores):
+        """Guarda a aba (cabeçalho inteiro, linhas só com as colunas da extração) e retorna o que foi guardado"""
+        valores = valores[:1] + [
+            [celula if posicao in self.posicoes else '' for posicao, celula in enumerate(linha)]
+            for linha in valores[1:]
+        ]
+        with self._conectar() as conexao:
+            conexao.execute(
+                "INSERT OR REPLACE INTO abas (planilha, aba, modificado_em, sincronizado_em, valores) VALUES (?, ?, ?, ?, ?)",
+                (planilha, aba, modificado_em, datetime.now().isoformat(timespec='seconds'), json.dumps(valores, ensure_ascii=False))
+            )
+        return valores
+
+# ----------------------------
+# Armazenamento dos PDFs em disco (endereçado por conteúdo)
+# ----------------------------
+class ArmazemPDFs:
+    """Guarda cada PDF uma única vez em blobs/<sha256>.pdf e indexa por distribuidora/UC/mês.
+
+    Na sessão ficam só os metadados; os bytes são lidos do disco quando necessário.
+    O índice também guarda o código da planilha e o numeroFatura, para que execuções
+    seguintes pulem as faturas que já foram baixadas.
+    """
+
+    def __init__(self, diretorio=DIRETORIO_PDFS):
+        self.diretorio = diretorio
+        self.diretorio_blobs = os.path.join(diretorio, 'blobs')
+        self.caminho_indice = os.path.join(diretorio, 'indice.db')
+        os.makedirs(self.diretorio_blobs, exist_ok=True)
+        with self._conectar() as conexao:
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS faturas (
+                    distribuidora TEXT NOT NULL,
+                    uc TEXT NOT NULL,
+                    mes TEXT NOT NULL,
+                    nome_arquivo TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    tamanho INTEGER NOT NULL,
+                    salvo_em TEXT NOT NULL,
+                    PRIMARY KEY (distribuidora, uc, mes)
+                )
+            """)
+            # Colunas do índice incremental (bancos criados antes delas ganham as colunas aqui)
+            colunas = {linha[1] for linha in conexao.execute("PRAGMA table_info(faturas)")}
+            if 'codigo' not in colunas:
+                conexao.execute("ALTER TABLE faturas ADD COLUMN codigo TEXT")
+            if 'numero_fatura' not in colunas:
+                conexao.execute("ALTER TABLE faturas ADD COLUMN numero_fatura TEXT")
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_faturas_codigo ON faturas (distribuidora, codigo, mes)")
+
+    @contextmanager
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho_indice, timeout=30)
+        try:
+            conexao.execute(f"PRAGMA journal_mode={MODO_JOURNAL_COMPARTILHADO}")
+            with conexao:
+                yield conexao
+        finally:
+            conexao.close()
+
+    def caminho_blob(self, sha256):
+        return os.path.join(self.diretorio_blobs, sha256[:2], f"{sha256}.pdf")
+
+    def novo_temporario(self):
+        """Arquivo temporário no mesmo disco dos blobs, para o download ser gravado direto nele"""
+        descritor, temporario = tempfile.mkstemp(suffix='.tmp', dir=self.diretorio_blobs)
+        os.close(descritor)
+        return temporario
+
+    def salvar_arquivo(self, distribuidora, uc, mes, nome_arquivo, temporario, sha256, tamanho,
+                       codigo=None, numero_fatura=None):
+        """Move o PDF gravado em novo_temporario() para o blob (se ainda não existir), indexa e
+        retorna os metadados que vão para a sessão"""
+        caminho = self.caminho_blob(sha256)
+        if os.path.exists(caminho):
+            os.remove(temporario)
+        else:
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            os.replace(temporario, caminho)
+        with self._conectar() as conexao:
+            conexao.execute(
+                "INSERT OR REPLACE INTO faturas "
+                "(distribuidora, uc, mes, nome_arquivo, sha256, tamanho, salvo_em, codigo, numero_fatura) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (distribuidora, uc, mes, nome_arquivo, sha256, tamanho, datetime.now().isoformat(),
+                 codigo, numero_fatura)
+            )
+        return {'caminho': caminho, 'tamanho': tamanho, 'sha256': sha256}
+
+    def _metadados(self, sha256, tamanho):
+        caminho = self.caminho_blob(sha256)
+        if not os.path.exists(caminho):
+            return None
+        return {'caminho': caminho, 'tamanho': tamanho, 'sha256': sha256}
+
+    def fatura_existente(self, distribuidora, uc, mes, numero_fatura):
+        """Metadados da fatura se este numeroFatura já foi baixado antes, senão None"""
+        with self._conectar() as conexao:
+            linha = conexao.execute(
+                "SELECT sha256, tamanho FROM faturas WHERE distribuidora = ? AND uc = ? AND mes = ? AND numero_fatura = ?",
+                (distribuidora, uc, mes, str(numero_fatura))
+            ).fetchone()
+        return self._metadados(*linha) if linha else None
+
+    def faturas_da_uc(self, distribuidora, codigo, meses):
+        """Faturas já baixadas da UC (código da planilha) nos meses pedidos: {mes: (uc, nome_arquivo, metadados)}"""
+        marcadores = ",".join("?" * len(meses))
+        with self._conectar() as conexao:
+            linhas = conexao.execute(
+                f"SELECT mes, uc, nome_arquivo, sha256, tamanho FROM faturas "
+                f"WHERE distribuidora = ? AND codigo = ? AND mes IN ({marcadores})",
+                (distribuidora, codigo, *meses)
+            ).fetchall()
+        faturas = {}
+        for mes, uc, nome_arquivo, sha256, tamanho in linhas:
+            metadados = self._metadados(sha256, tamanho)
+            if metadados:
+                faturas[mes] = (uc, nome_arquivo, metadados)
+        return faturas
+
+    @staticmethod
+    def ler(metadados):
+        with open(metadados['caminho'], 'rb') as arquivo:
+            return arquivo.read()
+
+# ----------------------------
+# Configuração do Selenium
+# ----------------------------
+def iniciar_navegador(headless=True):
+    chrome_options = Options()
+    if headless:
+        chrome_options.add_argument("--headless=new")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--window-size=1920,1080")
+    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    
+    # No Streamlit Cloud, o chromedriver estará no PATH se vc usar o packages.txt
+    driver = webdriver.Chrome(options=chrome_options) 
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    return driver
+
+# ----------------------------
+# Pool de navegadores aquecidos, reaproveitados entre logins
+# ----------------------------
+def memoria_navegador(navegador):
+    """RSS em MB do chromedriver, do Chrome e de todos os processos filhos"""
+    try:
+        processo = psutil.Process(navegador.service.process.pid)
+        return sum(p.memory_info().rss for p in [processo, *processo.children(recursive=True)]) / 2 ** 20
+    except (psutil.Error, AttributeError):
+        return 0
+
+class PoolNavegadores:
+    """Navegadores Chrome já abertos, compartilhados por todos os workers e execuções do processo.
+
+    Antes de voltar ao pool, cada navegador tem cookies e storage limpos e é verificado;
+    é fechado depois de MAX_USOS_NAVEGADOR logins, acima de LIMITE_RSS_NAVEGADOR_MB ou se
+    deixar de responder. Navegadores novos só são abertos enquanto o pool couber em LIMITE_RSS_POOL_MB,
+    e os que ficam TEMPO_OCIOSO_NAVEGADOR sem uso são fechados, para o processo não segurar
+    Chromes entre um job e outro.
+    """
+
+    def __init__(self, headless, tamanho=MAX_WORKERS_LIMITE):
+        self.headless = headless
+        self.tamanho = tamanho
+        self.usos = {}
+        self._livres = []
+        self._livre_desde = {}
+        self._abrindo = 0
+        self._condicao = threading.Condition()
+        threading.Thread(target=self._vigiar_ociosos, name="pool-navegadores", daemon=True).start()
+
+    def _cabe_mais(self):
+        if len(self.usos) + self._abrindo >= self.tamanho:
+            return False
+        return sum(memoria_navegador(navegador) for navegador in self.usos) < LIMITE_RSS_POOL_MB
+
+    def _liberar(self, navegador):
+        # Chamado com o lock
+        self._livres.append(navegador)
+        self._livre_desde[navegador] = time.monotonic()
+        self._condicao.notify()
+
+    def _abrir(self):
+        try:
+            navegador = iniciar_navegador(self.headless)
+        except Exception:
+            with self._condicao:
+                self._abrindo -= 1
+                self._condicao.notify()
+            raise
+        with self._condicao:
+            self._abrindo -= 1
+            self.usos[navegador] = 0
+        return navegador
+
+    def aquecer(self, quantidade):
+        """Abre navegadores até haver `quantidade` no pool; retorna quantos existem"""
+        while True:
+            with self._condicao:
+                if len(self.usos) + self._abrindo >= min(quantidade, self.tamanho):
+                    return len(self.usos)
+                self._abrindo += 1
+            navegador = self._abrir()
+            with self._condicao:
+                self._liberar(navegador)
+
+    def obter(self):
+        prazo = time.monotonic() + TIMEOUT_CHECKOUT_NAVEGADOR
+        while True:
+            navegador = None
+            with self._condicao:
+                while not self._livres:
+                    if self._cabe_mais():
+                        self._abrindo += 1
+                        break
+                    restante = prazo - time.monotonic()
+                    if restante <= 0:
+                        raise TimeoutError("Nenhum navegador livre no pool")
+                    self._condicao.wait(restante)
+                else:
+                    navegador = self._livres.pop()
+                    self._livre_desde.pop(navegador, None)
+            if navegador is None:
+                return self._abrir()
+            if self._responde(navegador):
+                return navegador
+            self._fechar(navegador)
+
+    def devolver(self, navegador):
+        with self._condicao:
+            self.usos[navegador] += 1
+            usos = self.usos[navegador]
+        if (usos >= MAX_USOS_NAVEGADOR
+                or memoria_navegador(navegador) > LIMITE_RSS_NAVEGADOR_MB
+                or not self._limpar(navegador)):
+            self._fechar(navegador)
+            return
+        with self._condicao:
+            self._liberar(navegador)
+
+    @contextmanager
+    def navegador(self):
+        navegador = self.obter()
+        try:
+            yield navegador
+        finally:
+            self.devolver(navegador)
+
+    def _responde(self, navegador):
+        try:
+            return navegador.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def _limpar(self, navegador):
+        """Apaga a sessão do login anterior e sai do portal, para o próximo get() recarregar a página"""
+        try:
+            navegador.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+            navegador.delete_all_cookies()
+            navegador.get("about:blank")
+            return self._responde(navegador)
+        except Exception:
+            return False
+
+    def _fechar(self, navegador):
+        # Sai do pool com o lock, mas o quit() (que pode levar segundos) roda fora dele
+        with self._condicao:
+            self.usos.pop(navegador, None)
+            self._condicao.notify()
+        try:
+            navegador.quit()
+        except Exception:
+            pass
+
+    def fechar_ociosos(self, ociosidade=TEMPO_OCIOSO_NAVEGADOR):
+        """Fecha os navegadores livres parados há mais de `ociosidade` segundos; retorna quantos"""
+        limite = time.monotonic() - ociosidade
+        with self._condicao:
+            ociosos = [navegador for navegador in self._livres if self._livre_desde.get(navegador, 0) <= limite]
+            for navegador in ociosos:
+                self._livres.remove(navegador)
+                self._livre_desde.pop(navegador, None)
+        for navegador in ociosos:
+            self._fechar(navegador)
+        return len(ociosos)
+
+    def _vigiar_ociosos(self):
+        while True:
+            time.sleep(TEMPO_OCIOSO_NAVEGADOR / 4)
+            self.fechar_ociosos()
+
+    def encerrar(self):
+        self.fechar_ociosos(ociosidade=0)
+
+_pools_navegadores = {}
+_lock_pools = threading.Lock()
+
+def obter_pool_navegadores(headless):
+    """Um pool por modo (headless ou com janela), vivo enquanto o processo rodar"""
+    with _lock_pools:
+        if headless not in _pools_navegadores:
+            _pools_navegadores[headless] = PoolNavegadores(headless)
+        return _pools_navegadores[headless]
+
+@atexit.register
+def encerrar_pools_navegadores():
+    for pool in list(_pools_navegadores.values()):
+        pool.encerrar()
+
+# ----------------------------
+# Resposta HTTP já lida (mesma interface usada de requests.Response)
+# ----------------------------
+class RespostaHTTP:
+    def __init__(self, status_code, headers, content, dados=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        # Resultado do leitor de streaming (o corpo não fica em content)
+        self.dados = dados
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def __bool__(self):
+        # Igual a requests.Response: respostas 4xx/5xx são "falsas"
+        return self.status_code < 400
+
+# ----------------------------
+# Métricas do caminho quente (histogramas por etapa, distribuidora e status)
+# ----------------------------
+def etapa_da_url(url):
+    """Etapa da UC correspondente a um endpoint da API"""
+    if url.endswith('/pdf'):
+        return 'pdf'
+    if url.endswith('/faturas'):
+        return 'faturas'
+    if url.endswith('/obterProtocolo'):
+        return 'protocolo'
+    return 'ucs'
+
+class MetricasExecucao:
+    """Histogramas e contadores acumulados desde o início do processo, no formato do Prometheus.
+
+    Chamados das threads de login e do loop da fase HTTP; cada registro é só um
+    bisect e algumas somas sob lock, então pode ficar no caminho quente.
+    """
+
+    DESCRICOES = {
+        'neoenergia_etapa_segundos': ('histogram', "Duração de cada tentativa por etapa (login, ucs, protocolo, faturas, pdf)"),
+        'neoenergia_espera_limitador_segundos': ('histogram', "Espera no limitador de taxa antes de cada tentativa"),
+        'neoenergia_espera_navegador_segundos': ('histogram', "Espera por um navegador livre no pool"),
+        'neoenergia_retentativas_total': ('counter', "Tentativas além da primeira, por etapa e distribuidora")
+    }
+
+    def __init__(self):
+        self.histogramas = {}
+        self.contadores = {}
+        self._lock = threading.Lock()
+
+    def observar(self, nome, segundos, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = {'buckets': [0] * (len(BUCKETS_METRICAS) + 1), 'soma': 0.0, 'total': 0}
+            histograma['buckets'][bisect.bisect_left(BUCKETS_METRICAS, segundos)] += 1
+            histograma['soma'] += segundos
+            histograma['total'] += 1
+
+    def incrementar(self, nome, quantidade=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self.contadores[chave] = self.contadores.get(chave, 0) + quantidade
+
+    def instantaneo(self):
+        """Cópia em dicionários simples, para o dump JSON"""
+        with self._lock:
+            return {
+                'histogramas': [
+                    {'nome': nome, 'rotulos': dict(rotulos), 'soma': round(h['soma'], 4), 'total': h['total'],
+                     'buckets': dict(zip([str(limite) for limite in BUCKETS_METRICAS] + ['+Inf'], h['buckets']))}
+                    for (nome, rotulos), h in sorted(self.histogramas.items())
+                ],
+                'contadores': [
+                    {'nome': nome, 'rotulos': dict(rotulos), 'valor': valor}
+                    for (nome, rotulos), valor in sorted(self.contadores.items())
+                ]
+            }
+
+    def texto_prometheus(self):
+        dados = self.instantaneo()
+        linhas = []
+        descritos = set()
+
+        def cabecalho(nome):
+            if nome not in descritos:
+                tipo, descricao = self.DESCRICOES[nome]
+                linhas.extend([f"# HELP {nome} {descricao}", f"# TYPE {nome} {tipo}"])
+                descritos.add(nome)
+
+        def serie(nome, rotulos):
+            if not rotulos:
+                return nome
+            return nome + '{' + ','.join(f'{chave}="{valor}"' for chave, valor in rotulos.items()) + '}'
+
+        for h in dados['histogramas']:
+            cabecalho(h['nome'])
+            acumulado = 0
+            for limite, quantidade in h['buckets'].items():
+                acumulado += quantidade
+                linhas.append(f"{serie(h['nome'] + '_bucket', {**h['rotulos'], 'le': limite})} {acumulado}")
+            linhas.append(f"{serie(h['nome'] + '_sum', h['rotulos'])} {h['soma']}")
+            linhas.append(f"{serie(h['nome'] + '_count', h['rotulos'])} {h['total']}")
+        for c in dados['contadores']:
+            cabecalho(c['nome'])
+            linhas.append(f"{serie(c['nome'], c['rotulos'])} {c['valor']}")
+        return '\n'.join(linhas) + '\n'
+
+METRICAS = MetricasExecucao()
+
+class _RespostaMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            corpo, tipo = METRICAS.texto_prometheus().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            corpo, tipo = json.dumps(METRICAS.instantaneo()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def log_message(self, *args):
+        pass
+
+_servidor_metricas = None
+_lock_servidor_metricas = threading.Lock()
+
+def iniciar_servidor_metricas(porta=PORTA_METRICAS):
+    """Sobe (uma vez por processo) o endpoint /metrics (Prometheus) e /metrics.json; porta 0 desliga"""
+    global _servidor_metricas
+    with _lock_servidor_metricas:
+        if porta and _servidor_metricas is None:
+            _servidor_metricas = ThreadingHTTPServer(('0.0.0.0', porta), _RespostaMetricas)
+            threading.Thread(target=_servidor_metricas.serve_forever, name="metricas", daemon=True).start()
+        return _servidor_metricas
+
+# ----------------------------
+# Função assíncrona para fazer requisições com retry
+# ----------------------------
+async def fazer_requisicao_com_retry_async(motor_http, url, headers=None, params=None, method='GET', 
+                                           distribuidora=None,
+                                           max_retries=MAX_RETRIES, 
+                                           skip_retry_errors=None, leitor=None):
+    """leitor: corrotina opcional que consome o corpo das respostas 200 em pedaços; o que ela
+    retorna fica em response.dados e o corpo não é carregado na memória"""
+    if skip_retry_errors is None:
+        skip_retry_errors = ERRORS_SEM_RETRY
+    
+    # Sessão persistente (keep-alive) do host regional da URL
+    sessao = motor_http.sessao_para(url)
+    # O ritmo das chamadas (e o backoff entre tentativas) vem do limitador do host/distribuidora
+    limitador = motor_http.limitador_para(url, distribuidora)
+    etapa = etapa_da_url(url)
+    rotulo_distribuidora = distribuidora or '-'
+    
+    for attempt in range(max_retries):
+        if attempt:
+            METRICAS.incrementar('neoenergia_retentativas_total', etapa=etapa, distribuidora=rotulo_distribuidora)
+        status = 'erro_conexao'
+        inicio = time.perf_counter()
+        try:
+            await limitador.adquirir()
+            METRICAS.observar('neoenergia_espera_limitador_segundos', time.perf_counter() - inicio, distribuidora=rotulo_distribuidora)
+            inicio = time.perf_counter()
+            # O semáforo global limita as requisições em voo; a espera do limitador fica fora dele
+            async with motor_http.semaforo:
+                if method.upper() == 'GET':
+                    contexto = sessao.get(url, headers=headers, params=params)
+                else:
+                    contexto = sessao.post(url, headers=headers, json=params)
+                async with contexto as res:
+                    if leitor and res.status == 200:
+                        response = RespostaHTTP(res.status, res.headers, b'', await leitor(res))
+                    else:
+                        response = RespostaHTTP(res.status, res.headers, await res.read())
+            status = response.status_code
+            
+            if response.status_code == 200:
+                limitador.registrar_sucesso()
+                return response
+            
+            response_text = response.text.lower()
+            should_skip_retry = any(error in response_text for error in skip_retry_errors)
+            
+            if should_skip_retry:
+                return response
+            
+            if response.status_code in STATUS_SOBRECARGA:
+                limitador.registrar_sobrecarga(time.perf_counter() - inicio)
+                if attempt < max_retries - 1:
+                    continue
+                else:
+                    return response
+            
+            return response
+            
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                status = 'timeout'
+            limitador.registrar_sobrecarga(time.perf_counter() - inicio)
+            if attempt < max_retries - 1:
+                continue
+            else:
+                raise
+        finally:
+            METRICAS.observar('neoenergia_etapa_segundos', time.perf_counter() - inicio, etapa=etapa, distribuidora=rotulo_distribuidora, status=str(status))
+    
+    return None
+
+# ----------------------------
+# Download do PDF em streaming (direto para o armazém)
+# ----------------------------
+class ExtratorBase64Json:
+    """Acha o fileData/faturaBase64 no JSON do /pdf e decodifica o base64 conforme os pedaços chegam.
+
+    Guarda só o necessário entre pedaços: o fim do pedaço anterior (para uma chave partida ao meio),
+    um escape JSON incompleto e até 3 caracteres base64 que ainda não fecham um grupo de 4.
+    """
+
+    CHAVE = re.compile(rb'"(?:fileData|faturaBase64)"\s*:\s*"')
+    TAMANHO_CAUDA = 256
+
+    def __init__(self):
+        self._cauda = b''
+        self._escape = b''
+        self._resto = b''
+        self._decodificados = 0
+        self._no_valor = False
+        self.concluido = False
+
+    def alimentar(self, pedaco):
+        """Bytes do PDF decodificados a partir deste pedaço do JSON"""
+        saida = []
+        while pedaco and not self.concluido:
+            if not self._no_valor:
+                texto = self._cauda + pedaco
+                achado = self.CHAVE.search(texto)
+                if not achado:
+                    self._cauda = texto[-self.TAMANHO_CAUDA:]
+                    break
+                self._cauda = b''
+                self._no_valor = True
+                pedaco = texto[achado.end():]
+                continue
+
+            fim = pedaco.find(b'"')
+            saida.append(self._decodificar(pedaco if fim < 0 else pedaco[:fim]))
+            if fim < 0:
+                break
+            pedaco = pedaco[fim + 1:]
+            saida.append(self._fechar_valor())
+        return b''.join(saida)
+
+    def finalizar(self):
+        if self._no_valor:
+            raise ValueError("JSON do PDF terminou no meio do base64")
+
+    def _decodificar(self, valor):
+        valor = self._escape + valor
+        self._escape = b''
+        if b'\\' in valor:
+            valor = self._desescapar(valor)
+        dados = self._resto + valor.translate(None, b' \n\r\t')
+        corte = len(dados) - len(dados) % 4
+        self._resto = dados[corte:]
+        pdf = binascii.a2b_base64(dados[:corte])
+        self._decodificados += len(pdf)
+        return pdf
+
+    def _desescapar(self, valor):
+        # Alguns serializadores escapam a barra do base64 (\/) ou quebram linhas (\n, \u000a)
+        partes = []
+        inicio = 0
+        while True:
+            barra = valor.find(b'\\', inicio)
+            if barra < 0:
+                partes.append(valor[inicio:])
+                break
+            partes.append(valor[inicio:barra])
+            fim = barra + (6 if valor[barra + 1:barra + 2] == b'u' else 2)
+            if fim > len(valor):
+                self._escape = valor[barra:]
+                break
+            partes.append(json.loads(b'"' + valor[barra:fim] + b'"').encode('ascii', errors='ignore'))
+            inicio = fim
+        return b''.join(partes)
+
+    def _fechar_valor(self):
+        pdf = binascii.a2b_base64(self._resto) if self._resto else b''
+        self._decodificados += len(pdf)
+        self._resto = b''
+        self._no_valor = False
+        # fileData vazio: vale o faturaBase64, como no data_json.get("fileData") or data_json.get("faturaBase64")
+        self.concluido = self._decodificados > 0
+        return pdf
+
+
+class DownloadPDF:
+    """Leitor do /pdf para fazer_requisicao_com_retry_async.
+
+    Grava o PDF num temporário do armazém enquanto o corpo chega, em pedaços de
+    TAMANHO_PEDACO_DOWNLOAD, calculando o sha256 no caminho. Retorna (temporario, sha256, tamanho),
+    para ArmazemPDFs.salvar_arquivo, ou None se a resposta não trouxe PDF.
+    """
+
+    def __init__(self, armazem):
+        self.armazem = armazem
+
+    async def __call__(self, res):
+        content_type = res.headers.get('Content-Type', '')
+        if 'application/json' in content_type:
+            extrator = ExtratorBase64Json()
+        elif 'application/pdf' in content_type:
+            extrator = None
+        else:
+            return None
+
+        temporario = self.armazem.novo_temporario()
+        sha256 = hashlib.sha256()
+        tamanho = 0
+        try:
+            with open(temporario, 'wb') as arquivo:
+                async for pedaco in res.content.iter_chunked(TAMANHO_PEDACO_DOWNLOAD):
+                    if extrator:
+                        pedaco = extrator.alimentar(pedaco)
+                    if pedaco:
+                        sha256.update(pedaco)
+                        arquivo.write(pedaco)
+                        tamanho += len(pedaco)
+            if extrator:
+                extrator.finalizar()
+        except BaseException:
+            os.remove(temporario)
+            raise
+
+        if not tamanho:
+            os.remove(temporario)
+            return None
+        return temporario, sha256.hexdigest(), tamanho
+
+# ----------------------------
+# Limitador de taxa adaptativo (token bucket + AIMD)
+# ----------------------------
+class LimitadorAIMD:
+    """Token bucket cuja taxa sobe aos poucos com respostas 200 e cai pela metade com 429/500/timeout.
+
+    Uma rajada de falhas das requisições que já estavam em voo conta como uma sobrecarga só:
+    depois de cada redução, as seguintes são ignoradas por 1/taxa ou pela duração da
+    requisição que falhou (o que for maior).
+    """
+
+    def __init__(self):
+        self.taxa = LIMITE_TAXA_INICIAL  # requisições por segundo
+        self.tokens = 1.0
+        self._ultimo = time.monotonic()
+        self._proxima_reducao = 0.0
+
+    async def adquirir(self):
+        # Sem lock: não há await entre conferir e tirar o token, e quem acorda recalcula a espera
+        # com a taxa atual (que pode ter subido enquanto dormia)
+        while True:
+            agora = time.monotonic()
+            capacidade = max(1.0, self.taxa)
+            self.tokens = min(capacidade, self.tokens + (agora - self._ultimo) * self.taxa)
+            self._ultimo = agora
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(min(LIMITE_REAVALIACAO, (1 - self.tokens) / self.taxa))
+
+    def registrar_sucesso(self):
+        self.taxa = min(LIMITE_TAXA_MAXIMA, self.taxa + LIMITE_INCREMENTO)
+
+    def registrar_sobrecarga(self, duracao=0.0):
+        """duracao: segundos da tentativa que falhou (aproxima o RTT das que ainda estão em voo)"""
+        agora = time.monotonic()
+        if agora < self._proxima_reducao:
+            return
+        # Esvazia o balde: a próxima chamada espera 1/taxa, que cresce a cada sobrecarga até MAX_DELAY
+        self.taxa = max(LIMITE_TAXA_MINIMA, self.taxa * LIMITE_FATOR_REDUCAO)
+        self.tokens = 0.0
+        self._proxima_reducao = agora + max(1 / self.taxa, duracao)
+
+# ----------------------------
+# Event loop da fase HTTP, com uma sessão keep-alive por host regional
+# ----------------------------
+class MotorHTTPAsync:
+    """Event loop asyncio em thread própria, com um pool de conexões por host e um semáforo global"""
+
+    def __init__(self, max_requisicoes):
+        self.max_requisicoes = int(max_requisicoes)
+        self.sessoes = {}
+        self.conexoes = {}
+        self.limitadores = {}
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._executar_loop, name="fase-http", daemon=True)
+        self._thread.start()
+        self.semaforo = self._aguardar(self._iniciar())
+
+    def _executar_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _aguardar(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _iniciar(self):
+        # Abre já as sessões dos hosts conhecidos (apineprd, apiseprd)
+        for dados in DISTRIBUIDORAS.values():
+            self.sessao_para(url_api(dados['base_url'], ''))
+        return asyncio.Semaphore(self.max_requisicoes)
+
+    def sessao_para(self, url):
+        """Retorna a ClientSession do host da URL, criando-a na primeira vez (só dentro do loop)"""
+        host = urlparse(url).hostname
+        if host not in self.sessoes:
+            self.conexoes[host] = {'novas': 0, 'reutilizadas': 0}
+            self.sessoes[host] = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT_REQUISICAO),
+                connector=aiohttp.TCPConnector(
+                    limit=POOL_CONEXOES_POR_HOST,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT
+                ),
+                trace_configs=[self._trace_conexoes(host)]
+            )
+        return self.sessoes[host]
+
+    def limitador_para(self, url, distribuidora=None):
+        """Retorna o limitador de taxa do par (host, distribuidora), criando-o na primeira vez"""
+        chave = (urlparse(url).hostname, distribuidora)
+        if chave not in self.limitadores:
+            self.limitadores[chave] = LimitadorAIMD()
+        return self.limitadores[chave]
+
+    def estatisticas_limites(self):
+        """Taxa (req/s) em que cada limitador terminou"""
+        return {f"{host}/{distribuidora or '-'}": round(limitador.taxa, 2) for (host, distribuidora), limitador in self.limitadores.items()}
+
+    def _trace_conexoes(self, host):
+        contadores = self.conexoes[host]
+
+        async def nova_conexao(sessao, contexto, params):
+            contadores['novas'] += 1
+
+        async def conexao_reutilizada(sessao, contexto, params):
+            contadores['reutilizadas'] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(nova_conexao)
+        trace_config.on_connection_reuseconn.append(conexao_reutilizada)
+        return trace_config
+
+    def estatisticas_conexoes(self):
+        """Conexões TCP+TLS abertas e reaproveitadas por host"""
+        return {host: dict(contadores) for host, contadores in self.conexoes.items()}
+
+    async def _finalizar(self):
+        tarefas = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for tarefa in tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        for sessao in self.sessoes.values():
+            await sessao.close()
+
+    def submeter(self, coro):
+        """Agenda a corrotina no loop; retorna um concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def encerrar(self):
+        self._aguardar(self._finalizar())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+# ----------------------------
+# Função para ler o token do storage
+# ----------------------------
+def ler_token_storage(navegador, id_distribuidora):
+    try:
+        if id_distribuidora == 52:
+            token_raw = navegador.execute_script("return window.localStorage.getItem('tokenNeSe');")
+            if not token_raw:
+                return None
+            try: 
+                tokens = json.loads(token_raw)
+                return tokens['se']
+            except: 
+                return token_raw
+        else:
+            return navegador.execute_script("return window.localStorage.getItem('access_token') || window.localStorage.getItem('token');")
+    except:
+        return None
+
+# ----------------------------
+# Função para limpar documento
+# ----------------------------
+def url_api(base_url, caminho):
+    """URL de um endpoint no host regional (apineprd/apiseprd) da API"""
+    return URL_API.format(base_url=base_url) + caminho
+
+def limpar_documento(documento):
+    return re.sub(r'[^0-9]', '', documento)
+
+# ----------------------------
+# Observadores dos eventos da execução
+# ----------------------------
+class ObservadorExecucao:
+    """Recebe os eventos da execução (interface, CLI, métricas...); por padrão ignora todos.
+
+    Os métodos são chamados das threads do motor, então devem ser rápidos e thread-safe:
+    quem precisa desenhar uma tela deve só acumular aqui e atualizar em lote depois.
+    """
+
+    def execucao_iniciada(self, execucao_id, total):
+        pass
+
+    def uc_concluida(self, registro):
+        """Chamado uma vez por UC, com o RegistroUC completo (desfecho, meses, tempo)"""
+        pass
+
+    def mensagem(self, nivel, texto):
+        """Avisos, erros e linhas do relatório final; `nivel` segue os nomes st.* (write, info, success, warning, error)"""
+        pass
+
+    def execucao_finalizada(self, resultados):
+        pass
+
+# ----------------------------
+# Coletor dos resultados compartilhado entre os workers
+# ----------------------------
+CATEGORIAS_RESULTADO = [
+    'ucs_sucesso',
+    'ucs_retidas',
+    'ucs_fatura_indisponivel',
+    'ucs_erro_sistema',
+    'ucs_erro_busca',
+    'ucs_sem_fatura',
+    'ucs_inativas',
+    'ucs_ativar_cadastro',
+    'ucs_cadastro_invalido'
+]
+
+# Categorias que indicam que a UC precisa ser tentada de novo ao retomar uma execução
+CATEGORIAS_FALHA = {'ucs_retidas', 'ucs_erro_sistema', 'ucs_erro_busca'}
+
+# Bit de cada categoria na coluna `categorias` da TabelaResultados (o bit mais baixo é o desfecho)
+BIT_CATEGORIA = {categoria: 1 << posicao for posicao, categoria in enumerate(CATEGORIAS_RESULTADO)}
+
+class TabelaResultados:
+    """Um registro por UC em colunas tipadas, com upsert O(1) pelo código da planilha.
+
+    As categorias ficam num bitmask na ordem de CATEGORIAS_RESULTADO, então o desfecho é o
+    bit mais baixo e o relatório final é uma passada pelas colunas. Exportável para CSV/Parquet.
+    """
+
+    def __init__(self):
+        self.posicoes = {}
+        self.codigo = []
+        self.uc = []
+        self.login = []
+        self.meses = []
+        self.distribuidora = array('H')
+        self.categorias = array('H')
+        self.bytes = array('Q')
+        self.tempo = array('d')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.codigo)
+
+    def registrar(self, registro):
+        """Insere a UC ou, se ela já apareceu (código repetido na planilha), junta os desfechos"""
+        bits = 0
+        for categoria in registro.categorias:
+            bits |= BIT_CATEGORIA[categoria]
+        tempo = math.nan if registro.tempo is None else registro.tempo
+
+        with self._lock:
+            posicao = self.posicoes.get(registro.codigo)
+            if posicao is None:
+                self.posicoes[registro.codigo] = len(self.codigo)
+                self.codigo.append(registro.codigo)
+                self.uc.append(registro.uc)
+                self.login.append(registro.login)
+                self.meses.append(",".join(registro.meses_baixados))
+                self.distribuidora.append(registro.distribuidora)
+                self.categorias.append(bits)
+                self.bytes.append(registro.bytes_baixados)
+                self.tempo.append(tempo)
+                return
+
+            self.uc[posicao] = registro.uc
+            self.categorias[posicao] |= bits
+            if registro.meses_baixados:
+                meses = set(filter(None, self.meses[posicao].split(","))) | set(registro.meses_baixados)
+                self.meses[posicao] = ",".join(sorted(meses))
+            self.bytes[posicao] += registro.bytes_baixados
+            if not math.isnan(tempo):
+                self.tempo[posicao] = tempo
+
+    def ucs_por_categoria(self):
+        """UCs de cada categoria; como no relatório de sempre, quem teve sucesso só conta como sucesso"""
+        sucesso = BIT_CATEGORIA['ucs_sucesso']
+        resultado = {categoria: [] for categoria in CATEGORIAS_RESULTADO}
+        with self._lock:
+            for uc, bits in zip(self.uc, self.categorias):
+                if bits & sucesso:
+                    resultado['ucs_sucesso'].append(uc)
+                    continue
+                for categoria, bit in BIT_CATEGORIA.items():
+                    if bits & bit:
+                        resultado[categoria].append(uc)
+        return resultado
+
+    def tempos(self):
+        """(código, segundos) das UCs que chegaram ao fim do processamento"""
+        with self._lock:
+            return [(codigo, tempo) for codigo, tempo in zip(self.codigo, self.tempo) if not math.isnan(tempo)]
+
+    def para_dataframe(self):
+        with self._lock:
+            bits = pd.Series(self.categorias, dtype='uint16')
+            df = pd.DataFrame({
+                'codigo': self.codigo,
+                'uc': self.uc,
+                'login': self.login,
+                'distribuidora': pd.Series(self.distribuidora, dtype='uint16'),
+                'meses_baixados': self.meses,
+                'bytes': pd.Series(self.bytes, dtype='uint64'),
+                'tempo': pd.Series(self.tempo, dtype='float64')
+            })
+        # Desfecho = bit mais baixo; as demais categorias viram colunas booleanas
+        codigos_desfecho = [(valor & -valor).bit_length() - 1 for valor in bits]
+        df.insert(4, 'desfecho', pd.Categorical.from_codes(codigos_desfecho, categories=CATEGORIAS_RESULTADO))
+        for categoria, bit in BIT_CATEGORIA.items():
+            df[categoria] = (bits & bit).astype(bool)
+        return df
+
+    def exportar(self, caminho):
+        """Grava a tabela em Parquet (.parquet, precisa do pyarrow) ou CSV (qualquer outra extensão)"""
+        df = self.para_dataframe()
+        if caminho.endswith('.parquet'):
+            df.to_parquet(caminho, index=False)
+        else:
+            df.to_csv(caminho, index=False)
+        return caminho
+
+class ColetorResultados:
+    """Acumula o desfecho de cada UC vindo de vários workers numa TabelaResultados.
+
+    Também guarda os PDFs baixados e repassa os eventos da execução aos observadores,
+    para que o motor não dependa de quem está acompanhando (Streamlit, CLI ou ninguém).
+    """
+
+    def __init__(self, total, jornal=None, execucao_id=None, observadores=()):
+        self.total = total
+        self.jornal = jornal
+        self.execucao_id = execucao_id
+        self.tabela = TabelaResultados()
+        self.observadores = list(observadores)
+        self.arquivos = {}
+        self.ucs_iniciadas = 0
+        self.ucs_concluidas = 0
+        self.parar = threading.Event()
+        self._lock = threading.Lock()
+
+    def notificar(self, evento, *args):
+        """Repassa o evento a cada observador; a falha de um observador não interrompe o motor"""
+        for observador in self.observadores:
+            try:
+                getattr(observador, evento)(*args)
+            except Exception:
+                pass
+
+    def registrar_mensagem(self, texto, nivel='write'):
+        self.notificar('mensagem', nivel, texto)
+
+    def adicionar_arquivo(self, mes_ref, nome_arquivo, metadados):
+        with self._lock:
+            self.arquivos.setdefault(mes_ref, {})[nome_arquivo] = metadados
+
+    def proxima_uc(self):
+        """Retorna o número sequencial (1..total) da UC que está começando"""
+        with self._lock:
+            self.ucs_iniciadas += 1
+            return self.ucs_iniciadas
+
+    def concluir(self, quantidade=1):
+        with self._lock:
+            self.ucs_concluidas += quantidade
+
+    def finalizar_uc(self, registro):
+        """Grava o desfecho da UC na tabela e no jornal (checkpoint) e conta o progresso"""
+        self.tabela.registrar(registro)
+        if self.jornal:
+            self.jornal.registrar(self.execucao_id, registro.codigo, registro.login, registro.categorias, registro.meses_baixados)
+        self.concluir()
+        self.notificar('uc_concluida', registro)
+
+    def registrar_falha_grupo(self, df_grupo, categoria):
+        """Marca todas as UCs de um login com a mesma categoria (ex.: credenciais inválidas)"""
+        for linha in df_grupo.itertuples(index=False):
+            registro = RegistroUC(self, linha)
+            registro.adicionar(categoria, linha.codigo.zfill(12))
+            self.finalizar_uc(registro)
+
+def codigo_distribuidora(valor):
+    """distribuidora_id da planilha como int, ou None se a célula estiver vazia ou não for número"""
+    numero = pd.to_numeric(valor, errors='coerce')
+    return None if pd.isna(numero) else int(numero)
+
+class RegistroUC:
+    """Desfecho de uma única UC (categorias, meses, detalhes da busca); vai para a tabela do coletor ao finalizar"""
+
+    def __init__(self, coletor, linha):
+        self.coletor = coletor
+        self.codigo = linha.codigo
+        self.login = linha.login
+        self.distribuidora = codigo_distribuidora(linha.dist) or 0
+        self.uc = linha.codigo.zfill(12)
+        self.numero = None
+        self.protocolo = None
+        self.faturas_encontradas = 0
+        self.mais_recente = None
+        self.categorias = set()
+        self.meses_baixados = []
+        self.meses_reaproveitados = []
+        self.meses_nao_encontrados = []
+        self.bytes_baixados = 0
+        self.tempo = None
+
+    @property
+    def desfecho(self):
+        """Categoria principal da UC, na ordem de CATEGORIAS_RESULTADO (sucesso prevalece)"""
+        return next((categoria for categoria in CATEGORIAS_RESULTADO if categoria in self.categorias), None)
+
+    def adicionar(self, categoria, uc):
+        # O relatório usa o código que a API devolveu para a UC, quando ela já respondeu
+        self.categorias.add(categoria)
+        self.uc = uc
+
+# ----------------------------
+# Jornal das execuções (checkpoint para retomar)
+# ----------------------------
+class JornalExecucoes:
+    """Registro append-only em SQLite do desfecho de cada UC de cada execução"""
+
+    def __init__(self, caminho=CAMINHO_JORNAL):
+        self.caminho = caminho
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        # Mesmo arquivo da FilaShards, que guarda credenciais
+        criar_arquivo_privado(caminho)
+        with self._conectar() as conexao:
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS execucoes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    iniciada_em TEXT NOT NULL,
+                    meses TEXT NOT NULL,
+                    mes_atraso TEXT NOT NULL,
+                    total_ucs INTEGER NOT NULL
+                )
+            """)
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS desfechos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    execucao_id INTEGER NOT NULL,
+                    codigo TEXT NOT NULL,
+                    login TEXT NOT NULL,
+                    categorias TEXT NOT NULL,
+                    meses_baixados TEXT NOT NULL,
+                    concluida INTEGER NOT NULL,
+                    registrado_em TEXT NOT NULL
+                )
+            """)
+            conexao.execute("CREATE INDEX IF NOT EXISTS idx_desfechos_execucao ON desfechos (execucao_id, codigo)")
+
+    @contextmanager
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho, timeout=30)
+        try:
+            conexao.execute(f"PRAGMA journal_mode={MODO_JOURNAL_COMPARTILHADO}")
+            conexao.execute("PRAGMA synchronous=NORMAL")
+            with conexao:
+                yield conexao
+        finally:
+            conexao.close()
+
+    def iniciar(self, meses_desejados, mes_atraso, total_ucs):
+        with self._conectar() as conexao:
+            cursor = conexao.execute(
+                "INSERT INTO execucoes (iniciada_em, meses, mes_atraso, total_ucs) VALUES (?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec='seconds'), meses_desejados, mes_atraso, total_ucs)
+            )
+            return cursor.lastrowid
+
+    def registrar(self, execucao_id, codigo, login, categorias, meses_baixados):
+        concluida = bool(categorias) and not (set(categorias) & CATEGORIAS_FALHA)
+        with self._conectar() as conexao:
+            conexao.execute(
+                "INSERT INTO desfechos (execucao_id, codigo, login, categorias, meses_baixados, concluida, registrado_em) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (execucao_id, codigo, login, ",".join(sorted(categorias)), ",".join(meses_baixados),
+                 int(concluida), datetime.now().isoformat(timespec='seconds'))
+            )
+
+    def ucs_concluidas(self, execucao_id):
+        """Códigos cuja última tentativa nesta execução terminou sem falha"""
+        with self._conectar() as conexao:
+            linhas = conexao.execute("""
+                SELECT codigo FROM desfechos d
+                WHERE execucao_id = ? AND concluida = 1
+                  AND id = (SELECT MAX(id) FROM desfechos WHERE execucao_id = d.execucao_id AND codigo = d.codigo)
+            """, (execucao_id,)).fetchall()
+        return {codigo for (codigo,) in linhas}
+
+    def obter(self, execucao_id):
+        with self._conectar() as conexao:
+            linha = conexao.execute(
+                "SELECT id, iniciada_em, meses, mes_atraso, total_ucs FROM execucoes WHERE id = ?", (execucao_id,)
+            ).fetchone()
+        if not linha:
+            return None
+        id_, iniciada_em, meses, mes_atraso, total = linha
+        return {'id': id_, 'iniciada_em': iniciada_em, 'meses': meses, 'mes_atraso': mes_atraso, 'total_ucs': total}
+
+    def resumo(self, execucao_id):
+        """Quantidade de UCs por categoria, pela última tentativa de cada código (soma todos os nós)"""
+        with self._conectar() as conexao:
+            linhas = conexao.execute("""
+                SELECT categorias FROM desfechos d
+                WHERE execucao_id = ?
+                  AND id = (SELECT MAX(id) FROM desfechos WHERE execucao_id = d.execucao_id AND codigo = d.codigo)
+            """, (execucao_id,)).fetchall()
+        contagens = {categoria: 0 for categoria in CATEGORIAS_RESULTADO}
+        for (categorias,) in linhas:
+            for categoria in filter(None, categorias.split(",")):
+                contagens[categoria] += 1
+        return contagens
+
+    def listar(self, limite=20):
+        with self._conectar() as conexao:
+            linhas = conexao.execute("""
+                SELECT e.id, e.iniciada_em, e.meses, e.total_ucs,
+                       (SELECT COUNT(DISTINCT codigo) FROM desfechos d WHERE d.execucao_id = e.id AND d.concluida = 1)
+                FROM execucoes e ORDER BY e.id DESC LIMIT ?
+            """, (limite,)).fetchall()
+        return [
+            {'id': id_, 'iniciada_em': iniciada_em, 'meses': meses, 'total_ucs': total, 'concluidas': concluidas}
+            for id_, iniciada_em, meses, total, concluidas in linhas
+        ]
+
+# ----------------------------
+# Cache de tokens por login (fase 1)
+# ----------------------------
+def expiracao_token(token):
+    """Lê o 'exp' do JWT; se o token não for um JWT, assume TOKEN_TTL_PADRAO"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return float(exp)
+    except Exception:
+        pass
+    return time.time() + TOKEN_TTL_PADRAO
+
+class CacheTokens:
+    """Guarda o bearer token de cada (login, distribuidora) até perto da expiração"""
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def obter(self, login, id_distribuidora):
+        with self._lock:
+            item = self._tokens.get((login, id_distribuidora))
+        if item and item[1] - TOKEN_MARGEM_EXPIRACAO > time.time():
+            return item[0]
+        return None
+
+    def salvar(self, login, id_distribuidora, token):
+        with self._lock:
+            self._tokens[(login, id_distribuidora)] = (token, expiracao_token(token))
+
+class CacheSessaoLogin:
+    """Lista de UCs e protocolo de cada login, buscados uma vez e compartilhados entre as UCs do grupo.
+
+    Vive no loop da fase HTTP: a primeira UC dispara a busca e as demais aguardam a mesma tarefa.
+    Falhas não ficam em cache, então a próxima UC tenta de novo. Logins cuja API já recusou um
+    protocolo emprestado entram em `protocolo_recusado` e passam a buscar um protocolo por UC.
+    """
+
+    def __init__(self):
+        self._entradas = {}
+        self.protocolo_recusado = set()
+        self.buscas = 0
+        self.reaproveitadas = 0
+
+    async def obter(self, chave, buscar):
+        tarefa = self._entradas.get(chave)
+        if tarefa is None:
+            tarefa = asyncio.ensure_future(buscar())
+            self._entradas[chave] = tarefa
+            self.buscas += 1
+        else:
+            self.reaproveitadas += 1
+        try:
+            valor = await asyncio.shield(tarefa)
+        except Exception:
+            self.descartar(chave, tarefa)
+            raise
+        if not valor:
+            self.descartar(chave, tarefa)
+        return valor
+
+    def descartar(self, chave, tarefa=None):
+        if tarefa is None or self._entradas.get(chave) is tarefa:
+            self._entradas.pop(chave, None)
+
+# ----------------------------
+# Condições de espera do login (WebDriverWait)
+# ----------------------------
+def botao_com_texto(texto, xpath_alternativo):
+    """Condição que retorna o primeiro botão cujo texto (ou innerHTML/value) contenha `texto`"""
+    def condicao(navegador):
+        for elem in navegador.find_elements(By.TAG_NAME, 'button'):
+            if texto in elem.text.upper():
+                return elem
+        for elem in navegador.find_elements(By.XPATH, xpath_alternativo):
+            if texto in (elem.get_attribute('innerHTML') or '').upper() or texto in (elem.get_attribute('value') or '').upper():
+                return elem
+        return False
+    return condicao
+
+def formulario_login_visivel(navegador):
+    """Condição verdadeira quando o campo userId está na tela (não só presente e escondido no DOM)"""
+    try:
+        return bool(EC.visibility_of_element_located((By.ID, 'userId'))(navegador))
+    except NoSuchElementException:
+        return False
+
+def desfecho_login(navegador):
+    """Condição que retorna o primeiro desfecho do login: aviso, erro de credencial ou token no storage"""
+    for aviso in navegador.find_elements(By.ID, 'swal2-html-container'):
+        if 'troca da sua senha' in aviso.text.lower():
+            return 'ucs_ativar_cadastro'
+    for msg in navegador.find_elements(By.CLASS_NAME, 'm-0'):
+        if 'CPF/CNPJ ou senha inválidos' in msg.text:
+            return 'ucs_cadastro_invalido'
+    token = navegador.execute_script(
+        "return window.localStorage.getItem('access_token') || window.localStorage.getItem('token') || window.localStorage.getItem('tokenNeSe');"
+    )
+    if token:
+        return 'token'
+    return False
+
+# ----------------------------
+# Login no portal (Selenium)
+# ----------------------------
+def realizar_login(navegador, login, senha):
+    """Faz o login no portal. Retorna None em caso de sucesso ou a categoria de falha"""
+    # Todas as esperas dividem o mesmo prazo máximo de TIMEOUT_LOGIN segundos
+    prazo = time.monotonic() + TIMEOUT_LOGIN
+
+    def aguardar(condicao):
+        restante = max(prazo - time.monotonic(), 0.1)
+        return WebDriverWait(navegador, restante, poll_frequency=INTERVALO_VERIFICACAO_LOGIN).until(condicao)
+
+    navegador.get(URL_LOGIN)
+
+    # Clicar no botão LOGIN assim que ele aparecer (ou seguir se o formulário já estiver visível;
+    # o campo existe escondido no DOM antes do clique)
+    try:
+        botao_login = botao_com_texto('LOGIN', "//button | //a | //input[@type='button']")
+        elem = aguardar(lambda nav: formulario_login_visivel(nav) or botao_login(nav))
+        if elem is not True:
+            navegador.execute_script("arguments[0].click();", elem)
+    except TimeoutException:
+        return 'ucs_erro_sistema'
+
+    # Preencher campos de login
+    try:
+        campo_user = aguardar(EC.visibility_of_element_located((By.ID, 'userId')))
+    except TimeoutException:
+        return 'ucs_erro_sistema'
+    try:
+        campo_user.clear()
+        campo_user.send_keys(login)
+
+        campo_senha = navegador.find_element(By.ID, 'password')
+        campo_senha.clear()
+        campo_senha.send_keys(senha)
+    except Exception as e:
+        return 'ucs_cadastro_invalido'
+
+    # Clicar no botão ENTRAR
+    try:
+        elem = aguardar(botao_com_texto('ENTRAR', "//button | //input[@type='submit']"))
+        navegador.execute_script("arguments[0].click();", elem)
+    except TimeoutException:
+        return 'ucs_erro_sistema'
+
+    # Espera o que acontecer primeiro: token, aviso de troca de senha ou credenciais inválidas
+    try:
+        desfecho = aguardar(desfecho_login)
+    except TimeoutException:
+        return 'ucs_erro_sistema'
+
+    if desfecho == 'token':
+        return None
+    return desfecho
+
+# ----------------------------
+# Faturas já baixadas em execuções anteriores
+# ----------------------------
+def reaproveitar_faturas_em_cache(linha, armazem, coletor, meses_refs):
+    """Se todos os meses pedidos da UC já estão no armazém, registra o sucesso sem chamar a API"""
+    nome_distribuidora = DISTRIBUIDORAS[int(linha.dist)]['nome'].upper()
+    faturas = armazem.faturas_da_uc(nome_distribuidora, linha.codigo.zfill(12), meses_refs)
+    if len(faturas) < len(meses_refs):
+        return False
+
+    registro = RegistroUC(coletor, linha)
+    for mes_ref, (uc, nome_arquivo, metadados) in faturas.items():
+        coletor.adicionar_arquivo(mes_ref, nome_arquivo, metadados)
+        registro.meses_baixados.append(mes_ref)
+        registro.meses_reaproveitados.append(mes_ref)
+    registro.uc = uc
+    registro.adicionar('ucs_sucesso', uc)
+    coletor.finalizar_uc(registro)
+    return True
+
+# ----------------------------
+# Fase 2: processamento HTTP de uma UC (sem navegador)
+# ----------------------------
+async def buscar_indice_ucs(motor_http, url_ucs, headers, params_ucs, distribuidora):
+    """Lista de UCs do login indexada pelos 10 últimos dígitos; None se a API falhar"""
+    res_ucs = await fazer_requisicao_com_retry_async(motor_http, url_ucs, headers=headers, params=params_ucs, method='GET', distribuidora=distribuidora)
+    if not res_ucs or res_ucs.status_code != 200:
+        return None
+
+    ucs_data = res_ucs.json()
+    ucs = ucs_data.get('listaUnidadesConsumidoras') or ucs_data.get('ucs') or []
+    return {'indice': {uc['uc'][-10:]: uc for uc in ucs}}
+
+CAMPOS_PROTOCOLO = ('protocolo', 'protocoloSalesforceStr', 'protocoloSalesforce', 'protocoloLegadoStr', 'protocoloLegado')
+
+async def buscar_protocolo(motor_http, url_protocolo, headers, params_protocolo, distribuidora, campos=CAMPOS_PROTOCOLO):
+    """Protocolo de atendimento (o primeiro dos `campos` preenchido); None se a API falhar, '' se a resposta vier sem protocolo"""
+    res_protocolo = await fazer_requisicao_com_retry_async(motor_http, url_protocolo, headers=headers, params=params_protocolo, method='GET', distribuidora=distribuidora)
+    if not res_protocolo or res_protocolo.status_code != 200:
+        return None
+
+    protocolo_data = res_protocolo.json()
+    return next((protocolo_data[campo] for campo in campos if protocolo_data.get(campo)), '')
+
+async def processar_uc_async(linha, motor_http, armazem, cache_tokens, cache_sessoes, pendentes, coletor, meses_desejados, mes_atraso):
+    if coletor.parar.is_set():
+        return
+
+    login = linha.login.strip()
+    id_distribuidora = int(linha.dist)
+    token = cache_tokens.obter(login, id_distribuidora)
+    if not token:
+        # O token expirou enquanto a UC aguardava na fila: volta para uma nova rodada de login
+        pendentes.put(linha)
+        return
+
+    registro = RegistroUC(coletor, linha)
+    inicio_uc = time.perf_counter()
+    registro.numero = coletor.proxima_uc()
+
+    try:
+        uc_desejada = linha.codigo.zfill(12)
+
+        distribuidora = DISTRIBUIDORAS[id_distribuidora]['nome']
+        canal = DISTRIBUIDORAS[id_distribuidora]['canal']
+        regiao = DISTRIBUIDORAS[id_distribuidora]['regiao']
+        usuario_api = DISTRIBUIDORAS[id_distribuidora]['usuario_api']
+        base_url = DISTRIBUIDORAS[id_distribuidora]['base_url']
+
+        headers = {
+            'Authorization': f'Bearer {token}', 
+            'Content-Type': 'application/json',
+            'Accept': 'application/json', 
+            'User-Agent': 'Mozilla/5.0'
+        }
+        
+        # Lista de UCs e protocolos buscados uma vez por token ficam no cache_sessoes sob esta chave
+        chave_sessao = (login, id_distribuidora, token)
+        protocolo_emprestado = False
+
+        # Lógica específica para cada distribuidora
+        if id_distribuidora == 52:
+            # ELEKTRO
+            uc_info = {'uc': uc_desejada}
+
+            url_protocolo = url_api('apiseprd', "/protocolo/1.1.0/obterProtocolo")
+            params_protocolo = {
+                "distribuidora": "ELEKTRO",
+                "canalSolicitante": "AGE",
+                "usuario": "AGENEOELK",
+                "documento": limpar_documento(login),
+                "recaptchaAnl": "false",
+                "regiao": "SE"
+            }
+
+            # O protocolo da ELEKTRO não depende da UC: busca uma vez por token
+            try:
+                protocolo = await cache_sessoes.obter(
+                    chave_sessao + ('protocolo',),
+                    lambda: buscar_protocolo(motor_http, url_protocolo, headers, params_protocolo, distribuidora, campos=('protocoloSalesforceStr',))
+                )
+
+                if protocolo is None:
+                    registro.adicionar('ucs_erro_sistema', uc_desejada)
+                    registro.adicionar('ucs_erro_busca', uc_desejada)
+                    return
+
+                if not protocolo:
+                    registro.adicionar('ucs_retidas', uc_desejada)
+                    return
+
+            except Exception as e:
+                registro.adicionar('ucs_retidas', uc_desejada)
+                return
+
+            url_faturas = url_api('apiseprd', "/multilogin/2.0.0/servicos/faturas/ucs/faturas")
+            params_faturas = {
+                "codigo": uc_desejada,
+                "documento": limpar_documento(login),
+                "canalSolicitante": "AGE",
+                "usuario": "AGENEOELK",
+                "protocolo": protocolo,
+                "distribuidora": "ELEKTRO",
+                "regiao": "SE",
+                "tipoPerfil": "1"
+            }
+
+            try:
+                res_faturas = await fazer_requisicao_com_retry_async(motor_http, url_faturas, headers=headers, params=params_faturas, method='GET', distribuidora=distribuidora)
+
+                if not res_faturas or res_faturas.status_code != 200:
+                    registro.adicionar('ucs_erro_sistema', uc_desejada)
+                    registro.adicionar('ucs_erro_busca', uc_desejada)
+                    return
+
+                faturas_data = res_faturas.json()
+                if 'entregaFaturas' in faturas_data:
+                    faturas = faturas_data['entregaFaturas'][0].get('faturas', [])
+                elif 'faturas' in faturas_data:
+                    faturas = faturas_data['faturas']
+                else:
+                    registro.adicionar('ucs_retidas', uc_desejada)
+                    return
+
+            except Exception as e:
+                registro.adicionar('ucs_retidas', uc_desejada)
+                return
+
+        else:
+            # Demais distribuidoras
+            login_limpo = limpar_documento(login)
+            url_ucs = url_api(base_url, f'/imoveis/1.1.0/clientes/{login_limpo}/ucs')
+
+            params_ucs = {
+                'documento': login_limpo,
+                'canalSolicitante': canal,
+                'distribuidora': distribuidora,
+                'usuario': usuario_api,
+                'indMaisUcs': 'X',
+                'protocolo': '123',
+                'opcaoSSOS': 'S',
+                'tipoPerfil': '1'
+            }
+
+            # A lista de UCs é a mesma para todo o login: busca uma vez por token
+            try:
+                ucs_login = await cache_sessoes.obter(
+                    chave_sessao + ('ucs',),
+                    lambda: buscar_indice_ucs(motor_http, url_ucs, headers, params_ucs, distribuidora)
+                )
+
+                if not ucs_login:
+                    registro.adicionar('ucs_erro_sistema', uc_desejada)
+                    registro.adicionar('ucs_erro_busca', uc_desejada)
+                    return
+
+                uc_info = ucs_login['indice'].get(uc_desejada[-10:])
+                if not uc_info:
+                    registro.adicionar('ucs_retidas', uc_desejada)
+                    return
+
+            except Exception as e:
+                registro.adicionar('ucs_retidas', uc_desejada)
+                return
+
+            url_protocolo = url_api(base_url, '/protocolo/1.1.0/obterProtocolo')
+            params_protocolo = {
+                'distribuidora': distribuidora[:4],
+                'canalSolicitante': canal,
+                'documento': login_limpo,
+                'codCliente': uc_info['uc'],
+                'recaptchaAnl': 'false',
+                'regiao': regiao
+            }
+
+            url_faturas = url_api(base_url, '/multilogin/2.0.0/servicos/faturas/ucs/faturas')
+            params_faturas = {
+                'codigo': uc_info['uc'],
+                'documento': login_limpo,
+                'canalSolicitante': canal,
+                'usuario': usuario_api,
+                'byPassActiv': 'X',
+                'documentoSolicitante': login_limpo,
+                'documentoCliente': login_limpo,
+                'distribuidora': distribuidora,
+                'tipoPerfil': '1'
+            }
+
+            # O protocolo do login é reaproveitado entre as UCs; se a API recusar o
+            # protocolo de outra UC, busca um protocolo próprio e tenta mais uma vez
+            chave_protocolo = chave_sessao + ('protocolo',)
+            reutilizar = REUTILIZAR_PROTOCOLO and chave_sessao not in cache_sessoes.protocolo_recusado
+            while True:
+                try:
+                    if reutilizar:
+                        protocolo = await cache_sessoes.obter(
+                            chave_protocolo,
+                            lambda: buscar_protocolo(motor_http, url_protocolo, headers, params_protocolo, distribuidora)
+                        )
+                    else:
+                        protocolo = await buscar_protocolo(motor_http, url_protocolo, headers, params_protocolo, distribuidora)
+
+                    if protocolo is None:
+                        registro.adicionar('ucs_erro_sistema', uc_info['uc'])
+                        registro.adicionar('ucs_erro_busca', uc_info['uc'])
+                        return
+
+                    if not protocolo:
+                        registro.adicionar('ucs_retidas', uc_info['uc'])
+                        return
+
+                except Exception as e:
+                    registro.adicionar('ucs_retidas', uc_info['uc'])
+                    return
+
+                params_faturas['protocolo'] = protocolo
+
+                try:
+                    res_faturas = await fazer_requisicao_com_retry_async(motor_http, url_faturas, headers=headers, params=params_faturas, method='GET', distribuidora=distribuidora)
+
+                    if not res_faturas or res_faturas.status_code != 200:
+                        if reutilizar:
+                            if res_faturas is not None:
+                                cache_sessoes.protocolo_recusado.add(chave_sessao)
+                            cache_sessoes.descartar(chave_protocolo)
+                            reutilizar = False
+                            continue
+                        registro.adicionar('ucs_erro_sistema', uc_info['uc'])
+                        registro.adicionar('ucs_erro_busca', uc_info['uc'])
+                        return
+
+                    faturas_data = res_faturas.json()
+                    faturas = faturas_data.get("faturas", [])
+                    protocolo_emprestado = reutilizar
+                    break
+
+                except Exception as e:
+                    registro.adicionar('ucs_retidas', uc_info['uc'])
+                    return
+
+        # Processar faturas
+        if not faturas:
+            registro.adicionar('ucs_sem_fatura', uc_info.get('uc', uc_desejada))
+            return
+
+        try:
+            if id_distribuidora == 52:
+                f_mais_recente = sorted(faturas, key=lambda f: f.get("dataCompetencia", ""), reverse=True)[0]
+                if f_mais_recente.get("dataCompetencia", "")[:7].replace('-', '/') <= mes_atraso.replace('/', '-'):
+                    registro.adicionar('ucs_inativas', uc_info['uc'])
+            else:
+                f_mais_recente = sorted(faturas, key=lambda f: f.get("mesReferencia", ""), reverse=True)[0]
+                if f_mais_recente.get("mesReferencia") <= mes_atraso:
+                    registro.adicionar('ucs_inativas', uc_info['uc'])
+        except IndexError:
+            registro.adicionar('ucs_sem_fatura', uc_info.get('uc', uc_desejada))
+            return
+
+        registro.uc = uc_info.get('uc', uc_desejada)
+        registro.protocolo = protocolo
+        registro.faturas_encontradas = len(faturas)
+
+        if id_distribuidora == 52:
+            registro.mais_recente = f_mais_recente.get('dataCompetencia')
+        else:
+            registro.mais_recente = f_mais_recente.get('mesReferencia')
+
+        # Baixar faturas dos meses desejados: os meses da UC vão em paralelo (até MAX_MESES_SIMULTANEOS),
+        # com o mesmo token e protocolo; os desfechos entram no registro depois, na ordem dos meses
+        faturas_baixadas_neste_mes = 0
+        meses_lista = [mes.strip() for mes in meses_desejados.split(",")]
+        nome_distribuidora = distribuidora.upper()
+        codigo_uc = uc_info.get('uc', uc_desejada)
+        limite_meses = asyncio.Semaphore(MAX_MESES_SIMULTANEOS)
+        chave_protocolo_uc = chave_sessao + ('protocolo', codigo_uc)
+
+        def protocolo_da_uc():
+            """Protocolo só desta UC, buscado uma vez para todos os meses cujo /pdf recusou o protocolo emprestado"""
+            return cache_sessoes.obter(
+                chave_protocolo_uc,
+                lambda: buscar_protocolo(motor_http, url_protocolo, headers, params_protocolo, distribuidora)
+            )
+
+        async def baixar_mes(mes_desejada):
+            """Desfecho de um mês: categorias, (mes_ref, nome_arquivo, metadados) do PDF e se ele veio do armazém"""
+            desfecho_mes = {'categorias': [], 'arquivo': None, 'reaproveitado': False, 'nao_encontrado': False}
+            async with limite_meses:
+                if coletor.parar.is_set():
+                    return None # Não começa outros meses se o usuário parar
+
+                fatura_desejada = None
+
+                if id_distribuidora == 52:
+                    mes_desejada_formatada = mes_desejada.replace('/', '-')
+                    fatura_desejada = next((f for f in faturas if f.get('dataCompetencia', '').startswith(mes_desejada_formatada)), None)
+                else:
+                    fatura_desejada = next((f for f in faturas if f.get('mesReferencia') == mes_desejada), None)
+
+                if not fatura_desejada:
+                    desfecho_mes['nao_encontrado'] = True
+                    desfecho_mes['categorias'].append('ucs_retidas')
+                    return desfecho_mes
+
+                numero_fatura = fatura_desejada.get('numeroFatura')
+                if not numero_fatura:
+                    desfecho_mes['categorias'].append('ucs_retidas')
+                    return desfecho_mes
+
+                mes_ref = mes_desejada.replace('/', '-')
+                nome_arquivo = f"{nome_distribuidora}_{codigo_uc}_{mes_ref}.pdf"
+
+                # Fatura já baixada em uma execução anterior: não chama o /pdf de novo
+                metadados = await asyncio.to_thread(
+                    armazem.fatura_existente, nome_distribuidora, codigo_uc, mes_ref, numero_fatura
+                )
+                if metadados:
+                    desfecho_mes['arquivo'] = (mes_ref, nome_arquivo, metadados)
+                    desfecho_mes['reaproveitado'] = True
+                    return desfecho_mes
+
+                # Download do PDF
+                url_pdf = url_api(base_url, f"/multilogin/2.0.0/servicos/faturas/{numero_fatura}/pdf")
+
+                if id_distribuidora == 52:
+                    params_pdf = {
+                        "codigo": codigo_uc,
+                        "protocolo": protocolo,
+                        "tipificacao": fatura_desejada.get('tipificacao', "1031607"),
+                        "usuario": usuario_api,
+                        "canalSolicitante": canal,
+                        "distribuidora": distribuidora,
+                        "regiao": regiao,
+                        "tipoPerfil": "1",
+                        "documento": limpar_documento(login),
+                    }
+                else:
+                    params_pdf = {
+                        "codigo": codigo_uc,
+                        "protocolo": protocolo,
+                        "tipificacao": fatura_desejada.get('tipificacao', "1031607"),
+                        "usuario": usuario_api,
+                        "canalSolicitante": canal,
+                        "distribuidora": distribuidora,
+                        "regiao": regiao,
+                        "tipoPerfil": "1",
+                        "documento": limpar_documento(login),
+                        "documentoSolicitante": limpar_documento(login),
+                        "documentoCliente": limpar_documento(login),
+                        "byPassActiv": "X",
+                        "motivo": "2"
+                    }
+
+                try:
+                    while True:
+                        res_pdf = await fazer_requisicao_com_retry_async(
+                            motor_http,
+                            url_pdf, 
+                            headers=headers, 
+                            params=params_pdf, 
+                            method='GET',
+                            distribuidora=distribuidora,
+                            skip_retry_errors=ERRORS_SEM_RETRY,
+                            leitor=DownloadPDF(armazem)
+                        )
+
+                        if res_pdf is None or not protocolo_emprestado:
+                            break
+                        if params_pdf['protocolo'] != protocolo:
+                            # Só o protocolo da própria UC funcionou: as próximas UCs do login não pegam emprestado
+                            if res_pdf.status_code == 200:
+                                cache_sessoes.protocolo_recusado.add(chave_sessao)
+                            break
+                        if res_pdf.status_code == 200 or "Fatura indisponível no canal digital" in res_pdf.text:
+                            break
+
+                        # O /pdf recusou o protocolo emprestado de outra UC: tenta com um protocolo próprio
+                        protocolo_proprio = await protocolo_da_uc()
+                        if not protocolo_proprio:
+                            break
+                        params_pdf['protocolo'] = protocolo_proprio
+
+                    if not res_pdf:
+                        desfecho_mes['categorias'] += ['ucs_erro_sistema', 'ucs_erro_busca']
+                        return desfecho_mes
+
+                    if res_pdf.status_code != 200:
+                        if "Fatura indisponível no canal digital" in res_pdf.text:
+                            desfecho_mes['categorias'].append('ucs_fatura_indisponivel')
+                        elif "falha ao checar relação 'documento' - 'uc'" in res_pdf.text:
+                            desfecho_mes['categorias'].append('ucs_cadastro_invalido')
+                        else:
+                            desfecho_mes['categorias'].append('ucs_retidas')
+                        return desfecho_mes
+
+                    # === O PDF já foi gravado em disco durante o download; a sessão guarda só os metadados ===
+                    content_type = res_pdf.headers.get('Content-Type', '')
+                    baixado = res_pdf.dados
+
+                    # Move o temporário para o armazém; o registro é atualizado na ordem dos meses
+                    if baixado:
+                        temporario, sha256, tamanho = baixado
+                        metadados = await asyncio.to_thread(
+                            armazem.salvar_arquivo, nome_distribuidora, codigo_uc, mes_ref, nome_arquivo,
+                            temporario, sha256, tamanho, uc_desejada, numero_fatura
+                        )
+                        desfecho_mes['arquivo'] = (mes_ref, nome_arquivo, metadados)
+                    elif 'application/pdf' not in content_type:
+                        # JSON sem fileData/faturaBase64 ou formato inesperado
+                        desfecho_mes['categorias'].append('ucs_retidas')
+                    # ===============================================
+
+                except Exception as e:
+                    coletor.registrar_mensagem(f"Erro ao baixar PDF para UC {codigo_uc}: {e}", 'warning')
+                    desfecho_mes['categorias'].append('ucs_retidas')
+
+                return desfecho_mes
+
+        desfechos_meses = await asyncio.gather(*(baixar_mes(mes) for mes in meses_lista))
+        cache_sessoes.descartar(chave_protocolo_uc)
+
+        for mes_desejada, desfecho_mes in zip(meses_lista, desfechos_meses):
+            if desfecho_mes is None:
+                continue
+            if desfecho_mes['nao_encontrado']:
+                registro.meses_nao_encontrados.append(mes_desejada)
+            for categoria in desfecho_mes['categorias']:
+                registro.adicionar(categoria, codigo_uc)
+            if desfecho_mes['arquivo']:
+                mes_ref, nome_arquivo, metadados = desfecho_mes['arquivo']
+                coletor.adicionar_arquivo(mes_ref, nome_arquivo, metadados)
+                registro.meses_baixados.append(mes_ref)
+                if desfecho_mes['reaproveitado']:
+                    registro.meses_reaproveitados.append(mes_ref)
+                else:
+                    registro.bytes_baixados += metadados['tamanho']
+                faturas_baixadas_neste_mes += 1
+
+        # Contabilizar sucesso
+        if faturas_baixadas_neste_mes > 0:
+            registro.adicionar('ucs_sucesso', uc_info.get('uc', uc_desejada))
+
+        # Tempo da UC
+        fim_uc = time.perf_counter()
+        tempo_uc = fim_uc - inicio_uc
+        registro.tempo = round(tempo_uc, 2)
+
+    except Exception as e:
+        coletor.registrar_mensagem(f"Erro inesperado no processamento da UC {linha.codigo}: {e}", 'error')
+        registro.adicionar('ucs_retidas', linha.codigo)
+    finally:
+        # Tabela, jornal (SQLite) e observadores fora do loop de eventos
+        await asyncio.to_thread(coletor.finalizar_uc, registro)
+
+# ----------------------------
+# Fase 1: worker com navegador próprio que só colhe tokens
+# ----------------------------
+def worker_login(fila_grupos, cache_tokens, cache_sessoes, motor_http, armazem, futuros, pendentes, coletor, meses_desejados, mes_atraso, pool):
+    meses_refs = [mes.strip().replace('/', '-') for mes in meses_desejados.split(",")]
+
+    while not coletor.parar.is_set():
+        try:
+            df_grupo = fila_grupos.get_nowait()
+        except queue.Empty:
+            break
+
+        # Nenhuma exceção sai da thread: as UCs do grupo que ainda não tiveram desfecho viram erro do sistema
+        resolvidas = set()
+        try:
+            ids = pd.to_numeric(df_grupo['dist'], errors='coerce')
+            invalidas = df_grupo[ids.isna()]
+            if not invalidas.empty:
+                coletor.registrar_mensagem(f"⚠️ {len(invalidas)} UCs sem distribuidora_id numérico foram retidas", 'warning')
+                coletor.registrar_falha_grupo(invalidas, 'ucs_retidas')
+                resolvidas.update(invalidas['codigo'])
+            validas = ids.isin(list(DISTRIBUIDORAS))
+            df_grupo = df_grupo[validas].assign(dist=ids[validas].astype(int).astype(str))
+            if df_grupo.empty:
+                continue
+
+            # UCs com todos os meses já baixados são resolvidas pelo armazém, sem login nem API
+            em_cache = []
+            for linha in df_grupo.itertuples(index=False):
+                em_cache.append(reaproveitar_faturas_em_cache(linha, armazem, coletor, meses_refs))
+                if em_cache[-1]:
+                    resolvidas.add(linha.codigo)
+            df_grupo = df_grupo[[not coberta for coberta in em_cache]]
+            if df_grupo.empty:
+                continue
+
+            login = df_grupo['login'].iloc[0].strip()
+            ids_distribuidora = df_grupo['dist'].astype(int).unique()
+
+            # Um único login por grupo; o navegador volta ao pool logo depois
+            try:
+                falha = None
+                if not all(cache_tokens.obter(login, id_dist) for id_dist in ids_distribuidora):
+                    inicio = time.perf_counter()
+                    with pool.navegador() as navegador:
+                        METRICAS.observar('neoenergia_espera_navegador_segundos', time.perf_counter() - inicio)
+                        inicio = time.perf_counter()
+                        falha = realizar_login(navegador, login, df_grupo['senha_dist'].iloc[0])
+                        METRICAS.observar('neoenergia_etapa_segundos', time.perf_counter() - inicio, etapa='login', distribuidora='portal', status=falha or 'ok')
+                        if not falha:
+                            for id_dist in ids_distribuidora:
+                                token = ler_token_storage(navegador, id_dist)
+                                if token:
+                                    cache_tokens.salvar(login, id_dist, token)
+            except Exception as e:
+                coletor.registrar_mensagem(f"Erro inesperado no login {login}: {e}", 'error')
+                falha = 'ucs_erro_sistema'
+
+            if falha:
+                resolvidas.update(df_grupo['codigo'])
+                coletor.registrar_falha_grupo(df_grupo, falha)
+                continue
+
+            for linha in df_grupo.itertuples(index=False):
+                futuros.append(motor_http.submeter(
+                    processar_uc_async(linha, motor_http, armazem, cache_tokens, cache_sessoes, pendentes, coletor, meses_desejados, mes_atraso)
+                ))
+                resolvidas.add(linha.codigo)
+        except Exception as e:
+            coletor.registrar_mensagem(f"Erro inesperado no grupo do login {df_grupo['login'].iloc[0]}: {e}", 'error')
+            coletor.registrar_falha_grupo(df_grupo[~df_grupo['codigo'].isin(resolvidas)], 'ucs_erro_sistema')
+
+# ----------------------------
+# Espera das fases na thread do job
+# ----------------------------
+def aguardar_execucao(em_andamento, coletor):
+    # A parada é pedida pelo coletor.parar; cada UC confere o sinal antes de começar
+    try:
+        while em_andamento():
+            time.sleep(INTERVALO_PROGRESSO)
+    finally:
+        if em_andamento():
+            coletor.parar.set()
+
+# ----------------------------
+# Função principal do scraper
+# ----------------------------
+def executar_scraper(df_filtrado, meses_desejados, mes_atraso, headless=False, max_workers=1, max_requisicoes=MAX_REQUISICOES_PADRAO, execucao_id=None, coletor=None, diretorio_dados=DIRETORIO_DADOS):
+    # O progresso, as mensagens e os PDFs baixados ficam no coletor (ver GerenciadorJobs)
+    if coletor is None:
+        coletor = ColetorResultados(len(df_filtrado))
+
+    # Cada grupo contém todas as UCs de um mesmo login (contíguas, como sai de ordenar_por_login)
+    grupos = PlanoExecucao(df_filtrado).grupos()
+
+    # Cada UC finalizada é gravada no jornal; ao retomar, a execução continua no mesmo id
+    jornal = JornalExecucoes(os.path.join(diretorio_dados, 'execucoes.db'))
+    if execucao_id is None:
+        execucao_id = jornal.iniciar(meses_desejados, mes_atraso, len(df_filtrado))
+    coletor.jornal = jornal
+    coletor.execucao_id = execucao_id
+    coletor.registrar_mensagem(f"📝 Execução #{execucao_id} registrada no jornal", 'info')
+    coletor.notificar('execucao_iniciada', execucao_id, coletor.total)
+
+    cache_tokens = CacheTokens()
+    cache_sessoes = CacheSessaoLogin()
+    armazem = ArmazemPDFs(os.path.join(diretorio_dados, 'pdfs'))
+    num_workers = max(1, min(int(max_workers), len(grupos)))
+    
+    tempo_total_inicio = time.perf_counter()
+    
+    motor_http = MotorHTTPAsync(max_requisicoes)
+    pool = obter_pool_navegadores(headless)
+
+    try:
+        for rodada in range(MAX_RODADAS_TOKEN):
+            if not grupos or coletor.parar.is_set():
+                break
+
+            fila_grupos = queue.Queue()
+            for df_grupo in grupos:
+                fila_grupos.put(df_grupo)
+
+            num_workers = max(1, min(int(max_workers), len(grupos)))
+            futuros = []
+            pendentes = queue.Queue()
+
+            workers = []
+            for n in range(num_workers):
+                worker = threading.Thread(
+                    target=worker_login,
+                    name=f"worker-login-{n + 1}",
+                    args=(fila_grupos, cache_tokens, cache_sessoes, motor_http, armazem, futuros, pendentes, coletor, meses_desejados, mes_atraso, pool),
+                    daemon=True
+                )
+                workers.append(worker)
+
+            # Os navegadores ficam abertos entre execuções; só abre os que faltarem
+            try:
+                pool.aquecer(num_workers)
+            except Exception as e:
+                coletor.registrar_mensagem(f"Erro ao iniciar navegador: {e}", 'error')
+                coletor.registrar_mensagem("Verifique se o 'google-chrome-stable' e 'chromedriver' estão no seu 'packages.txt'.", 'error')
+                if not pool.usos:
+                    coletor.registrar_mensagem("❌ Não foi possível iniciar o navegador", 'error')
+                    return None
+
+            for worker in workers:
+                worker.start()
+
+            aguardar_execucao(
+                lambda: any(w.is_alive() for w in workers) or any(not f.done() for f in futuros),
+                coletor
+            )
+
+            # UCs cujo token expirou antes da fase HTTP voltam para uma nova rodada de login
+            linhas_pendentes = list(pendentes.queue)
+            grupos = []
+            if linhas_pendentes:
+                df_pendentes = pd.DataFrame(linhas_pendentes)
+                grupos = [df_grupo.reset_index(drop=True) for _, df_grupo in df_pendentes.groupby('login', sort=False)]
+
+        for df_grupo in grupos:
+            coletor.registrar_falha_grupo(df_grupo, 'ucs_erro_sistema')
+    finally:
+        motor_http.encerrar()
+
+    if coletor.parar.is_set():
+        coletor.registrar_mensagem("⏹️ Execução interrompida pelo usuário", 'warning')
+    
+    tempo_total_fim = time.perf_counter()
+    tempo_total = tempo_total_fim - tempo_total_inicio
+
+    # Relatório final (uma passada pela tabela; quem teve sucesso só conta como sucesso)
+    ucs_por_categoria = coletor.tabela.ucs_por_categoria()
+    
+    coletor.registrar_mensagem("\n🧾 === RELATÓRIO FINAL ===")
+    coletor.registrar_mensagem(f"📊 Total UCs: {len(df_filtrado)}")
+    coletor.registrar_mensagem(f"✅ Sucesso: {len(ucs_por_categoria['ucs_sucesso'])}")
+    coletor.registrar_mensagem(f"📦 Retidas: {len(ucs_por_categoria['ucs_retidas'])}")
+    coletor.registrar_mensagem(f"🚫 Indisponíveis: {len(ucs_por_categoria['ucs_fatura_indisponivel'])}")
+    coletor.registrar_mensagem(f"🔴 Erros Sistema: {len(ucs_por_categoria['ucs_erro_sistema'])}")
+    coletor.registrar_mensagem(f"❌ Erros Busca: {len(ucs_por_categoria['ucs_erro_busca'])}")
+    coletor.registrar_mensagem(f"📭 Sem Fatura: {len(ucs_por_categoria['ucs_sem_fatura'])}")
+    coletor.registrar_mensagem(f"⛔ Inativas: {len(ucs_por_categoria['ucs_inativas'])}")
+    coletor.registrar_mensagem(f"🔐 Ativar Cadastro: {len(ucs_por_categoria['ucs_ativar_cadastro'])}")
+    coletor.registrar_mensagem(f"🔑 Cred. Inválidas: {len(ucs_por_categoria['ucs_cadastro_invalido'])}")
+    coletor.registrar_mensagem(f"\n⏲️ Tempo Total: {tempo_total:.2f} seg ({num_workers} worker(s))")
+
+    conexoes = motor_http.estatisticas_conexoes()
+    for host, contadores in conexoes.items():
+        if contadores['novas'] or contadores['reutilizadas']:
+            coletor.registrar_mensagem(f"🔌 {host}: {contadores['novas']} conexões abertas, {contadores['reutilizadas']} reutilizadas")
+
+    limites = motor_http.estatisticas_limites()
+    for chave, taxa in limites.items():
+        coletor.registrar_mensagem(f"🚦 {chave}: taxa final {taxa} req/s")
+
+    if cache_sessoes.reaproveitadas:
+        coletor.registrar_mensagem(f"🗂️ Lista de UCs/protocolo: {cache_sessoes.buscas} buscas, {cache_sessoes.reaproveitadas} reaproveitadas")
+    
+    resultados = {
+        'execucao_id': execucao_id,
+        'ucs_processadas': len(df_filtrado),
+        **ucs_por_categoria,
+        'tempo_total': tempo_total,
+        'tempos_ucs': coletor.tabela.tempos(),
+        'conexoes': conexoes,
+        'limites': limites
+    }
+    coletor.notificar('execucao_finalizada', resultados)
+    
+    return resultados
+
+# ----------------------------
+# Fila compartilhada de shards (execução em vários nós)
+# ----------------------------
+class FilaShards:
+    """Fila em SQLite com um shard por login, compartilhada pelos nós que apontam para o mesmo diretório de dados.
+
+    Cada nó reserva alguns shards com um lease, processa e confirma. Se o nó cair, o lease
+    expira e outro nó reserva o shard de novo; as UCs já concluídas são puladas pelo jornal,
+    que fica no mesmo arquivo. Um shard reservado MAX_TENTATIVAS_SHARD vezes sem ser confirmado
+    vira 'falhou' em vez de derrubar nós para sempre. As linhas guardam as credenciais da
+    planilha, como o CSV de entrada: o arquivo é criado com permissão 0600 e as UCs de um
+    shard são apagadas assim que ele é confirmado.
+
+    O arquivo usa MODO_JOURNAL_COMPARTILHADO (sem WAL), então o volume só precisa de locks de arquivo.
+    """
+
+    def __init__(self, caminho=CAMINHO_JORNAL):
+        self.caminho = caminho
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        criar_arquivo_privado(caminho)
+        with self._conectar() as conexao:
+            conexao.execute("""
+                CREATE TABLE IF NOT EXISTS shards (
+                    execucao_id INTEGER NOT NULL,
+                    login TEXT NOT NULL,
+                    ordem INTEGER NOT NULL,
+                    ucs TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pendente',
+                    no TEXT,
+                    lease_ate REAL,
+                    tentativas INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (execucao_id, login)
+                )
+            """)
+
+    @contextmanager
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho, timeout=30)
+        try:
+            conexao.execute(f"PRAGMA journal_mode={MODO_JOURNAL_COMPARTILHADO}")
+            with conexao:
+                yield conexao
+        finally:
+            conexao.close()
+
+    def criar(self, execucao_id, df_filtrado):
+        """Um shard por login, na ordem do df_filtrado (logins com mais UCs primeiro)"""
+        grupos = df_filtrado.groupby('login', sort=False)
+        with self._conectar() as conexao:
+            conexao.executemany(
+                "INSERT OR IGNORE INTO shards (execucao_id, login, ordem, ucs) VALUES (?, ?, ?, ?)",
+                [
+                    (execucao_id, login, ordem, df_grupo.to_json(orient='records'))
+                    for ordem, (login, df_grupo) in enumerate(grupos)
+                ]
+            )
+        return grupos.ngroups
+
+    def reservar(self, execucao_id, no, quantidade):
+        """Reserva até `quantidade` shards livres (ou com lease vencido); retorna {login: df_grupo}"""
+        agora = time.time()
+        with self._conectar() as conexao:
+            # Lease vencido na última tentativa permitida: o shard derrubou nós demais
+            conexao.execute("""
+                UPDATE shards SET status = 'falhou', lease_ate = NULL
+                WHERE execucao_id = ? AND status = 'em_andamento' AND lease_ate < ? AND tentativas >= ?
+            """, (execucao_id, agora, MAX_TENTATIVAS_SHARD))
+            linhas = conexao.execute("""
+                UPDATE shards SET status = 'em_andamento', no = ?, lease_ate = ?, tentativas = tentativas + 1
+                WHERE rowid IN (
+                    SELECT rowid FROM shards
+                    WHERE execucao_id = ?
+                      AND (status = 'pendente' OR (status = 'em_andamento' AND lease_ate < ?))
+                    ORDER BY ordem LIMIT ?
+                )
+                RETURNING login, ucs
+            """, (no, agora + LEASE_SHARD, execucao_id, agora, quantidade)).fetchall()
+        return {login: pd.DataFrame(json.loads(ucs), dtype=str) for login, ucs in linhas}
+
+    def _atualizar(self, sql, parametros, execucao_id, no, logins):
+        marcadores = ",".join("?" * len(logins))
+        with self._conectar() as conexao:
+            conexao.execute(
+                f"{sql} WHERE execucao_id = ? AND no = ? AND status = 'em_andamento' AND login IN ({marcadores})",
+                (*parametros, execucao_id, no, *logins)
+            )
+
+    def renovar(self, execucao_id, no, logins):
+        self._atualizar("UPDATE shards SET lease_ate = ?", (time.time() + LEASE_SHARD,), execucao_id, no, logins)
+
+    def confirmar(self, execucao_id, no, logins):
+        """Marca os shards como concluídos e apaga as UCs (com as senhas), que ninguém vai reservar de novo"""
+        self._atualizar("UPDATE shards SET status = 'concluido', lease_ate = NULL, ucs = '[]'", (), execucao_id, no, logins)
+
+    def liberar(self, execucao_id, no, logins):
+        """Devolve os shards à fila (ex.: parada do nó) para que outro nó os processe; não conta como tentativa"""
+        self._atualizar(
+            "UPDATE shards SET status = 'pendente', no = NULL, lease_ate = NULL, tentativas = tentativas - 1",
+            (), execucao_id, no, logins
+        )
+
+    def situacao(self, execucao_id):
+        with self._conectar() as conexao:
+            linhas = conexao.execute(
+                "SELECT status, COUNT(*) FROM shards WHERE execucao_id = ? GROUP BY status", (execucao_id,)
+            ).fetchall()
+        return dict(linhas)
+
+def identificador_no():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def executar_shards(execucao_id, headless=False, max_workers=1, max_requisicoes=MAX_REQUISICOES_PADRAO, diretorio_dados=DIRETORIO_DADOS,
+                    shards_por_rodada=None, observadores=(), parar=None, ao_finalizar_rodada=None):
+    """Nó de uma execução distribuída: reserva shards, roda o executar_scraper neles e confirma, até a fila esvaziar.
+
+    Retorna False se a execução não existe ou o navegador não pôde ser iniciado.
+    """
+    caminho_jornal = os.path.join(diretorio_dados, 'execucoes.db')
+    jornal = JornalExecucoes(caminho_jornal)
+    fila = FilaShards(caminho_jornal)
+    execucao = jornal.obter(execucao_id)
+    if not execucao:
+        return False
+
+    no = identificador_no()
+    parar = parar or threading.Event()
+    shards_por_rodada = shards_por_rodada or max(1, int(max_workers)) * 2
+
+    while not parar.is_set():
+        shards = fila.reservar(execucao_id, no, shards_por_rodada)
+        if not shards:
+            return True
+        logins = list(shards)
+
+        # Um shard reservado de novo (nó anterior caiu) só refaz as UCs que não terminaram
+        concluidas = jornal.ucs_concluidas(execucao_id)
+        df_rodada = pd.concat(shards.values(), ignore_index=True)
+        df_rodada = df_rodada[~df_rodada['codigo'].isin(concluidas)].reset_index(drop=True)
+
+        coletor = ColetorResultados(len(df_rodada), observadores=observadores)
+        coletor.parar = parar
+
+        fim_rodada = threading.Event()
+        def renovar_leases():
+            while not fim_rodada.wait(INTERVALO_RENOVACAO_LEASE):
+                fila.renovar(execucao_id, no, logins)
+        renovacao = threading.Thread(target=renovar_leases, name="renovacao-lease", daemon=True)
+        renovacao.start()
+
+        try:
+            resultados = None
+            if not df_rodada.empty:
+                resultados = executar_scraper(
+                    df_rodada, execucao['meses'], execucao['mes_atraso'], headless, max_workers, max_requisicoes,
+                    execucao_id, coletor, diretorio_dados
+                )
+                if resultados is None:
+                    fila.liberar(execucao_id, no, logins)
+                    return False
+        finally:
+            fim_rodada.set()
+            renovacao.join()
+
+        if parar.is_set():
+            fila.liberar(execucao_id, no, logins)
+            break
+
+        fila.confirmar(execucao_id, no, logins)
+        if ao_finalizar_rodada and resultados:
+            ao_finalizar_rodada(coletor, resultados)
+
+    return True
@@ -0,0 +1,192 @@
+"""Download do /pdf em streaming: ExtratorBase64Json e DownloadPDF contra corpos partidos em pedaços arbitrários"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+
+import pytest
+
+from scraper import ArmazemPDFs, DownloadPDF, ExtratorBase64Json
+
+# ----------------------------
+# Corpos de resposta do /pdf
+# ----------------------------
+def pdf_aleatorio(gerador, tamanho=None):
+    tamanho = gerador.randrange(0, 4000) if tamanho is None else tamanho
+    return b'%PDF-1.4\n' + gerador.randbytes(tamanho) + b'\n%%EOF'
+
+def base64_com_barras_escapadas(pdf):
+    return base64.b64encode(pdf).decode().replace('/', '\\/')
+
+def base64_quebrado_em_linhas(pdf):
+    # base64 MIME (linhas de 76) serializado em JSON: as quebras viram \n
+    return json.dumps(base64.encodebytes(pdf).decode())[1:-1]
+
+def base64_quebrado_em_unicode(pdf):
+    return base64_quebrado_em_linhas(pdf).replace('\\n', '\\u000a')
+
+FORMATOS_JSON = {
+    'fileData': lambda pdf: json.dumps({'fileData': base64.b64encode(pdf).decode()}),
+    'faturaBase64': lambda pdf: json.dumps({'faturaBase64': base64.b64encode(pdf).decode()}),
+    'campos_em_volta': lambda pdf: (
+        '{"status": "OK", "mensagem": "' + 'x' * 600 + '", "dados": {"uc": "007000000001"},\n'
+        '  "fileData" :  "' + base64.b64encode(pdf).decode() + '", "fim": true}'
+    ),
+    'barras_escapadas': lambda pdf: '{"fileData": "' + base64_com_barras_escapadas(pdf) + '"}',
+    'quebras_de_linha': lambda pdf: '{"fileData": "' + base64_quebrado_em_linhas(pdf) + '"}',
+    'quebras_unicode': lambda pdf: '{"fileData": "' + base64_quebrado_em_unicode(pdf) + '"}',
+    'fileData_vazio': lambda pdf: json.dumps({'fileData': '', 'faturaBase64': base64.b64encode(pdf).decode()}),
+    'fileData_nulo': lambda pdf: json.dumps({'fileData': None, 'faturaBase64': base64.b64encode(pdf).decode()}),
+}
+
+def partir(corpo, gerador, maximo):
+    """Pedaços de 1..maximo bytes, como o iter_chunked entrega um corpo que chega aos poucos"""
+    inicio = 0
+    while inicio < len(corpo):
+        fim = inicio + gerador.randint(1, maximo)
+        yield corpo[inicio:fim]
+        inicio = fim
+
+def extrair(corpo, pedacos):
+    extrator = ExtratorBase64Json()
+    saida = b''.join(extrator.alimentar(pedaco) for pedaco in pedacos)
+    extrator.finalizar()
+    return saida, extrator
+
+# ----------------------------
+# ExtratorBase64Json
+# ----------------------------
+@pytest.mark.parametrize('formato', FORMATOS_JSON)
+@pytest.mark.parametrize('tamanho_pedaco', range(1, 65))
+def test_extrator_pedacos_de_tamanho_fixo(formato, tamanho_pedaco):
+    gerador = random.Random(tamanho_pedaco)
+    pdf = pdf_aleatorio(gerador)
+    corpo = FORMATOS_JSON[formato](pdf).encode()
+    pedacos = [corpo[i:i + tamanho_pedaco] for i in range(0, len(corpo), tamanho_pedaco)]
+
+    saida, extrator = extrair(corpo, pedacos)
+
+    assert saida == pdf
+    assert extrator.concluido
+
+def test_extrator_pdfs_e_pedacos_aleatorios():
+    gerador = random.Random(2025)
+    for _ in range(400):
+        # Tamanhos pequenos e perto de múltiplos de 3 cobrem o padding do base64
+        pdf = pdf_aleatorio(gerador, gerador.choice([0, 1, 2, 3, gerador.randrange(4000)]))
+        formato = gerador.choice(list(FORMATOS_JSON))
+        corpo = FORMATOS_JSON[formato](pdf).encode()
+
+        saida, _ = extrair(corpo, partir(corpo, gerador, gerador.randint(1, 64)))
+
+        assert saida == pdf, formato
+
+def test_extrator_ignora_o_que_vem_depois_do_valor():
+    pdf = pdf_aleatorio(random.Random(1))
+    corpo = json.dumps({'fileData': base64.b64encode(pdf).decode(), 'faturaBase64': base64.b64encode(b'outro').decode()}).encode()
+
+    saida, extrator = extrair(corpo, partir(corpo, random.Random(2), 5))
+
+    assert saida == pdf
+    assert extrator.concluido
+
+@pytest.mark.parametrize('corpo', [
+    b'{"mensagem": "Fatura indispon\\u00edvel no canal digital"}',
+    b'{"fileData": null}',
+    b'{"fileData": "", "faturaBase64": ""}',
+    b'',
+])
+def test_extrator_sem_pdf(corpo):
+    saida, extrator = extrair(corpo, partir(corpo, random.Random(3), 4))
+
+    assert saida == b''
+    assert not extrator.concluido
+
+def test_extrator_json_truncado_no_base64():
+    corpo = json.dumps({'fileData': base64.b64encode(pdf_aleatorio(random.Random(4))).decode()}).encode()
+    extrator = ExtratorBase64Json()
+    extrator.alimentar(corpo[:len(corpo) // 2])
+
+    with pytest.raises(ValueError):
+        extrator.finalizar()
+
+# ----------------------------
+# DownloadPDF
+# ----------------------------
+class CorpoSimulado:
+    """O pedaço de aiohttp.StreamReader que o DownloadPDF usa"""
+
+    def __init__(self, corpo, pedacos, falhar_em=None):
+        self.corpo = corpo
+        self.pedacos = pedacos
+        self.falhar_em = falhar_em
+
+    async def iter_chunked(self, tamanho):
+        for inicio in range(0, len(self.corpo), self.pedacos):
+            if self.falhar_em is not None and inicio >= self.falhar_em:
+                raise ConnectionResetError("conexão caiu no meio do corpo")
+            yield self.corpo[inicio:inicio + self.pedacos]
+
+class RespostaSimulada:
+    def __init__(self, corpo, content_type, pedacos=7, falhar_em=None):
+        self.headers = {'Content-Type': content_type}
+        self.content = CorpoSimulado(corpo, pedacos, falhar_em)
+
+@pytest.fixture
+def armazem(tmp_path):
+    return ArmazemPDFs(str(tmp_path))
+
+def temporarios(armazem):
+    return [nome for nome in os.listdir(armazem.diretorio_blobs) if nome.endswith('.tmp')]
+
+def baixar(armazem, resposta):
+    return asyncio.run(DownloadPDF(armazem)(resposta))
+
+@pytest.mark.parametrize('content_type, formato', [
+    ('application/pdf', None),
+    ('application/json', 'fileData'),
+    ('application/json; charset=utf-8', 'quebras_de_linha'),
+    ('application/json', 'fileData_vazio'),
+])
+def test_download_grava_pdf_e_sha256(armazem, content_type, formato):
+    pdf = pdf_aleatorio(random.Random(5), 3000)
+    corpo = pdf if formato is None else FORMATOS_JSON[formato](pdf).encode()
+
+    temporario, sha256, tamanho = baixar(armazem, RespostaSimulada(corpo, content_type))
+
+    with open(temporario, 'rb') as arquivo:
+        assert arquivo.read() == pdf
+    assert sha256 == hashlib.sha256(pdf).hexdigest()
+    assert tamanho == len(pdf)
+
+    metadados = armazem.salvar_arquivo('COELBA', '007000000001', '2025-10', 'COELBA_007000000001_2025-10.pdf', temporario, sha256, tamanho)
+    assert ArmazemPDFs.ler(metadados) == pdf
+    assert not temporarios(armazem)
+
+@pytest.mark.parametrize('corpo, content_type', [
+    (b'{"fileData": null}', 'application/json'),
+    (b'', 'application/pdf'),
+])
+def test_download_sem_pdf_nao_deixa_temporario(armazem, corpo, content_type):
+    assert baixar(armazem, RespostaSimulada(corpo, content_type)) is None
+    assert not temporarios(armazem)
+
+def test_download_ignora_content_type_desconhecido(armazem):
+    assert baixar(armazem, RespostaSimulada(b'<html></html>', 'text/html')) is None
+    assert not temporarios(armazem)
+
+def test_download_remove_temporario_se_o_corpo_falhar(armazem):
+    corpo = FORMATOS_JSON['fileData'](pdf_aleatorio(random.Random(6), 3000)).encode()
+
+    with pytest.raises(ConnectionResetError):
+        baixar(armazem, RespostaSimulada(corpo, 'application/json', falhar_em=len(corpo) // 2))
+    assert not temporarios(armazem)
+
+def test_download_json_truncado(armazem):
+    corpo = FORMATOS_JSON['fileData'](pdf_aleatorio(random.Random(7), 3000)).encode()
+
+    with pytest.raises(ValueError):
+        baixar(armazem, RespostaSimulada(corpo[:len(corpo) // 2], 'application/json'))
+    assert not temporarios(armazem)